@@ -0,0 +1,229 @@
+"""
+Benchmark harness of the stages of the pipeline. Each stage runs in a fresh process (so the peak
+RSS of a stage is not hidden by the ones that ran before it): its inputs are prepared first, and
+then the wall time of the stage and the peak RSS of the process are recorded. Results are saved as
+JSON, and can be compared with the results of a previous run to catch regressions.
+
+    python benchmarks/synthetic_rf2.py --concepts 100000 --out /tmp/synthetic_rf2
+    python benchmarks/run_benchmarks.py --release /tmp/synthetic_rf2 --out baseline.json
+    python benchmarks/run_benchmarks.py --release /tmp/synthetic_rf2 --baseline baseline.json  # exit code 1 on regressions
+"""
+import glob, io, json, os, platform, shutil, sys, tempfile, time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+from multiprocessing import get_context
+from optparse import OptionParser
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(BENCHMARKS_DIR, "..", "src"))
+sys.path.append(BENCHMARKS_DIR)
+
+ROOT_CONCEPT_CODE = 138875005
+# Relative increase of the wall time or the peak RSS of a stage that is reported as a regression
+DEFAULT_TOLERANCE = 0.25
+
+
+def find_release_files(release_dir, language="en"):
+    """Full Description file of a language and Full Relationship file of a release directory."""
+    def find(pattern):
+        paths = sorted(glob.glob(os.path.join(release_dir, "**", "Full", "Terminology", pattern), recursive=True))
+        if not paths:
+            raise FileNotFoundError("There is no {} file in {}".format(pattern, release_dir))
+        return paths[0]
+    return {"descriptions": find("sct2_Description_Full-{}_*.txt".format(language)),
+            "relationships": find("sct2_Relationship_Full_*.txt"), "language": language}
+
+
+# Each stage is a function that prepares its inputs and returns the function that is measured.
+# The measured function returns the number of rows (or codes, nodes...) of its output.
+
+def _descriptions(files):
+    from utils.tabular_read import active_terms_from_conceptRF2_file
+    return active_terms_from_conceptRF2_file(files["descriptions"], use_snapshot=False)
+
+
+def _top_level_codes(graph):
+    return graph.codes[graph.children(graph.index_of(ROOT_CONCEPT_CODE))]
+
+
+def stage_active_terms(files):
+    return lambda: len(_descriptions(files))
+
+
+def stage_active_relations(files):
+    from utils.tabular_read import get_active_relations
+    return lambda: len(get_active_relations(files["relationships"], use_snapshot=False))
+
+
+def stage_prepare_concepts(files):
+    from utils.tabular_read import prepare_concept_df
+    descriptions = _descriptions(files)
+    return lambda: len(prepare_concept_df(descriptions, files["language"]))
+
+
+def stage_load_ontology(files):
+    from utils.graph_read import load_ontology
+    return lambda: load_ontology(files["relationships"], use_snapshot=False).number_of_nodes()
+
+
+def stage_load_ontology_csr(files):
+    from utils.graph_read import load_ontology_csr
+    return lambda: len(load_ontology_csr(files["relationships"], use_snapshot=False))
+
+
+def stage_subtrees(files):
+    from utils.graph_read import load_ontology, load_ontology_csr, get_sucessors_from_list
+    roots = _top_level_codes(load_ontology_csr(files["relationships"], use_snapshot=False))
+    g = load_ontology(files["relationships"], use_snapshot=False)
+    return lambda: len(get_sucessors_from_list(g, roots))
+
+
+def stage_subtrees_csr(files):
+    from utils.graph_read import load_ontology_csr, get_sucessors_from_list
+    g = load_ontology_csr(files["relationships"], use_snapshot=False)
+    roots = _top_level_codes(g)
+    return lambda: len(get_sucessors_from_list(g, roots))
+
+
+def stage_gazetteer(files):
+    import gaznomed
+    out_dir = tempfile.mkdtemp()
+    out_path = os.path.join(out_dir, "gazetteer.tsv")
+    argv = ["-c", files["descriptions"], "-r", files["relationships"], "-l", files["language"], "--no_snapshot", "-o", out_path]
+
+    def run():
+        gaznomed.main(argv)
+        with open(out_path, encoding="utf-8") as f:
+            rows = sum(1 for _ in f) - 1
+        shutil.rmtree(out_dir)
+        return rows
+    return run
+
+
+STAGES = {
+    "active_terms_from_conceptRF2_file": stage_active_terms,
+    "get_active_relations": stage_active_relations,
+    "prepare_concept_df": stage_prepare_concepts,
+    "load_ontology": stage_load_ontology,
+    "load_ontology_csr": stage_load_ontology_csr,
+    "get_sucessors_from_list": stage_subtrees,
+    "get_sucessors_from_list_csr": stage_subtrees_csr,
+    "gazetteer": stage_gazetteer,
+}
+
+
+def run_stage(stage, files):
+    """Worker task: prepare the inputs of a stage, run it once and measure it."""
+    from utils.metrics import rss_mb, peak_rss_mb, reset_peak_rss
+    with redirect_stdout(io.StringIO()):
+        run = STAGES[stage](files)
+        # The peak of the stage does not include the inputs that were freed before it started
+        reset_peak_rss()
+        rss_before = rss_mb()
+        start = time.perf_counter()
+        rows = run()
+        wall = time.perf_counter() - start
+    peak = peak_rss_mb()
+    return {"wall_seconds": wall, "peak_rss_mb": peak, "rss_before_mb": rss_before, "rows": int(rows)}
+
+
+def benchmark(files, stages, repeat=3):
+    """
+    Run each stage repeat times, each time in a new process.
+
+    Returns:
+        dict: stage -> best wall time, its peak RSS and the RSS before the stage (MB), rows of its output and all the wall times
+    """
+    results = dict()
+    for stage in stages:
+        runs = []
+        for _ in range(repeat):
+            with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as pool:
+                runs.append(pool.submit(run_stage, stage, files).result())
+        best = min(runs, key=lambda run: run["wall_seconds"])
+        results[stage] = dict(best, peak_rss_mb=min(run["peak_rss_mb"] for run in runs),
+                              wall_seconds_all=[run["wall_seconds"] for run in runs])
+        print("{:<36} {:>9.3f} s {:>9.1f} MB peak RSS {:>10} rows".format(
+            stage, results[stage]["wall_seconds"], results[stage]["peak_rss_mb"], results[stage]["rows"]))
+    return results
+
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+    Compare the stages of two runs.
+
+    Returns:
+        list: (stage, metric, baseline value, value) of the metrics that increased more than the tolerance
+    """
+    regressions = []
+    for stage, result in results["stages"].items():
+        if stage not in baseline["stages"]:
+            continue
+        for metric in ["wall_seconds", "peak_rss_mb"]:
+            before, after = baseline["stages"][stage][metric], result[metric]
+            print("{:<36} {:<13} {:>10.3f} -> {:>10.3f} ({:+.1%})".format(stage, metric, before, after,
+                                                                      after / before - 1 if before else 0))
+            if before and after > before * (1 + tolerance):
+                regressions.append((stage, metric, before, after))
+    return regressions
+
+
+def main(argv=None):
+    parser = OptionParser(usage="%prog [--release DIR | --concepts N] [options]")
+    parser.add_option("--release", dest="release", default=None,
+                      help="Directory of a (synthetic) release. If it is not given, a synthetic release is generated")
+    parser.add_option("-n", "--concepts", dest="concepts", type="int", default=10000,
+                      help="Number of concepts of the generated release")
+    parser.add_option("--seed", dest="seed", type="int", default=0, help="Seed of the generated release")
+    parser.add_option("-l", "--language", dest="language", default="en", help="Language of the Description file")
+    parser.add_option("-s", "--stages", dest="stages", default=",".join(STAGES),
+                      help="Comma-separated stages to run: {}".format(", ".join(STAGES)))
+    parser.add_option("--repeat", dest="repeat", type="int", default=3, help="Runs of each stage (the fastest one is kept)")
+    parser.add_option("-o", "--out", dest="out", default=None, help="JSON file where the results are saved")
+    parser.add_option("-b", "--baseline", dest="baseline", default=None,
+                      help="JSON results of a previous run. The exit code is 1 if a stage is slower or uses more memory")
+    parser.add_option("--tolerance", dest="tolerance", type="float", default=DEFAULT_TOLERANCE,
+                      help="Relative increase reported as a regression. Defaults to {}".format(DEFAULT_TOLERANCE))
+    (options, args) = parser.parse_args(argv)
+    stages = options.stages.split(",")
+    unknown = [stage for stage in stages if stage not in STAGES]
+    if unknown:
+        parser.error("Unknown stages {}".format(", ".join(unknown)))
+
+    release_dir, generated = options.release, options.release is None
+    dataset = {"release": options.release}
+    if generated:
+        from synthetic_rf2 import generate_release
+        release_dir = tempfile.mkdtemp()
+        print("Generating a synthetic release of {} concepts".format(options.concepts))
+        dataset = {"concepts": options.concepts, "seed": options.seed,
+                   "rows": generate_release(release_dir, options.concepts, options.seed)["rows"]}
+    try:
+        files = find_release_files(release_dir, options.language)
+        dataset["sizes"] = {name: os.path.getsize(files[name]) for name in ["descriptions", "relationships"]}
+        import numpy, pandas
+        results = {"dataset": dataset, "repeat": options.repeat,
+                   "environment": {"python": platform.python_version(), "platform": platform.platform(),
+                                   "numpy": numpy.__version__, "pandas": pandas.__version__},
+                   "stages": benchmark(files, stages, options.repeat)}
+    finally:
+        if generated:
+            shutil.rmtree(release_dir)
+    if options.out is not None:
+        with open(options.out, "w") as f:
+            json.dump(results, f, indent=1)
+        print("Save results in {}".format(options.out))
+    if options.baseline is not None:
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("dataset", {}).get("sizes") != dataset["sizes"]:
+            print("WARNING: the baseline was measured on a different release")
+        regressions = compare(results, baseline, options.tolerance)
+        for stage, metric, before, after in regressions:
+            print("REGRESSION {} {}: {:.3f} -> {:.3f}".format(stage, metric, before, after))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
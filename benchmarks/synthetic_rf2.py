@@ -0,0 +1,370 @@
+"""
+Synthetic Snomed-CT RF2 release generator. Real releases are licensed, so the benchmarks run on
+releases generated by this script, that have the layout and the shape of a real one:
+
+    - Full Description files (english and spanish) and a Full Relationship file, in the
+      /Full/Terminology/ folder of a release archive (and optionally the Snapshot files)
+    - SCTIDs with partition identifiers and Verhoeff check digits
+    - A DAG under the root concept 138875005, with the real top-level concepts, a few concepts with
+      several parents and depths similar to the ones of the international edition
+    - History: components are created along the releases, re-released without changes, reparented,
+      inactivated (concepts keep their descriptions and lose their "is a" relationships), and FSNs
+      are replaced (sometimes the old FSN is left active)
+    - Finding site, procedure site and causative agent attribute relationships
+
+    python benchmarks/synthetic_rf2.py --concepts 100000 --out /tmp/synthetic_rf2
+"""
+import os, sys
+from optparse import OptionParser
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from utils.constants import FSN_TYPE_ID, SYNONYM_TYPE_ID, IS_A_TYPE_ID, SEMANTIC_TAGS_ES2EN
+
+ROOT_CONCEPT_CODE = 138875005
+MODEL_COMPONENT_CODE = 900000000000441003
+CONCEPT_MODEL_ATTRIBUTE_CODE = 410662002
+FINDING_SITE_TYPE_ID = 363698007
+PROCEDURE_SITE_TYPE_ID = 363704007
+CAUSATIVE_AGENT_TYPE_ID = 246075003
+MODULE_ID = 900000000000207008
+CASE_SIGNIFICANCE_ID = 900000000000448009
+INFERRED_RELATIONSHIP_ID = 900000000000011006
+EXISTENTIAL_MODIFIER_ID = 900000000000451002
+# Semi-annual releases, from the first one (January 2002) to the one of the generated release
+RELEASES = [int("{}{}".format(year, month)) for year in range(2002, 2024) for month in ("0131", "0731")]
+LANGUAGES = ["en", "es"]
+
+# Top-level concepts: code, name, semantic tags of their descendants and share of the concepts
+TOP_LEVEL = [
+    (404684003, "Clinical finding", ["disorder", "finding"], 0.30),
+    (71388002, "Procedure", ["procedure"], 0.15),
+    (123037004, "Body structure", ["body structure"], 0.10),
+    (105590001, "Substance", ["substance"], 0.07),
+    (373873005, "Pharmaceutical / biologic product", ["product"], 0.09),
+    (410607006, "Organism", ["organism"], 0.10),
+    (363787002, "Observable entity", ["observable entity"], 0.05),
+    (260787004, "Physical object", ["physical object"], 0.04),
+    (362981000, "Qualifier value", ["qualifier value"], 0.04),
+    (243796009, "Situation with explicit context", ["situation"], 0.03),
+    (272379006, "Event", ["event"], 0.02),
+    (123038009, "Specimen", ["specimen"], 0.01),
+]
+ATTRIBUTES = [(FINDING_SITE_TYPE_ID, "Finding site"), (PROCEDURE_SITE_TYPE_ID, "Procedure site"),
+              (CAUSATIVE_AGENT_TYPE_ID, "Causative agent")]
+# Spanish version of the english semantic tags
+SEMANTIC_TAGS_EN2ES = {english: spanish for spanish, english in sorted(SEMANTIC_TAGS_ES2EN.items(), reverse=True)}
+
+# Verhoeff tables
+VERHOEFF_D = np.array([[0, 1, 2, 3, 4, 5, 6, 7, 8, 9], [1, 2, 3, 4, 0, 6, 7, 8, 9, 5], [2, 3, 4, 0, 1, 7, 8, 9, 5, 6],
+                       [3, 4, 0, 1, 2, 8, 9, 5, 6, 7], [4, 0, 1, 2, 3, 9, 5, 6, 7, 8], [5, 9, 8, 7, 6, 0, 4, 3, 2, 1],
+                       [6, 5, 9, 8, 7, 1, 0, 4, 3, 2], [7, 6, 5, 9, 8, 2, 1, 0, 4, 3], [8, 7, 6, 5, 9, 3, 2, 1, 0, 4],
+                       [9, 8, 7, 6, 5, 4, 3, 2, 1, 0]])
+# Permutation of the digits in position i: the i-th power of the permutation of position 1
+VERHOEFF_P = np.array([list(range(10))] * 8)
+for i in range(1, 8):
+    VERHOEFF_P[i] = VERHOEFF_P[i - 1][[1, 5, 7, 6, 2, 8, 3, 0, 9, 4]]
+VERHOEFF_INV = np.array([0, 4, 3, 2, 1, 5, 6, 7, 8, 9])
+# Partition identifiers of the SCTIDs
+CONCEPT_PARTITION, DESCRIPTION_PARTITION, RELATIONSHIP_PARTITION = 0, 1, 2
+
+
+def sctids(items, partition):
+    """SCTIDs of the given item identifiers: item identifier, partition identifier and Verhoeff check digit."""
+    numbers = np.asarray(items, dtype=np.int64) * 100 + partition
+    check = np.zeros(len(numbers), dtype=np.int64)
+    # Digits from the right; the check digit takes the position 0
+    for position in range(18):
+        has_digit = numbers >= 10 ** position
+        digits = numbers // 10 ** position % 10
+        check = np.where(has_digit, VERHOEFF_D[check, VERHOEFF_P[(position + 1) % 8, digits]], check)
+    return numbers * 10 + VERHOEFF_INV[check]
+
+
+def vocabulary(rng, size, syllables):
+    """Pseudo-words built from the syllables of a language."""
+    lengths = rng.integers(2, 5, size)
+    words = [syllables[i] for i in rng.integers(0, len(syllables), int(lengths.sum()))]
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    return np.array(sorted({"".join(words[offsets[i]:offsets[i + 1]]) for i in range(size)}), dtype=object)
+
+
+def terms(rng, words, n):
+    """n terms of 1 to 4 words."""
+    output = words[rng.integers(0, len(words), n)]
+    for extra in range(3):
+        longer = rng.random(n) < 0.6 / (extra + 1)
+        output[longer] = output[longer] + " " + words[rng.integers(0, len(words), int(longer.sum()))]
+    return output
+
+
+def later_release(rng, after, until=None):
+    """Random release index in (after, until) for each component (until defaults to the number of releases)."""
+    until = np.full(len(after), len(RELEASES)) if until is None else until
+    return after + 1 + (rng.random(len(after)) * (until - after - 1)).astype(np.int64)
+
+
+def add_history(rng, rows, until, rate):
+    """
+    Re-release rows without changes (as a change of a column that is not read, e.g. the module):
+    each row gets a Poisson number of copies with later releases, before the release "until" in
+    which the component changes.
+    """
+    room = until - rows.release.values - 1
+    copies = np.minimum(rng.poisson(rate, len(rows)), np.maximum(room, 0))
+    repeated = rows.iloc[np.repeat(np.arange(len(rows)), copies)].copy()
+    repeated["release"] = later_release(rng, repeated.release.values, np.repeat(until, copies))
+    return pd.concat([rows, repeated], ignore_index=True).drop_duplicates(subset=["id", "release"])
+
+
+class IdGenerator:
+    """Consecutive item identifiers of a partition."""
+
+    def __init__(self, partition, first_item):
+        self.partition = partition
+        self.next_item = first_item
+
+    def __call__(self, n):
+        items = self.next_item + np.arange(n, dtype=np.int64)
+        self.next_item += n
+        return sctids(items, self.partition)
+
+
+def generate_hierarchy(rng, n_concepts, extra_parent_rate=0.25):
+    """
+    Concepts and "is a" edges of the hierarchy. Concepts of each top-level branch are created in order;
+    each one gets a parent chosen uniformly among the previous concepts of its branch (a random recursive
+    tree, with logarithmic depth) and sometimes a second parent. Parents always precede their children,
+    so the hierarchy has no cycles.
+
+    Returns:
+        (pd.DataFrame, pd.DataFrame): Concepts (code, branch, position in the branch, release, semantic_tag)
+                                      and edges (source, destination)
+    """
+    weights = np.array([top[3] for top in TOP_LEVEL])
+    branch = rng.choice(len(TOP_LEVEL), n_concepts, p=weights / weights.sum())
+    codes = IdGenerator(CONCEPT_PARTITION, 10000000)(n_concepts)
+    concepts, sources, destinations = [], [], []
+    for b, (top_code, _, tags, _) in enumerate(TOP_LEVEL):
+        members = codes[branch == b]
+        m = len(members)
+        if m == 0:
+            continue
+        position = np.arange(m)
+        releases = np.sort(rng.integers(0, len(RELEASES) - 1, m))
+        first_parent = (rng.random(m) * position).astype(np.int64)
+        sources.append(members)
+        destinations.append(np.where(position == 0, top_code, members[first_parent]))
+        second_parent = (rng.random(m) * position).astype(np.int64)
+        extra = (rng.random(m) < extra_parent_rate) & (position > 1) & (second_parent != first_parent)
+        sources.append(members[extra])
+        destinations.append(members[second_parent[extra]])
+        concepts.append(pd.DataFrame({"code": members, "branch": b, "position": position, "release": releases,
+                                      "semantic_tag": np.array(tags, dtype=object)[rng.integers(0, len(tags), m)]}))
+    concepts = pd.concat(concepts, ignore_index=True)
+    edges = pd.DataFrame({"source": np.concatenate(sources), "destination": np.concatenate(destinations)})
+    return concepts, edges
+
+
+def generate_relationships(rng, concepts, edges, history_rate, reparent_rate=0.1, inactivation_rate=0.03):
+    """
+    Rows of the Relationship file: the "is a" edges with reparentings and inactivated concepts,
+    the attribute relationships, and the metadata concepts of the attribute types.
+
+    Returns:
+        (pd.DataFrame, np.ndarray): Relationship rows and codes of the inactivated concepts
+    """
+    new_ids = IdGenerator(RELATIONSHIP_PARTITION, 10000000)
+    release_of = pd.Series(concepts.release.values, index=concepts.code.values)
+    metadata_rows = [(top[0], ROOT_CONCEPT_CODE) for top in TOP_LEVEL] + [(MODEL_COMPONENT_CODE, ROOT_CONCEPT_CODE),
+        (CONCEPT_MODEL_ATTRIBUTE_CODE, MODEL_COMPONENT_CODE)] + [(code, CONCEPT_MODEL_ATTRIBUTE_CODE) for code, _ in ATTRIBUTES]
+    metadata = pd.DataFrame(metadata_rows, columns=["source", "destination"])
+    rels = pd.concat([metadata.assign(release=0), edges.assign(release=release_of[edges.source.values].values)], ignore_index=True)
+    rels = rels.assign(id=new_ids(len(rels)), active=1, typeId=IS_A_TYPE_ID, group=0)
+
+    # Inactivated concepts: leaves of the hierarchy lose their "is a" relationships
+    is_leaf = ~concepts.code.isin(edges.destination).values
+    inactivated = concepts[is_leaf & (rng.random(len(concepts)) < inactivation_rate) & (concepts.release.values < len(RELEASES) - 1)]
+    inactivation_release = pd.Series(later_release(rng, inactivated.release.values), index=inactivated.code.values)
+    # Reparentings: the relationship is inactivated and a relationship with another previous concept of the
+    # branch is created (so the hierarchy stays acyclic)
+    position_of = pd.Series(concepts.position.values, index=concepts.code.values)
+    candidates = rels[(rels.release.values < len(RELEASES) - 1) & ~rels.source.isin(inactivated.code).values
+                      & rels.source.isin(concepts.code).values]
+    candidates = candidates[position_of[candidates.source.values].values > 0]
+    reparented = candidates[rng.random(len(candidates)) < reparent_rate]
+    reparent_release = later_release(rng, reparented.release.values)
+    # Concepts are sorted by branch and position, so the concept of a position of a branch is at branch_start + position
+    branch_start = pd.Series(np.flatnonzero(concepts.position.values == 0), index=concepts.branch.values[concepts.position.values == 0])
+    branch_of = pd.Series(concepts.branch.values, index=concepts.code.values)
+    new_parent_position = (rng.random(len(reparented)) * position_of[reparented.source.values].values).astype(np.int64)
+    new_parents = concepts.code.values[branch_start[branch_of[reparented.source.values].values].values + new_parent_position]
+    new_rels = reparented.assign(id=new_ids(len(reparented)), destination=new_parents, release=reparent_release)
+
+    # Release in which each "is a" relationship changes (for the re-released copies)
+    until = np.full(len(rels), len(RELEASES))
+    until[rels.index.get_indexer(reparented.index)] = reparent_release
+    dying = rels.source.isin(inactivation_release.index).values
+    until[dying] = inactivation_release[rels.source.values[dying]].values
+    isa = add_history(rng, rels, until, history_rate)
+    inactive = pd.concat([reparented.assign(release=reparent_release, active=0),
+                          rels[dying].assign(release=until[dying], active=0)], ignore_index=True)
+
+    # Attribute relationships (relationship group 1)
+    attribute_rels = []
+    for type_id, source_tags, value_tags, rate in [
+            (FINDING_SITE_TYPE_ID, ["disorder", "finding"], ["body structure"], 0.6),
+            (PROCEDURE_SITE_TYPE_ID, ["procedure"], ["body structure"], 0.5),
+            (CAUSATIVE_AGENT_TYPE_ID, ["disorder"], ["substance", "organism"], 0.2)]:
+        sources = concepts[concepts.semantic_tag.isin(source_tags).values & (rng.random(len(concepts)) < rate)]
+        values = concepts.code.values[concepts.semantic_tag.isin(value_tags).values]
+        if len(values) == 0:
+            continue
+        attribute_rels.append(pd.DataFrame({"source": sources.code.values, "destination": rng.choice(values, len(sources)),
+                                            "release": sources.release.values, "typeId": type_id}))
+    attribute_rels = pd.concat(attribute_rels, ignore_index=True)
+    attribute_rels = attribute_rels.assign(id=new_ids(len(attribute_rels)), active=1, group=1)
+    attribute_rels = add_history(rng, attribute_rels, np.full(len(attribute_rels), len(RELEASES)), history_rate)
+    rows = pd.concat([isa, inactive, new_rels, attribute_rels], ignore_index=True)
+    return rows, inactivated.code.values
+
+
+def generate_descriptions(rng, concepts, history_rate, synonyms=(1, 4), fsn_change_rate=0.05, inactivation_rate=0.08):
+    """
+    Rows of the Description files of each language: one FSN with the semantic tag and some synonyms per
+    concept, with replaced FSNs (20% of the old FSNs are left active) and inactivated synonyms.
+
+    Returns:
+        dict: language -> pd.DataFrame with the description rows
+    """
+    new_ids = IdGenerator(DESCRIPTION_PARTITION, 10000000)
+    syllables = {"en": ["ac", "an", "ar", "bo", "car", "di", "en", "fer", "gas", "hy", "in", "lo", "ma", "neu", "os",
+                        "per", "ra", "sis", "tis", "ur", "ven", "xy"],
+                 "es": ["a", "ca", "ción", "de", "do", "es", "fa", "ga", "hi", "in", "lo", "mé", "na", "no", "pa",
+                        "que", "ra", "sa", "ti", "to", "ur", "za"]}
+    fixed = [(ROOT_CONCEPT_CODE, "SNOMED CT Concept", "SNOMED RT+CTV3"),
+             (MODEL_COMPONENT_CODE, "SNOMED CT Model Component", "core metadata concept"),
+             (CONCEPT_MODEL_ATTRIBUTE_CODE, "Concept model attribute", "attribute")] + \
+        [(code, name, "attribute") for code, name in ATTRIBUTES] + \
+        [(code, name, tags[0]) for code, name, tags, _ in TOP_LEVEL]
+    output = dict()
+    for language in LANGUAGES:
+        words = vocabulary(rng, 5000, syllables[language])
+        translate = (lambda tag: tag) if language == "en" else (lambda tag: SEMANTIC_TAGS_EN2ES[tag])
+        tags = concepts.semantic_tag.map(translate).values
+        fsn = pd.DataFrame({"conceptId": concepts.code.values, "release": concepts.release.values, "typeId": FSN_TYPE_ID,
+                            "term": terms(rng, words, len(concepts)) + " (" + tags + ")"})
+        fsn = pd.concat([fsn, pd.DataFrame({"conceptId": [code for code, _, _ in fixed], "release": 0, "typeId": FSN_TYPE_ID,
+                                            "term": ["{} ({})".format(name, translate(tag)) for _, name, tag in fixed]})],
+                        ignore_index=True)
+        counts = rng.integers(synonyms[0], synonyms[1] + 1, len(concepts))
+        synonym_concepts = concepts.iloc[np.repeat(np.arange(len(concepts)), counts)]
+        syn = pd.DataFrame({"conceptId": synonym_concepts.code.values, "release": synonym_concepts.release.values,
+                            "typeId": SYNONYM_TYPE_ID, "term": terms(rng, words, len(synonym_concepts))})
+        rows = pd.concat([fsn, syn], ignore_index=True).assign(active=1)
+        rows["id"] = new_ids(len(rows))
+        last = len(RELEASES) - 1
+        # Replaced FSNs
+        is_fsn = rows.typeId.values == FSN_TYPE_ID
+        replaced = rows[is_fsn & (rows.release.values < last) & (rng.random(len(rows)) < fsn_change_rate)]
+        replace_release = later_release(rng, replaced.release.values)
+        new_fsn = replaced.assign(id=new_ids(len(replaced)), release=replace_release,
+                                  term="new " + replaced.term.values)
+        left_active = rng.random(len(replaced)) < 0.2
+        old_fsn = replaced[~left_active].assign(release=replace_release[~left_active], active=0)
+        # Inactivated synonyms
+        removed = rows[~is_fsn & (rows.release.values < last) & (rng.random(len(rows)) < inactivation_rate)]
+        remove_release = later_release(rng, removed.release.values)
+        until = np.full(len(rows), len(RELEASES))
+        until[rows.index.get_indexer(old_fsn.index)] = old_fsn.release.values
+        until[rows.index.get_indexer(removed.index)] = remove_release
+        rows = pd.concat([add_history(rng, rows, until, history_rate), new_fsn, old_fsn,
+                          removed.assign(release=remove_release, active=0)], ignore_index=True)
+        output[language] = rows
+    return output
+
+
+def write_rf2(rows, path, columns):
+    """Write RF2 rows sorted by id and effectiveTime, with CRLF line endings."""
+    rows = rows.sort_values(by=["id", "effectiveTime"], kind="stable")
+    # Joining the string columns is several times faster than DataFrame.to_csv for this kind of table
+    values = [list(map(str, rows[column].tolist())) for column in columns]
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        f.write("\t".join(columns) + "\r\n")
+        f.writelines(line + "\r\n" for line in map("\t".join, zip(*values)))
+
+
+def generate_release(out_dir, n_concepts=10000, seed=0, history_rate=0.5, snapshot=False):
+    """
+    Generate a synthetic release inside out_dir.
+
+    Args:
+        out_dir (str): Output directory
+        n_concepts (int, optional): Number of concepts (besides the top-level and metadata concepts)
+        seed (int, optional): Seed of the random generator. The same seed gives the same release.
+        history_rate (float, optional): Mean number of unchanged re-releases of each component
+        snapshot (bool, optional): Also write the Snapshot files
+
+    Returns:
+        dict: Paths of the Full files ("descriptions": language -> path, "relationships": path) and row counts
+    """
+    rng = np.random.default_rng(seed)
+    date = RELEASES[-1]
+    release_dir = os.path.join(out_dir, "SnomedCT_SyntheticRF2_PRODUCTION_{}T120000Z".format(date))
+    concepts, edges = generate_hierarchy(rng, n_concepts)
+    relationships, inactivated = generate_relationships(rng, concepts, edges, history_rate)
+    descriptions = generate_descriptions(rng, concepts, history_rate)
+    relationships = relationships.assign(effectiveTime=np.array(RELEASES)[relationships.release.values], moduleId=MODULE_ID,
+                                         sourceId=relationships.source, destinationId=relationships.destination,
+                                         relationshipGroup=relationships.group, characteristicTypeId=INFERRED_RELATIONSHIP_ID,
+                                         modifierId=EXISTENTIAL_MODIFIER_ID)
+    files = {"descriptions": dict(), "relationships": None,
+             "rows": {"concepts": len(concepts), "inactivated_concepts": len(inactivated), "relationships": len(relationships)}}
+    for release_type in ["Full", "Snapshot"] if snapshot else ["Full"]:
+        terminology_dir = os.path.join(release_dir, release_type, "Terminology")
+        os.makedirs(terminology_dir, exist_ok=True)
+        for language, rows in descriptions.items():
+            rows = rows.assign(effectiveTime=np.array(RELEASES)[rows.release.values], moduleId=MODULE_ID,
+                               languageCode=language, caseSignificanceId=CASE_SIGNIFICANCE_ID)
+            if release_type == "Snapshot":
+                rows = rows.sort_values(by="effectiveTime", kind="stable").drop_duplicates(subset="id", keep="last")
+            path = os.path.join(terminology_dir, "sct2_Description_{}-{}_INT_{}.txt".format(release_type, language, date))
+            write_rf2(rows, path, ["id", "effectiveTime", "active", "moduleId", "conceptId", "languageCode", "typeId",
+                                   "term", "caseSignificanceId"])
+            if release_type == "Full":
+                files["descriptions"][language] = path
+                files["rows"]["descriptions_" + language] = len(rows)
+        rows = relationships
+        if release_type == "Snapshot":
+            rows = rows.sort_values(by="effectiveTime", kind="stable").drop_duplicates(subset="id", keep="last")
+        path = os.path.join(terminology_dir, "sct2_Relationship_{}_INT_{}.txt".format(release_type, date))
+        write_rf2(rows, path, ["id", "effectiveTime", "active", "moduleId", "sourceId", "destinationId",
+                               "relationshipGroup", "typeId", "characteristicTypeId", "modifierId"])
+        if release_type == "Full":
+            files["relationships"] = path
+    return files
+
+
+def main(argv=None):
+    parser = OptionParser(usage="%prog --concepts N --out DIR [options]")
+    parser.add_option("-n", "--concepts", dest="concepts", type="int", default=10000,
+                      help="Number of concepts of the release (e.g. 10000 to 1000000)")
+    parser.add_option("-o", "--out", dest="out", help="Output directory")
+    parser.add_option("--seed", dest="seed", type="int", default=0, help="Seed of the random generator")
+    parser.add_option("--history", dest="history_rate", type="float", default=0.5,
+                      help="Mean number of unchanged re-releases of each component (depth of the history of the Full files)")
+    parser.add_option("--snapshot", dest="snapshot", action="store_true", default=False,
+                      help="Also write the Snapshot files of the release")
+    (options, args) = parser.parse_args(argv)
+    if options.out is None:
+        parser.error("Provide the output directory")
+    files = generate_release(options.out, options.concepts, options.seed, options.history_rate, options.snapshot)
+    for language, path in files["descriptions"].items():
+        print("Descriptions ({}): {}".format(language, path))
+    print("Relationships: {}".format(files["relationships"]))
+    print(files["rows"])
+
+
+if __name__ == "__main__":
+    sys.exit(main())
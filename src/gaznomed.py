@@ -1,13 +1,12 @@
-import csv, os, sys, pickle
-import pandas as pd
-
-# Include system path
-general_path = os.getcwd().split("gaznomed")[0]+"gaznomed/"
-sys.path.append(general_path+'src/')
-from utils.tabular_read import active_terms_from_conceptRF2_file, get_active_relations, \
-                     list_of_active_codes_from_relations, filter_concepts_by_semantic_tag, \
-                         prepare_concept_df
-from utils.graph_read import load_ontology, get_sucessors_from_list
+import os, sys
+
+# Include the src directory in the system path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+# Only lightweight modules are imported here: pandas, NumPy and networkx are imported when a stage needs
+# them (see build_gazetteer and query_main), so --help and queries over a query index start fast
+from utils.constants import OUTPUT_FORMATS, GAZETTEER_COLUMNS
+from utils.normalization import check_steps, NORMALIZATION_STEPS
+from utils.metrics import MetricsRecorder, stage
 from optparse import OptionParser
 
 
@@ -16,18 +15,166 @@ def get_comma_separated_args(option, opt, value, parser):
     setattr(parser.values, option.dest, value.split(','))
 
 
+def serve_main(argv):
+    """`gaznomed serve`: load a release once and answer queries over HTTP (see server.py)"""
+    from terminology import Terminology
+    from server import serve
+    parser = OptionParser(usage="%prog serve -c CONCEPT_FILE -r RELATION_FILE -l LANGUAGE [options]")
+    parser.add_option("-c", "--concept_file", dest = "concept_paths", type=str, action="callback", callback=get_comma_separated_args, \
+        help = "Path to the RF2 snomed-ct concept file. Several files can be given separated by comma", default=None)
+    parser.add_option("-r", "--relation_file", dest = "relation_paths", type=str, action="callback", callback=get_comma_separated_args, \
+        help = "Path to the RF2 snomed-ct relation file. Several files can be given separated by comma", default=None)
+    parser.add_option("-l", "--language", dest = "languages", type=str, action="callback", callback=get_comma_separated_args, \
+        help = "Language of each concept file ('en' or 'es')", default=None)
+    parser.add_option("--host", dest="host", default="127.0.0.1", \
+        help="Address the server listens on. Default value only accepts connections from the local machine")
+    parser.add_option("--port", dest="port", type="int", default=8000, help="Port the server listens on")
+    parser.add_option("-w", "--workers", dest="workers", type="int", default=1, \
+        help="Number of processes used to parse the RF2 files")
+    parser.add_option("--reader", dest="reader", type="choice", choices=["mmap", "pandas"], default="mmap", \
+        help="RF2 reader used when workers is 1: 'mmap' or 'pandas'")
+    parser.add_option("--cache_dir", "--cache-dir", dest="cache_dir", default=None, \
+        help="Directory where the parsed RF2 files are cached")
+    parser.add_option("--no_snapshot", dest="use_snapshot", action="store_false", default=True, \
+        help="Always read the given RF2 files, even if the Snapshot files of the same release are present")
+    (options, args) = parser.parse_args(argv)
+
+    if options.concept_paths is None or options.relation_paths is None:
+        parser.error("Provide the concept and relation files")
+    if options.languages is not None and len(options.languages) == 1:
+        options.languages = options.languages * len(options.concept_paths)
+    if options.languages is None or len(options.languages) != len(options.concept_paths):
+        parser.error("Provide one language per concept file")
+    terminology = Terminology.load(options.concept_paths, options.languages, options.relation_paths,
+                                   cache_dir=options.cache_dir, use_snapshot=options.use_snapshot,
+                                   workers=options.workers, reader=options.reader)
+    serve(terminology, options.host, options.port)
+
+
+def read_subtree_codes(path):
+    """Read the codes of a subtrees file: one code per line (the first field of the line), '#' comments and blank lines are skipped"""
+    codes = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            fields = line.split("#", 1)[0].replace(",", " ").split()
+            if fields:
+                if not fields[0].isdigit():
+                    raise ValueError("Invalid code {} in the subtrees file {}".format(fields[0], path))
+                codes.append(fields[0])
+    return codes
+
+
+def query_main(argv):
+    """`gaznomed query`: semantic tag and subtree queries over a query index (see utils.query_index), without pandas"""
+    from utils.query_index import QueryIndex, QUERY_FORMATS
+    parser = OptionParser(usage="%prog query -q QUERY_INDEX [-s SEMANTIC_TAGS] [-t SUBTREES] [options]")
+    parser.add_option("-q", "--query_index", "--query-index", dest="query_index", default=None, \
+        help="Directory of a query index saved by a gazetteer run with --query_index")
+    parser.add_option("-s", "--semantic_tags", dest="semantic_tag_list", type=str, action="callback", callback=get_comma_separated_args, \
+        help="Comma-separated semantic tags. Default value selects all semantic tags, 'None' selects none", default="all")
+    parser.add_option("-t", "--subtrees", dest="subtrees_code_list", type=str, action="callback", callback=get_comma_separated_args, \
+        help="Comma-separated codes from which the subtrees are selected", default=None)
+    parser.add_option("-o", "--out", dest="out", default=None, help="Output path. Rows are written to the standard output if it is not given")
+    parser.add_option("-f", "--format", dest="output_format", type="choice", choices=QUERY_FORMATS, default="tsv", \
+        help="Format of the output: 'tsv' or 'jsonl'")
+    (options, args) = parser.parse_args(argv)
+
+    if options.query_index is None:
+        parser.error("Provide the query index directory")
+    index = QueryIndex.load(options.query_index)
+    rows = index.rows(options.semantic_tag_list, options.subtrees_code_list)
+    if options.out is None:
+        index.write(rows, sys.stdout, options.output_format)
+        return
+    with open(options.out, "w", encoding="utf-8", newline="") as f:
+        written = index.write(rows, f, options.output_format)
+    print("Save {} rows in {}".format(written, options.out))
+
+
+def load_graph_stage(load, name="build_graph"):
+    """Load a hierarchy structure (see terminology.load_hierarchy) in its own stage"""
+    with stage(name) as record:
+        g = load()
+        record["codes"] = len(g)
+    return g
+
+
 def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) and argv[0] == "serve":
+        return serve_main(argv[1:])
+    if len(argv) and argv[0] == "query":
+        return query_main(argv[1:])
     parser = OptionParser()
-    parser.add_option("-c", "--concept_file", dest = "concept_path", help = "Path to the RF2 snomed-ct concept file", default=None)
-    parser.add_option("-r", "--relation_file", dest = "relation_path", help = "Path to the RF2 snomed-ct relation file", default=None)
-    parser.add_option("-l", "--language", dest = "language", help = "Language of the concept file. It can be 'en' or 'es'.", default=None)
+    parser.add_option("-c", "--concept_file", dest = "concept_paths", type=str, action="callback", callback=get_comma_separated_args, \
+        help = "Path to the RF2 snomed-ct concept file. Several files (for example of different languages or extensions) \
+            can be given separated by comma (without space)", default=None)
+    parser.add_option("-r", "--relation_file", dest = "relation_paths", type=str, action="callback", callback=get_comma_separated_args, \
+        help = "Path to the RF2 snomed-ct relation file. Several files (edition and extensions) can be given separated by comma", default=None)
+    parser.add_option("-l", "--language", dest = "languages", type=str, action="callback", callback=get_comma_separated_args, \
+        help = "Language of the concept file. It can be 'en' or 'es'. If several concept files are given, provide \
+            one language per file separated by comma", default=None)
     parser.add_option("-s", "--semantic_tags", dest="semantic_tag_list", type=str, action="callback", callback=get_comma_separated_args, \
         help="Provide list of snomed-ct semantic tags separated by comma (without space) you want to select from sct terminology. Default \
             value selects all semantic tags. If you don't want to select any semantic tag, write 'None'", default="all")
     parser.add_option("-t", "--subtrees", dest="subtrees_code_list", type=str, action="callback", callback=get_comma_separated_args, \
         help="Provide a comma-separated list of snomed-ct codes (without spaces) from which you want to get the subtrees", default=None)
+    parser.add_option("--subtrees_file", "--subtrees-file", dest="subtrees_file", default=None, \
+        help="File with the codes from which the subtrees are selected, one per line (for batches of thousands of roots). \
+            They are added to the codes of --subtrees")
+    parser.add_option("--subtree_roots", "--subtree-roots", dest="subtree_roots", action="store_true", default=False, \
+        help="Add a subtree_root column with the subtree codes (of --subtrees and --subtrees_file) each concept descends \
+            from, separated by comma. All the subtrees are labeled in a single pass over the hierarchy")
+    parser.add_option("--attribute", dest="attribute_constraints", action="append", default=None, \
+        help="Attribute constraint TYPE_ID=CODE[,CODE...]: only keep the concepts with an active relationship of type TYPE_ID \
+            (e.g. 363698007, finding site) whose value is in the subtrees of the codes. It can be repeated (all the \
+            constraints must be satisfied)")
+    parser.add_option("-g", "--graph_backend", dest="graph_backend", type="choice", choices=["csr", "networkx"], default="csr", \
+        help="Structure used to store the snomed-ct hierarchy when computing subtrees: 'csr' (compact integer arrays) or 'networkx'")
+    parser.add_option("-i", "--subsumption_index", dest="subsumption_index", default=None, \
+        help="Path to a .npz subsumption index of the release. It is computed and saved the first time it is used, \
+            and loaded instead of the relation file afterwards")
+    parser.add_option("-w", "--workers", dest="workers", type="int", default=1, \
+        help="Number of processes used to parse the RF2 files. Default value (1) parses them serially")
+    parser.add_option("--reader", dest="reader", type="choice", choices=["mmap", "pandas"], default="mmap", \
+        help="RF2 reader used when workers is 1: 'mmap' (memory-mapped, only decodes the needed columns) or 'pandas'")
+    parser.add_option("--cache_dir", "--cache-dir", dest="cache_dir", default=None, \
+        help="Directory where the parsed RF2 files are cached. Repeated runs against the same release load them from there")
+    parser.add_option("--clear_cache", "--clear-cache", dest="clear_cache", action="store_true", default=False, \
+        help="Remove the cache directory before running")
+    parser.add_option("--no_snapshot", dest="use_snapshot", action="store_false", default=True, \
+        help="Always read the given RF2 files, even if the Snapshot files of the same release are present")
     parser.add_option("-o", "--out", dest="out", help="Absolute output path where you want to save the gazetteer")
-    #parser.add_option("-p", "--preprocessing", dest = "preprocessing_args", type=str, action="callback", callback=get_comma_separated_args, help="Preprocessing to be done on text and terminologies")
+    parser.add_option("-f", "--format", dest="output_format", type="choice", choices=OUTPUT_FORMATS, default="tsv", \
+        help="Format of the output: 'tsv', 'tsv.gz' (gzip compressed TSV), 'parquet' (requires pyarrow) or 'jsonl'")
+    parser.add_option("-a", "--automaton", dest="automaton", default=None, \
+        help="Directory where a precompiled matching automaton over the normalized terms of the gazetteer is saved \
+            (see utils.automaton.TermAutomaton)")
+    parser.add_option("--hierarchy_columns", dest="hierarchy_columns", action="store_true", default=False, \
+        help="Add the depth, top-level branches and direct parents of each concept to the gazetteer (computed in a single \
+            pass over the hierarchy)")
+    parser.add_option("--ancestors", dest="ancestors", action="store_true", default=False, \
+        help="Save the ancestor closure of the concepts of the gazetteer (one row per code and ancestor) next to the output \
+            (OUTPUTFILE.ancestors.tsv)")
+    parser.add_option("-q", "--query_index", "--query-index", dest="query_index", default=None, \
+        help="Directory where a query index of the release (all the active concepts and the hierarchy, in NumPy arrays) \
+            is saved. `gaznomed.py query` answers semantic tag and subtree queries from it without loading pandas")
+    parser.add_option("-u", "--update_from", dest="update_from", default=None, \
+        help="Output path of a gazetteer built from a previous release (with --cache_dir). Only the concepts that changed \
+            in the new release are recomputed, and a change report is saved next to the output")
+    parser.add_option("--split_languages", dest="split_languages", action="store_true", default=False, \
+        help="Save one gazetteer per language (the language code is added to the output file name) instead of a combined one")
+    parser.add_option("-p", "--preprocessing", dest = "preprocessing_args", type=str, action="callback", callback=get_comma_separated_args, \
+        help="Comma-separated chain of normalization steps applied to the terms: {}. The normalized gazetteer is saved \
+            next to the output (OUTPUTFILE.normalized.tsv) and the automaton uses the same normalization".format(
+            ",".join(NORMALIZATION_STEPS)), default=None)
+    
+    parser.add_option("--metrics", dest="metrics", default=None, \
+        help="JSON file where the wall time, CPU time, peak memory and row count of each stage of the run are saved")
+    parser.add_option("--profile_dir", "--profile-dir", dest="profile_dir", default=None, \
+        help="Directory where each stage is profiled with cProfile (STAGE.prof files, e.g. for snakeviz or pstats)")
+    parser.add_option("--trace_memory", "--trace-memory", dest="trace_memory", action="store_true", default=False, \
+        help="Trace the peak of the Python allocations of each stage with tracemalloc (slower)")
     
     (options, args) = parser.parse_args(argv)
     print("Parameters selected for the attribute 'semantic_tags'")
@@ -35,50 +182,266 @@ def main(argv=None):
     print("Parameters selected for the attribute 'subtrees'")
     print(options.subtrees_code_list)
     
-    # Rear active terms from the concepts Snomed-CT RF2 File
-    concepts = active_terms_from_conceptRF2_file(options.concept_path)
-    # Prepare a dataframe with the correct shape:
-    concepts_df_prepared = prepare_concept_df(concepts,options.language)
-
-
-    # Load a dictionary that contains the parent codes of each Snomed-CT code. If the code has no parents, means that that code is deprecated. 
-    active_rels = get_active_relations(options.relation_path)
-    # From that active_rels variable, obtain the list of active codes.
-    active_codes = list_of_active_codes_from_relations(active_rels)
-    # Filter the concept_df, only maintaining the active_codes
-    concepts_df_prepared = concepts_df_prepared[concepts_df_prepared.code.isin(active_codes)].reset_index(drop=True).copy()
-
-    # FILTER SEMANTIC TAGS 
-    if options.semantic_tag_list == "all" or options.semantic_tag_list == ["all"]:
-        filtered_concepts_df = concepts_df_prepared.copy()
-    elif options.semantic_tag_list == ["None"]: 
-        filtered_concepts_df = pd.DataFrame(columns=["code","language","term","semantic_tag","mainterm"])
+    if options.concept_paths is None or options.relation_paths is None:
+        parser.error("Provide the concept and relation files")
+    if options.languages is not None and len(options.languages) == 1:
+        options.languages = options.languages * len(options.concept_paths)
+    if options.languages is None or len(options.languages) != len(options.concept_paths):
+        parser.error("Provide one language per concept file")
+    if options.subsumption_index is not None and options.graph_backend == "networkx":
+        parser.error("The subsumption index (-i) can not be used with the networkx backend (-g networkx)")
+    if options.preprocessing_args is not None:
+        try:
+            check_steps(options.preprocessing_args)
+        except ValueError as error:
+            parser.error(str(error))
+    if options.attribute_constraints is not None:
+        from utils.attributes import parse_attribute_constraint
+        if options.update_from is not None:
+            parser.error("Attribute constraints can not be used in incremental updates (--update_from)")
+        try:
+            options.attribute_constraints = [parse_attribute_constraint(constraint) for constraint in options.attribute_constraints]
+        except ValueError as error:
+            parser.error(str(error))
+    if options.subtrees_file is not None:
+        try:
+            options.subtrees_code_list = (options.subtrees_code_list or []) + read_subtree_codes(options.subtrees_file)
+        except (OSError, ValueError) as error:
+            parser.error(str(error))
+        print("{} subtree codes".format(len(options.subtrees_code_list)))
+    if options.subtree_roots and not options.subtrees_code_list:
+        parser.error("The subtree_root column requires subtree codes (--subtrees or --subtrees_file)")
+    if options.query_index is not None and options.update_from is not None:
+        parser.error("The query index can not be saved in incremental updates (--update_from)")
+    if options.update_from is not None:
+        # The update only recomputes the concepts that changed: it must read the same kind of files and make the same selection
+        from utils.incremental import load_run_state
+        try:
+            previous_state = load_run_state(options.update_from)
+        except (OSError, ValueError) as error:
+            parser.error(str(error))
+        previous_languages = [f["language"] for f in previous_state["concept_files"]]
+        if previous_languages != options.languages:
+            parser.error("The previous run read {} concept files with the languages {}, and this one {} with {}. Build the "
+                         "gazetteer again without --update_from".format(len(previous_languages), ",".join(previous_languages),
+                                                                          len(options.languages), ",".join(options.languages)))
+        if previous_state["semantic_tags"] != options.semantic_tag_list or previous_state["subtrees"] != options.subtrees_code_list:
+            parser.error("The semantic tags or subtrees differ from the ones of the previous run. Build the gazetteer again "
+                         "without --update_from")
+    if options.metrics is None and options.profile_dir is None and not options.trace_memory:
+        build_gazetteer(options)
+        return
+    recorder = MetricsRecorder(options.profile_dir, options.trace_memory)
+    with recorder.activate():
+        build_gazetteer(options)
+    print(recorder.summary())
+    if options.metrics is not None:
+        recorder.save(options.metrics, argv=argv)
+        print("Save metrics in {}".format(options.metrics))
+
+
+def build_gazetteer(options):
+    """Build the gazetteer of the parsed command line options (see main)"""
+    import numpy as np
+    from utils.tabular_read import list_of_active_codes_from_relations, isin_sorted, prepare_concept_df, concat_concept_dfs
+    from utils.cache import clear_cache, cache_entry
+    from utils.incremental import save_run_state, load_run_state, read_gazetteer, changed_description_concepts, \
+        changed_hierarchy_concepts, apply_changes, previous_descriptions, previous_isa_edges, CHANGES_SUFFIX
+    from utils.writer import write_gazetteer, write_table, to_output_types, output_path_with_suffix, DEDUP_COLUMNS
+    from utils.hierarchy import add_hierarchy_columns, ancestor_table, subtree_root_table, add_subtree_root_column, \
+        HIERARCHY_COLUMNS, SUBTREE_ROOT_COLUMN
+    from utils.graph_read import get_subtree_roots
+    from utils.normalization import normalize_terms
+    from utils.automaton import TermAutomaton, DEFAULT_NORMALIZATION
+    from utils.attributes import constrained_codes
+    from terminology import rf2_file_to_read, load_descriptions, load_description_versions, load_language_descriptions, \
+        load_all_concepts, files_by_language, load_relationships, load_isa_edges, load_hierarchy, gazetteer_parts, \
+        select_gazetteer, load_hierarchy_table, load_subsumption, load_attribute_index, load_csr_graph
+    if options.clear_cache and options.cache_dir is not None:
+        clear_cache(options.cache_dir)
+    # RF2 files that are actually read (Snapshot files of the release if they are present)
+    concept_paths = [rf2_file_to_read(path, options.use_snapshot) for path in options.concept_paths]
+    relation_paths = [rf2_file_to_read(path, options.use_snapshot) for path in options.relation_paths]
+
+    rf2_options = dict(cache_dir=options.cache_dir, workers=options.workers, reader=options.reader)
+
+    # Load the table of active "is a" relationships. It is read once and shared by the active code filter and the hierarchy.
+    # If a code has no parents, means that that code is deprecated.
+    with stage("read_relations") as record:
+        isa_edges = load_isa_edges(relation_paths, **rf2_options)
+        record["rows"] = len(isa_edges)
+
+    if options.update_from is None:
+        # Read and prepare the concepts of each language (its concept files together), applying its semantic tag normalization
+        with stage("read_concepts") as record:
+            concepts_df_prepared = load_all_concepts(concept_paths, options.languages, **rf2_options)
+            record["rows"] = len(concepts_df_prepared)
     else:
-        filtered_concepts_df = filter_concepts_by_semantic_tag(concepts_df_prepared.copy(), options.semantic_tag_list)
-
-
-
-    # Check if we need to compute any substree
-    if options.subtrees_code_list is None:
-        print("No need to include subtree codes")
-        subtrees_df = pd.DataFrame(columns=["code","language","term","semantic_tag","mainterm"])
-    else: 
-        # Load snomed-as hiearchical structure (networkx)
-        g = load_ontology(options.relation_path, root_concept_code = "138875005", relation_types=["116680003"])
-        # Compute the children from the codes.
-        print("Generating subtrees codes")
-        # Transform input codes to ints
-        lista_ints = [int(i) for i in options.subtrees_code_list]
-        codigos_subtress = get_sucessors_from_list(g, lista_ints)
-        # Select from dataframe those codes
-        subtrees_df = concepts_df_prepared[concepts_df_prepared.code.isin(codigos_subtress)].reset_index(drop=True).copy()
-
-    # PREPARE OUTPUT FILE
-    output_df = pd.concat([filtered_concepts_df, subtrees_df]).reset_index(drop=True).copy()
-    output_df = output_df.drop_duplicates(subset=["code","language","term","semantic_tag"]).reset_index(drop=True)
-    output_df = output_df[["code","term","semantic_tag","mainterm","language"]]
-    output_df.to_csv(options.out, sep="\t",index=False)
-    print("Save file in {}".format(options.out))
+        # Incremental update: only the concepts that changed since the previous release are prepared again
+        # The concept files and the selection were checked against the previous run in main
+        previous_state = load_run_state(options.update_from)
+        with stage("read_previous_gazetteer") as record:
+            previous_gazetteer = read_gazetteer(previous_state["outputs"], previous_state.get("format", "tsv"))
+            record["rows"] = len(previous_gazetteer)
+        with stage("changed_concepts") as record:
+            previous_edges = previous_isa_edges(previous_state["relation_files"])
+            affected = changed_hierarchy_concepts(previous_edges, isa_edges, with_descendants=options.subtrees_code_list is not None)
+            descriptions = {language: load_language_descriptions(paths, **rf2_options)
+                            for language, paths in files_by_language(concept_paths, options.languages).items()}
+            previous = previous_descriptions(previous_state["concept_files"])
+            for language, language_descriptions in descriptions.items():
+                affected |= changed_description_concepts(previous[language], language_descriptions)
+            record["codes"] = len(affected)
+        print("{} concepts changed since the previous release".format(len(affected)))
+        affected = np.array(sorted(affected), dtype=np.int64)
+        with stage("read_concepts") as record:
+            concepts_df_prepared = concat_concept_dfs(prepare_concept_df(language_descriptions[isin_sorted(language_descriptions.conceptId.values, affected)].copy(), language)
+                                                      for language, language_descriptions in descriptions.items())
+            record["rows"] = len(concepts_df_prepared)
+
+    # From the edges table, obtain the sorted array of active codes.
+    with stage("active_code_filter") as record:
+        active_codes = list_of_active_codes_from_relations(isa_edges)
+        # Filter the concept_df, only maintaining the active_codes
+        concepts_df_prepared = concepts_df_prepared[isin_sorted(concepts_df_prepared.code.values, active_codes)].reset_index(drop=True)
+        record["codes"], record["rows"] = len(active_codes), len(concepts_df_prepared)
+
+    # The hierarchy structures are loaded once and shared by the stages that use them: the CSR graph (subtrees with
+    # the csr backend, hierarchy columns) and its transitive closure (query index, attribute constraints, ancestors,
+    # and subtrees when a subsumption index file is given), computed from the same graph if it is not cached
+    csr_graph, subsumption = None, None
+    selects_subtrees = options.subtrees_code_list is not None
+    if options.hierarchy_columns or (selects_subtrees and options.graph_backend == "csr" and options.subsumption_index is None):
+        csr_graph = load_graph_stage(lambda: load_csr_graph(relation_paths, isa_edges, options.cache_dir))
+    if options.query_index is not None or options.attribute_constraints is not None or options.ancestors or \
+            (selects_subtrees and options.subsumption_index is not None):
+        subsumption = load_graph_stage(lambda: load_subsumption(relation_paths, isa_edges, options.cache_dir,
+                                                                options.subsumption_index, graph=csr_graph),
+                                       "build_subsumption_index")
+
+    if options.query_index is not None:
+        from utils.query_index import QueryIndex
+        with stage("query_index") as record:
+            query_index = QueryIndex.from_concepts(concepts_df_prepared, subsumption)
+            query_index.save(options.query_index)
+            record["rows"] = len(query_index)
+        print("Save query index in {}".format(options.query_index))
+
+    # Concepts that satisfy the attribute constraints: intersections of the sources of the attribute
+    # relationships with the closures of their values
+    allowed_codes = None
+    if options.attribute_constraints is not None:
+        with stage("attribute_index") as record:
+            attribute_index = load_attribute_index(relation_paths, **rf2_options)
+            record["rows"] = len(attribute_index)
+        with stage("attribute_constraints") as record:
+            allowed_codes = constrained_codes(np.unique(concepts_df_prepared.code.values), options.attribute_constraints,
+                                              attribute_index, subsumption)
+            record["codes"] = len(allowed_codes)
+        print("{} concepts satisfy the attribute constraints".format(len(allowed_codes)))
+
+    # Select the concepts of the semantic tags and the subtrees
+    if options.graph_backend == "networkx":
+        load_graph = lambda: load_graph_stage(lambda: load_hierarchy(relation_paths, isa_edges, graph_backend="networkx"))
+    else:
+        load_graph = lambda: subsumption if options.subsumption_index is not None else csr_graph
+    subtree_codes = None
+    if options.subtree_roots:
+        # All the subtrees are labeled with their roots in one pass, and the selection reuses their codes
+        g = load_graph()
+        with stage("subtree_roots") as record:
+            subtree_roots = subtree_root_table(*get_subtree_roots(g, options.subtrees_code_list))
+            subtree_codes = subtree_roots.code.values
+            record["codes"] = len(subtree_codes)
+    if options.update_from is None and options.automaton is None and options.preprocessing_args is None and not options.ancestors:
+        # The selections are written in chunks, one after the other, dropping the duplicated rows
+        output_parts = gazetteer_parts(concepts_df_prepared, options.semantic_tag_list, options.subtrees_code_list, load_graph,
+                                       allowed_codes, subtree_codes)
+    else:
+        output_df = select_gazetteer(concepts_df_prepared, options.semantic_tag_list, options.subtrees_code_list, load_graph,
+                                     allowed_codes, subtree_codes)
+        if options.update_from is not None:
+            with stage("apply_changes") as record:
+                output_df, changes_df = apply_changes(previous_gazetteer, affected, output_df)
+                record["rows"] = len(changes_df)
+            to_output_types(changes_df).to_csv(options.out + CHANGES_SUFFIX, sep="\t", index=False)
+            print("Save change report ({} changes) in {}".format(len(changes_df), options.out + CHANGES_SUFFIX))
+        output_parts = [output_df]
+    # Functions that add columns joined by code to the rows of the gazetteer
+    columns, column_adders = list(GAZETTEER_COLUMNS), []
+    if options.hierarchy_columns:
+        # Depth, top-level branches and parents of every concept, computed once and joined by code
+        with stage("hierarchy_table") as record:
+            hierarchy = load_hierarchy_table(relation_paths, isa_edges, options.cache_dir, graph=csr_graph)
+            record["codes"] = len(hierarchy)
+        columns += HIERARCHY_COLUMNS
+        column_adders.append(lambda df: add_hierarchy_columns(df, hierarchy))
+    if options.subtree_roots:
+        columns.append(SUBTREE_ROOT_COLUMN)
+        column_adders.append(lambda df: add_subtree_root_column(df, subtree_roots))
+
+    def with_columns(df):
+        if not column_adders:
+            return df
+        with stage("extra_columns") as record:
+            record["rows"] = len(df)
+            for add_columns in column_adders:
+                df = add_columns(df)
+            return df
+    output_parts = (with_columns(part) for part in output_parts)
+    out_paths = write_gazetteer(output_parts, options.out, options.output_format, options.split_languages, columns)
+    for out_path in out_paths:
+        print("Save file in {}".format(out_path))
+    if options.preprocessing_args is not None:
+        # Normalized gazetteer: each distinct term is normalized once, and the rows that become
+        # duplicated keep the mainterm flag if any of them is a mainterm
+        with stage("normalization") as record:
+            normalized_df = output_df.assign(term=normalize_terms(output_df.term, options.preprocessing_args))
+            normalized_df = normalized_df[normalized_df.term.str.len() > 0]
+            normalized_df["mainterm"] = normalized_df.groupby(DEDUP_COLUMNS, observed=True, sort=False).mainterm.transform("max")
+            record["rows"] = len(normalized_df)
+        normalized_path = output_path_with_suffix(options.out, ".normalized", options.output_format)
+        for out_path in write_gazetteer([with_columns(normalized_df)], normalized_path, options.output_format,
+                                        options.split_languages, columns):
+            print("Save normalized gazetteer in {}".format(out_path))
+    if options.ancestors:
+        ancestors_path = output_path_with_suffix(options.out, ".ancestors", options.output_format)
+        with stage("ancestors") as record:
+            ancestors_df = ancestor_table(subsumption, output_df.code.values)
+            write_table(ancestors_df, ancestors_path, options.output_format)
+            record["rows"] = len(ancestors_df)
+        print("Save ancestor closure in {}".format(ancestors_path))
+    if options.automaton is not None:
+        with stage("automaton") as record:
+            TermAutomaton.from_gazetteer(output_df, options.preprocessing_args or DEFAULT_NORMALIZATION).save(options.automaton)
+            record["rows"] = len(output_df)
+        print("Save matching automaton in {}".format(options.automaton))
+
+    # Save the state of the run, so the gazetteer can be updated incrementally with the next release
+    if options.cache_dir is not None:
+        with stage("save_state"):
+            # Tables the next update compares with: the active descriptions of a language with a single file, and
+            # the latest versions of every file when they are combined (see utils.incremental)
+            groups = files_by_language(concept_paths, options.languages)
+            concept_tables = [("descriptions", load_descriptions) if len(groups[language]) == 1 else
+                              ("description_versions", load_description_versions) for language in options.languages]
+            relation_table, load_relation_table = ("isa_edges", lambda path, **kwargs: load_isa_edges([path], **kwargs)) \
+                if len(relation_paths) == 1 else ("relationships", load_relationships)
+            for concept_path, (_, load_table) in zip(concept_paths, concept_tables):
+                load_table(concept_path, **rf2_options)  # Make sure the table is cached
+            for relation_path in relation_paths:
+                load_relation_table(relation_path, **rf2_options)
+            save_run_state(options.out, {
+                "concept_files": [{"path": os.path.abspath(path), "language": language,
+                                   table: os.path.join(cache_entry(options.cache_dir, path), table + ".pkl")}
+                                  for path, language, (table, _) in zip(concept_paths, options.languages, concept_tables)],
+                "relation_files": [{"path": os.path.abspath(path),
+                                    relation_table: os.path.join(cache_entry(options.cache_dir, path), relation_table + ".pkl")}
+                                   for path in relation_paths],
+                "semantic_tags": options.semantic_tag_list,
+                "subtrees": options.subtrees_code_list,
+                "format": options.output_format,
+                "outputs": [os.path.abspath(path) for path in out_paths]})
 
 if __name__ == "__main__":
   sys.exit(main())
\ No newline at end of file
@@ -0,0 +1,177 @@
+"""
+This module contains a small asyncio HTTP server that keeps a Terminology (see terminology.py)
+resident in memory and serves gazetteer slices to other processes. It is started with
+`python src/gaznomed.py serve ...` and listens on localhost by default.
+
+Endpoints (GET, all of them accept format=tsv|json):
+    /health                                  Status of the server
+    /semantic_tags                           Semantic tags of the release
+    /semantic_tag?tags=disorder,finding      Rows of the concepts of those semantic tags
+    /subtree?codes=404684003,71388002        Rows of the concepts of the subtrees of those codes
+    /code?codes=404684003                    Rows of those codes
+    /gazetteer?semantic_tags=...&subtrees=...Same selection as the CLI (all the semantic tags by default, 'None' for none)
+"""
+import asyncio, json
+from urllib.parse import urlsplit, parse_qs
+from utils.writer import to_output_types
+
+# Number of rows written on each chunk of a streamed response
+ROWS_PER_CHUNK = 10000
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 500: "Internal Server Error"}
+
+
+class UnknownEndpoint(Exception):
+    """Raised by run_query for a path that is not an endpoint (answered with 404)."""
+
+
+def _split(params, name):
+    values = params.get(name)
+    if not values:
+        return None
+    return [value for value in ",".join(values).split(",") if value]
+
+
+def _codes(params, name):
+    values = _split(params, name)
+    if values is None:
+        raise ValueError("Parameter '{}' is required".format(name))
+    return [int(value) for value in values]
+
+
+def run_query(terminology, path, params):
+    """
+    Answer a query with the terminology. This function is blocking and runs in a thread.
+
+    Returns:
+        pd.DataFrame or object serializable to json
+    """
+    if path == "/health":
+        return {"status": "ok", "concepts": len(terminology.concepts)}
+    if path == "/semantic_tags":
+        return terminology.semantic_tags()
+    if path == "/semantic_tag":
+        return terminology.filter_by_semantic_tag(_split(params, "tags") or [])
+    if path == "/subtree":
+        return terminology.lookup(terminology.subtree(_codes(params, "codes")))
+    if path == "/code":
+        return terminology.lookup(_codes(params, "codes"))
+    if path == "/gazetteer":
+        subtrees = _split(params, "subtrees")
+        return terminology.gazetteer(semantic_tags=_split(params, "semantic_tags") or "all",
+                                     subtrees=[int(code) for code in subtrees] if subtrees else None)
+    raise UnknownEndpoint(path)
+
+
+def _format_chunks(result, output_format):
+    """Yield the encoded chunks of a response body."""
+    if not hasattr(result, "to_csv"):
+        yield json.dumps(result, ensure_ascii=False).encode("utf-8")
+        return
+    result = to_output_types(result)
+    if output_format == "json":
+        yield b"["
+        for start in range(0, len(result), ROWS_PER_CHUNK):
+            rows = result.iloc[start:start + ROWS_PER_CHUNK].to_json(orient="records", force_ascii=False)[1:-1]
+            yield (("," if start else "") + rows).encode("utf-8")
+        yield b"]"
+    else:
+        yield result.iloc[:0].to_csv(sep="\t", index=False).encode("utf-8")
+        for start in range(0, len(result), ROWS_PER_CHUNK):
+            yield result.iloc[start:start + ROWS_PER_CHUNK].to_csv(sep="\t", index=False, header=False).encode("utf-8")
+
+
+class GazetteerServer:
+    """
+    asyncio HTTP/1.1 server over a Terminology. Queries run in the default thread pool, so a slow
+    query does not block the others, and responses are streamed with chunked transfer encoding.
+    """
+
+    def __init__(self, terminology, host="127.0.0.1", port=8000):
+        self.terminology = terminology
+        self.host = host
+        self.port = port
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        print("Serving gazetteer on http://{}:{}".format(self.host, self.port))
+        return self.server
+
+    async def serve_forever(self):
+        await self.start()
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def close(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    def _send_headers(self, writer, status, content_type):
+        writer.write("HTTP/1.1 {} {}\r\nContent-Type: {}; charset=utf-8\r\nTransfer-Encoding: chunked\r\n"
+                     "Connection: close\r\n\r\n".format(status, REASONS[status], content_type).encode("latin-1"))
+
+    async def _send(self, writer, status, chunks, content_type):
+        self._send_headers(writer, status, content_type)
+        await self._send_chunks(writer, chunks)
+
+    async def _send_chunks(self, writer, chunks):
+        for chunk in chunks:
+            if chunk:
+                writer.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+                await writer.drain()
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+    async def _send_error(self, writer, status, message):
+        await self._send(writer, status, [json.dumps({"error": message}).encode("utf-8")], "application/json")
+
+    async def handle(self, reader, writer):
+        headers_sent = False
+        try:
+            request_line = (await reader.readline()).decode("latin-1").strip()
+            # Skip the headers
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request_line.split(" ")
+            if len(parts) != 3:
+                await self._send_error(writer, 400, "Malformed request")
+                return
+            method, target, _ = parts
+            if method != "GET":
+                await self._send_error(writer, 405, "Only GET requests are supported")
+                return
+            url = urlsplit(target)
+            params = parse_qs(url.query)
+            output_format = (params.get("format") or ["tsv"])[0]
+            loop = asyncio.get_running_loop()
+            try:
+                result = await loop.run_in_executor(None, run_query, self.terminology, url.path, params)
+            except UnknownEndpoint:
+                await self._send_error(writer, 404, "Unknown endpoint {}".format(url.path))
+                return
+            except ValueError as error:
+                await self._send_error(writer, 400, str(error))
+                return
+            is_table = hasattr(result, "to_csv")
+            content_type = "text/tab-separated-values" if is_table and output_format != "json" else "application/json"
+            self._send_headers(writer, 200, content_type)
+            headers_sent = True
+            await self._send_chunks(writer, _format_chunks(result, output_format))
+        except ConnectionError:
+            pass
+        except Exception as error:
+            # Once the body has started, the error can not be reported: the connection is closed without the last
+            # chunk, so the client sees a truncated response
+            if not headers_sent:
+                await self._send_error(writer, 500, str(error))
+        finally:
+            writer.close()
+
+
+def serve(terminology, host="127.0.0.1", port=8000):
+    """Serve a Terminology until the process is interrupted."""
+    try:
+        asyncio.run(GazetteerServer(terminology, host, port).serve_forever())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,411 @@
+"""
+This module contains the library API of gaznomed: functions to load the parts of a Snomed-CT
+release (used by the CLI in gaznomed.py) and the Terminology object, that loads a release once
+(or from a cache) and answers repeated semantic tag, subtree and gazetteer queries from memory.
+
+    import sys; sys.path.append("PATH_TO_GAZNOMED/src")
+    from terminology import Terminology
+    sct = Terminology.load(["sct2_Description_Full-en_INT_20210731.txt"], ["en"],
+                           ["sct2_Relationship_Full_INT_20210731.txt"], cache_dir="CACHE_DIR")
+    sct.gazetteer(semantic_tags=["disorder"], subtrees=[404684003])
+"""
+import os, sys
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from utils.tabular_read import active_terms_from_conceptRF2_file, get_active_edges, \
+    list_of_active_codes_from_relations, isin_sorted, filter_concepts_by_semantic_tag, prepare_concept_df, \
+    concat_concept_dfs, latest_descriptions, latest_relationships, latest_versions_of_files, active_terms, active_edges
+from utils.constants import IS_A_TYPE_ID, GAZETTEER_COLUMNS
+from utils.graph_read import ontology_from_edges, csr_from_edges, get_sucessors_from_list, get_subtree_roots, \
+    load_subsumption_index
+from utils.csr_graph import CSRGraph
+from utils.subsumption import SubsumptionIndex
+from utils.hierarchy import hierarchy_table, add_hierarchy_columns
+from utils.attributes import AttributeIndex, constrained_codes
+from utils.rf2 import find_snapshot_file
+from utils.cache import load_or_build, load_or_build_dataframe
+from utils.metrics import stage
+
+ROOT_CONCEPT_CODE = 138875005
+
+
+def rf2_file_to_read(path, use_snapshot=True):
+    """Return the RF2 file that is actually read (the Snapshot file of the release if it is present)"""
+    if not use_snapshot:
+        return path
+    snapshot_path = find_snapshot_file(path)
+    if snapshot_path != path:
+        print("Reading Snapshot file {}".format(snapshot_path))
+    return snapshot_path
+
+
+def load_descriptions(concept_path, cache_dir=None, workers=1, reader="mmap"):
+    """Read active terms from a concepts Snomed-CT RF2 File (already resolved to the file that is actually read)"""
+    return load_or_build_dataframe(cache_dir, concept_path, "descriptions.pkl",
+        lambda: active_terms_from_conceptRF2_file(concept_path, use_snapshot=False, workers=workers, reader=reader))
+
+
+def load_description_versions(concept_path, cache_dir=None, workers=1, reader="mmap"):
+    """Read the latest version of every description (active or not) of a concepts Snomed-CT RF2 File"""
+    return load_or_build_dataframe(cache_dir, concept_path, "description_versions.pkl",
+        lambda: latest_descriptions(concept_path, use_snapshot=False, workers=workers, reader=reader))
+
+
+def files_by_language(concept_paths, languages):
+    """Group the concept files by language, in order of first appearance: {language: [concept files]}"""
+    groups = dict()
+    for concept_path, language in zip(concept_paths, languages):
+        groups.setdefault(language, []).append(concept_path)
+    return groups
+
+
+def load_language_descriptions(concept_paths, cache_dir=None, workers=1, reader="mmap"):
+    """
+    Read the active terms of the concept files of one language (edition and extensions, in that order).
+    With several files, the latest version of each description is resolved across all of them.
+    """
+    if len(concept_paths) == 1:
+        return load_descriptions(concept_paths[0], cache_dir, workers, reader)
+    return active_terms(latest_versions_of_files([load_description_versions(concept_path, cache_dir, workers, reader)
+                                                  for concept_path in concept_paths]))
+
+
+def load_concepts(concept_paths, language, cache_dir=None, workers=1, reader="mmap"):
+    """
+    Read active terms from the concepts Snomed-CT RF2 Files of a language and prepare a dataframe with the correct shape.
+    The files of a language are prepared together, so a synonym takes the semantic tag of the FSN of its concept
+    from any of them (e.g. a synonym of an extension whose FSN is in the edition file).
+    """
+    if isinstance(concept_paths, str):
+        concept_paths = [concept_paths]
+    if len(concept_paths) == 1:
+        return load_or_build_dataframe(cache_dir, concept_paths[0], "concepts_{}.pkl".format(language),
+            lambda: prepare_concept_df(load_descriptions(concept_paths[0], cache_dir, workers, reader), language))
+    return prepare_concept_df(load_language_descriptions(concept_paths, cache_dir, workers, reader), language)
+
+
+def load_all_concepts(concept_paths, languages, cache_dir=None, workers=1, reader="mmap"):
+    """Read and prepare the concepts of several concept files, applying the semantic tag normalization of each language"""
+    return concat_concept_dfs(load_concepts(paths, language, cache_dir, workers, reader)
+                              for language, paths in files_by_language(concept_paths, languages).items())
+
+
+def load_relationships(relation_path, cache_dir=None, workers=1, reader="mmap"):
+    """Read the latest version of every relationship (active or not, of every type) of a relation file"""
+    return load_or_build_dataframe(cache_dir, relation_path, "relationships.pkl",
+        lambda: latest_relationships(relation_path, use_snapshot=False, workers=workers, reader=reader))
+
+
+def load_active_edges(relation_paths, name, relation_types, cache_dir=None, workers=1, reader="mmap"):
+    """
+    Load the active relationships of the given types of one or several relation files (edition and extensions,
+    in that order). With several files, the latest version of each relationship is resolved across all of them,
+    so a relationship inactivated in an extension is not active.
+    """
+    if len(relation_paths) == 1:
+        return load_or_build_dataframe(cache_dir, relation_paths[0], name,
+            lambda: get_active_edges(relation_paths[0], relation_types=relation_types, use_snapshot=False,
+                                     workers=workers, reader=reader))
+    return active_edges(latest_versions_of_files([load_relationships(relation_path, cache_dir, workers, reader)
+                                                  for relation_path in relation_paths]), relation_types)
+
+
+def load_isa_edges(relation_paths, cache_dir=None, workers=1, reader="mmap"):
+    """Load the table of active "is a" relationships of one or several relation files (edition and extensions)"""
+    return load_active_edges(relation_paths, "isa_edges.pkl", [IS_A_TYPE_ID], cache_dir, workers, reader)
+
+
+def load_attribute_edges(relation_paths, cache_dir=None, workers=1, reader="mmap"):
+    """Load the table of active relationships of every type (attribute relationships included) of one or several relation files"""
+    return load_active_edges(relation_paths, "edges.pkl", "all", cache_dir, workers, reader)
+
+
+def load_attribute_index(relation_paths, cache_dir=None, workers=1, reader="mmap", relation_types="all"):
+    """Index the active attribute relationships of the given typeIds ("all" for every type) in typed adjacency arrays"""
+    return AttributeIndex.from_edges(load_attribute_edges(relation_paths, cache_dir, workers, reader), relation_types)
+
+
+def load_csr_graph(relation_paths, isa_edges, cache_dir=None):
+    """Load the "is a" hierarchy as a CSR graph. It is only cached when there is a single relation file"""
+    cache_dir = cache_dir if len(relation_paths) == 1 else None
+    return load_or_build(cache_dir, relation_paths[0], "isa_graph",
+                         lambda: csr_from_edges(isa_edges, root_concept_code = ROOT_CONCEPT_CODE),
+                         save=CSRGraph.save, load=CSRGraph.load)
+
+
+def load_hierarchy(relation_paths, isa_edges, cache_dir=None, graph_backend="csr", subsumption_index=None):
+    """
+    Load snomed-as hiearchical structure: the CSR graph (cached when there is a single relation file), or the
+    networkx graph. The transitive closure is only loaded when a subsumption index file (subsumption_index) is given,
+    and that file must have been built from the given relation files (see load_subsumption).
+    """
+    if graph_backend == "networkx":
+        if subsumption_index is not None:
+            raise ValueError("The subsumption index can not be used with the networkx backend")
+        return ontology_from_edges(isa_edges, root_concept_code = ROOT_CONCEPT_CODE)
+    if subsumption_index is not None:
+        return load_subsumption(relation_paths, isa_edges, cache_dir, subsumption_index)
+    return load_csr_graph(relation_paths, isa_edges, cache_dir)
+
+
+def load_subsumption(relation_paths, isa_edges, cache_dir=None, subsumption_index=None, graph=None):
+    """
+    Load the transitive closure of the hierarchy: from the subsumption index file if it is given, else from the
+    cache (only when there is a single relation file), else it is computed from the given CSR graph (or function
+    that returns it, only called if needed), or from the CSR graph loaded with load_csr_graph if none is given.
+    """
+    if graph is None:
+        graph = lambda: load_csr_graph(relation_paths, isa_edges, cache_dir)
+    if subsumption_index is not None:
+        return load_subsumption_index(subsumption_index, graph, relation_paths, cache_dir)
+    cache_dir = cache_dir if len(relation_paths) == 1 else None
+    return load_or_build(cache_dir, relation_paths[0], "subsumption_index.npz",
+                         lambda: SubsumptionIndex.from_graph(graph() if callable(graph) else graph),
+                         save=SubsumptionIndex.save, load=SubsumptionIndex.load)
+
+
+def load_hierarchy_table(relation_paths, isa_edges, cache_dir=None, graph=None):
+    """
+    Load the depth, top-level branches and parents of every concept (see utils.hierarchy.hierarchy_table).
+    The table is computed from the given CSR graph (or function that returns it, only called if the table is
+    not cached), or from the CSR graph loaded with load_csr_graph if none is given.
+    """
+    if graph is None:
+        graph = lambda: load_csr_graph(relation_paths, isa_edges, cache_dir)
+    cache_dir = cache_dir if len(relation_paths) == 1 else None
+    return load_or_build_dataframe(cache_dir, relation_paths[0], "hierarchy.pkl",
+                                   lambda: hierarchy_table(graph() if callable(graph) else graph, root_concept_code = ROOT_CONCEPT_CODE))
+
+
+def gazetteer_parts(concepts_df_prepared, semantic_tag_list, subtrees_code_list, load_graph, allowed_codes=None,
+                    subtree_codes=None):
+    """
+    Selections of the gazetteer, in output order: the concepts of the given semantic tags and the
+    concepts of the subtrees of the given codes. They may share rows (see select_gazetteer and
+    utils.writer.write_gazetteer, which drop the duplicates).
+
+    Args:
+        concepts_df_prepared (pd.DataFrame): Active concepts (output of prepare_concept_df)
+        semantic_tag_list (list or str): Semantic tags, "all" (or ["all"]) for all of them, ["None"] for none
+        subtrees_code_list (list): Codes from which the subtrees are selected, or None
+        load_graph (callable): Function without arguments that returns the hierarchy (only called if needed)
+        allowed_codes (np.ndarray, optional): Sorted int64 codes the selections are restricted to (e.g. the
+                                              codes that satisfy attribute constraints, see utils.attributes)
+        subtree_codes (np.ndarray, optional): Sorted int64 codes of the subtrees, if they were already computed
+                                              (e.g. with utils.graph_read.get_subtree_roots). load_graph is not called then.
+
+    Yields:
+        pd.DataFrame: Rows of each selection
+    """
+    if allowed_codes is not None:
+        concepts_df_prepared = concepts_df_prepared[isin_sorted(concepts_df_prepared.code.values, allowed_codes)]
+    # FILTER SEMANTIC TAGS
+    if semantic_tag_list == "all" or semantic_tag_list == ["all"]:
+        yield concepts_df_prepared
+    elif semantic_tag_list != ["None"]:
+        with stage("semantic_tags") as record:
+            part = filter_concepts_by_semantic_tag(concepts_df_prepared, semantic_tag_list)
+            record["rows"] = len(part)
+        yield part
+
+    # Check if we need to compute any substree
+    if subtrees_code_list is None:
+        print("No need to include subtree codes")
+    else:
+        g = load_graph() if subtree_codes is None else None
+        # Compute the children from the codes.
+        print("Generating subtrees codes")
+        with stage("subtrees") as record:
+            # Transform input codes to ints
+            lista_ints = [int(i) for i in subtrees_code_list]
+            codigos_subtress = get_sucessors_from_list(g, lista_ints) if subtree_codes is None else subtree_codes
+            # Select from dataframe those codes
+            part = concepts_df_prepared[isin_sorted(concepts_df_prepared.code.values, codigos_subtress)]
+            record["codes"], record["rows"] = len(codigos_subtress), len(part)
+        yield part
+
+
+def select_gazetteer(concepts_df_prepared, semantic_tag_list, subtrees_code_list, load_graph, allowed_codes=None,
+                     subtree_codes=None):
+    """
+    Select the rows of the gazetteer (see gazetteer_parts) in a single table.
+
+    Returns:
+        pd.DataFrame: Gazetteer with the columns code, term, semantic_tag, mainterm and language
+    """
+    parts = list(gazetteer_parts(concepts_df_prepared, semantic_tag_list, subtrees_code_list, load_graph, allowed_codes,
+                                 subtree_codes))
+    if not parts:
+        return pd.DataFrame(columns=GAZETTEER_COLUMNS)
+    with stage("concat_selections") as record:
+        output_df = pd.concat(parts, ignore_index=True)
+        output_df = output_df.drop_duplicates(subset=["code","language","term","semantic_tag"]).reset_index(drop=True)
+        record["rows"] = len(output_df)
+    return output_df[GAZETTEER_COLUMNS]
+
+
+class Terminology:
+    """
+    In-memory Snomed-CT release. The concept table is sorted by code and indexed by semantic tag,
+    and the hierarchy is kept as a subsumption index, so repeated queries do not read files or
+    traverse the graph.
+
+    Attributes:
+        concepts (pd.DataFrame): Active concepts (code, language, term, semantic_tag, mainterm), sorted by code
+        isa_edges (pd.DataFrame): Active "is a" relationships
+        index (SubsumptionIndex): Transitive closure of the hierarchy
+        attributes (AttributeIndex): Attribute relationships (None if the release was loaded without them)
+    """
+
+    def __init__(self, concepts, isa_edges, index=None, attributes=None):
+        active_codes = list_of_active_codes_from_relations(isa_edges)
+        concepts = concepts[isin_sorted(concepts.code.values, active_codes)]
+        self.concepts = concepts.sort_values(by="code", kind="stable").reset_index(drop=True)
+        self.isa_edges = isa_edges
+        self.index = index if index is not None else SubsumptionIndex.from_graph(csr_from_edges(isa_edges))
+        self.attributes = attributes
+        self._hierarchy = None
+        self._codes = self.concepts.code.values
+        self._rows_by_tag = {tag: rows.values for tag, rows in
+                             self.concepts.groupby("semantic_tag", sort=False, observed=True).groups.items()}
+
+    @classmethod
+    def load(cls, concept_paths, languages, relation_paths, cache_dir=None, use_snapshot=True, workers=1, reader="mmap",
+             attributes=False):
+        """
+        Load a release from its RF2 files, or from the cache if cache_dir is given and the files were already parsed.
+
+        Args:
+            concept_paths (list): Paths to the RF2 concept (description) files
+            languages (list): Language of each concept file ('en' or 'es')
+            relation_paths (list): Paths to the RF2 relation files (edition and extensions)
+            cache_dir (str, optional): Cache directory (see utils.cache)
+            use_snapshot (bool, optional): Read the Snapshot files of the release if they are present.
+            workers (int, optional): Number of processes used to parse the RF2 files.
+            reader (str, optional): RF2 reader used when workers is 1, "mmap" or "pandas".
+            attributes (bool, optional): Also index the attribute relationships, for attribute-constrained queries.
+
+        Returns:
+            Terminology
+        """
+        if isinstance(concept_paths, str):
+            concept_paths = [concept_paths]
+        if isinstance(languages, str):
+            languages = [languages] * len(concept_paths)
+        if isinstance(relation_paths, str):
+            relation_paths = [relation_paths]
+        concept_paths = [rf2_file_to_read(path, use_snapshot) for path in concept_paths]
+        relation_paths = [rf2_file_to_read(path, use_snapshot) for path in relation_paths]
+        concepts = load_all_concepts(concept_paths, languages, cache_dir, workers, reader)
+        isa_edges = load_isa_edges(relation_paths, cache_dir, workers, reader)
+        attribute_index = load_attribute_index(relation_paths, cache_dir, workers, reader) if attributes else None
+        return cls(concepts, isa_edges, load_subsumption(relation_paths, isa_edges, cache_dir), attribute_index)
+
+    def _rows_of_codes(self, codes):
+        """Positions of the rows of the given codes in the concept table."""
+        codes = np.unique(np.asarray(codes, dtype=np.int64))
+        starts = np.searchsorted(self._codes, codes, side="left")
+        lengths = np.searchsorted(self._codes, codes, side="right") - starts
+        return np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(int(lengths.sum()))
+
+    def semantic_tags(self):
+        """Semantic tags present in the release."""
+        return sorted(self._rows_by_tag)
+
+    def lookup(self, codes):
+        """Rows of the given codes."""
+        return self.concepts.iloc[self._rows_of_codes(codes)][GAZETTEER_COLUMNS]
+
+    def filter_by_semantic_tag(self, tags):
+        """Rows of the concepts of the given semantic tags."""
+        if isinstance(tags, str):
+            tags = [tags]
+        rows = [self._rows_by_tag[tag] for tag in tags if tag in self._rows_by_tag]
+        rows = np.sort(np.concatenate(rows)) if rows else np.empty(0, dtype=np.int64)
+        return self.concepts.iloc[rows][GAZETTEER_COLUMNS]
+
+    def subtree(self, codes):
+        """Codes of the subtrees of the given codes (codes included)."""
+        return self.index.descendants([int(code) for code in np.atleast_1d(codes)])
+
+    def subtree_roots(self, codes):
+        """
+        Codes of the subtrees of the given codes, labeled with the codes (roots) whose subtrees contain them.
+
+        Returns:
+            pd.DataFrame: One row per code and root, with the int64 columns code and subtree_root
+        """
+        codes, roots = get_subtree_roots(self.index, np.atleast_1d(codes))
+        return pd.DataFrame({"code": codes, "subtree_root": roots})
+
+    def hierarchy(self, codes=None):
+        """Depth, top-level branches and direct parents of the given codes, or of every concept (see utils.hierarchy)."""
+        if self._hierarchy is None:
+            self._hierarchy = hierarchy_table(csr_from_edges(self.isa_edges), root_concept_code = ROOT_CONCEPT_CODE)
+        if codes is None:
+            return self._hierarchy
+        return add_hierarchy_columns(pd.DataFrame({"code": np.atleast_1d(np.asarray(codes, dtype=np.int64))}), self._hierarchy)
+
+    def _attribute_index(self):
+        if self.attributes is None:
+            raise ValueError("The attribute relationships are not loaded. Use Terminology.load(..., attributes=True)")
+        return self.attributes
+
+    def attributes_of(self, codes):
+        """Attribute relationships of the given codes, as a table with the columns code, typeId and destinationId."""
+        sources, type_ids, destinations = self._attribute_index().attributes(codes)
+        return pd.DataFrame({"code": sources, "typeId": type_ids, "destinationId": destinations})
+
+    def with_attributes(self, constraints, codes=None):
+        """
+        Codes that satisfy every attribute constraint (see utils.attributes.constrained_codes).
+
+        Args:
+            constraints (dict or list): typeId -> value codes, or (typeId, value codes) pairs. The value of the
+                                        relationship must be one of the value codes or one of their descendants.
+            codes (array-like, optional): Candidate codes (all the concepts if None), e.g. the output of subtree
+
+        Returns:
+            np.ndarray: Sorted int64 SCTIDs
+        """
+        constraints = constraints.items() if isinstance(constraints, dict) else constraints
+        constraints = [(type_id, np.atleast_1d(values)) for type_id, values in constraints]
+        codes = np.unique(self._codes) if codes is None else np.unique(np.asarray(codes, dtype=np.int64))
+        return constrained_codes(codes, constraints, self._attribute_index(), self.index)
+
+    def query_index(self):
+        """Concept rows and hierarchy in NumPy arrays, to be saved and queried without pandas (see utils.query_index)."""
+        from utils.query_index import QueryIndex
+        return QueryIndex.from_concepts(self.concepts, self.index)
+
+    def is_a(self, codes, ancestor_codes):
+        """Bulk "is a" test (see SubsumptionIndex.is_a)."""
+        return self.index.is_a(codes, ancestor_codes)
+
+    def gazetteer(self, semantic_tags="all", subtrees=None, attributes=None):
+        """
+        Rows of the gazetteer with the concepts of the given semantic tags plus the concepts of the
+        subtrees of the given codes, as the CLI does.
+
+        Args:
+            semantic_tags (list or str, optional): Semantic tags, "all" for all of them, None for none.
+            subtrees (list, optional): Codes from which the subtrees are selected.
+            attributes (dict or list, optional): Attribute constraints the concepts must satisfy (see with_attributes)
+
+        Returns:
+            pd.DataFrame: Gazetteer with the columns code, term, semantic_tag, mainterm and language
+        """
+        if semantic_tags == "all" or semantic_tags == ["all"]:
+            rows = np.arange(len(self.concepts))
+        else:
+            rows = np.empty(0, dtype=np.int64)
+            if semantic_tags is not None and semantic_tags != ["None"]:
+                rows = self.filter_by_semantic_tag(semantic_tags).index.values
+            if subtrees is not None:
+                rows = np.union1d(rows, self._rows_of_codes(self.subtree(subtrees)))
+        if attributes is not None:
+            rows = np.intersect1d(rows, self._rows_of_codes(self.with_attributes(attributes)))
+        output_df = self.concepts.iloc[rows]
+        return output_df.drop_duplicates(subset=["code","language","term","semantic_tag"])[GAZETTEER_COLUMNS]
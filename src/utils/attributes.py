@@ -0,0 +1,146 @@
+"""
+This module contains an index of the active attribute relationships of Snomed-CT (finding site,
+causative agent, ...). The relationships are stored as typed adjacency arrays: sorted by
+(typeId, destinationId), with the range of each typeId in a CSR-like pointer array. Together
+with a SubsumptionIndex, it answers attribute-constrained queries such as "descendants of X whose
+finding site is in the subtree of Y" (`<< X : 363698007 = << Y` in ECL) with binary searches and
+intersections of sorted code arrays, without traversing the graph.
+
+relationshipGroup is not taken into account: a concept satisfies a constraint if any of its
+relationships of that type satisfies it.
+"""
+import numpy as np
+from utils.constants import IS_A_TYPE_ID
+from utils.tabular_read import isin_sorted
+
+
+def parse_attribute_constraint(constraint):
+    """
+    Parse a constraint written as "TYPE_ID=CODE[,CODE...]": the concept has a relationship of type
+    TYPE_ID whose value is one of the codes or one of their descendants.
+
+    Returns:
+        (int, list): typeId and codes of the value subtrees
+    """
+    type_id, separator, codes = constraint.partition("=")
+    try:
+        if not separator or not codes:
+            raise ValueError
+        return int(type_id), [int(code) for code in codes.split(",")]
+    except ValueError:
+        raise ValueError("Invalid attribute constraint {}. Use TYPE_ID=CODE[,CODE...]".format(constraint))
+
+
+class AttributeIndex:
+    """
+    Active attribute relationships in typed adjacency arrays.
+
+    Attributes:
+        types (np.ndarray): Sorted int64 typeIds
+        type_indptr (np.ndarray): Relationships of types[i] are in the range [type_indptr[i], type_indptr[i + 1])
+        sources, destinations (np.ndarray): int64 SCTIDs of the relationships, sorted by (typeId, destination, source)
+    """
+
+    def __init__(self, types, type_indptr, sources, destinations):
+        self.types = types
+        self.type_indptr = type_indptr
+        self.sources = sources
+        self.destinations = destinations
+
+    @classmethod
+    def from_edges(cls, edges, relation_types="all"):
+        """
+        Build the index from a table of active relationships. "Is a" relationships are left out
+        (they are indexed by CSRGraph and SubsumptionIndex) and repeated relationships are merged.
+
+        Args:
+            edges (pd.DataFrame): Active relationships with the columns sourceId, destinationId and typeId
+                                  (see utils.tabular_read.get_active_edges)
+            relation_types (list or str, optional): typeIds to index, or "all"
+
+        Returns:
+            AttributeIndex
+        """
+        edges = edges[edges.typeId != IS_A_TYPE_ID]
+        if relation_types != "all":
+            edges = edges[isin_sorted(edges.typeId.values, np.unique(np.asarray(relation_types, dtype=np.int64)))]
+        triples = np.stack([edges.typeId.values, edges.destinationId.values, edges.sourceId.values], axis=1).astype(np.int64)
+        triples = np.unique(triples.reshape(-1, 3), axis=0)
+        types, counts = np.unique(triples[:, 0], return_counts=True)
+        type_indptr = np.zeros(len(types) + 1, dtype=np.int64)
+        np.cumsum(counts, out=type_indptr[1:])
+        return cls(types, type_indptr, np.ascontiguousarray(triples[:, 2]), np.ascontiguousarray(triples[:, 1]))
+
+    def save(self, path):
+        """Save the index to a .npz file."""
+        with open(path, "wb") as f:
+            np.savez(f, types=self.types, type_indptr=self.type_indptr, sources=self.sources,
+                     destinations=self.destinations)
+
+    @classmethod
+    def load(cls, path):
+        """Load an index saved with AttributeIndex.save."""
+        with np.load(path) as data:
+            return cls(data["types"], data["type_indptr"], data["sources"], data["destinations"])
+
+    def __len__(self):
+        return len(self.sources)
+
+    def _range(self, type_id):
+        """Range of the relationships of a typeId (empty if the type is not indexed)."""
+        position = int(np.searchsorted(self.types, int(type_id)))
+        if position == len(self.types) or self.types[position] != int(type_id):
+            return 0, 0
+        return int(self.type_indptr[position]), int(self.type_indptr[position + 1])
+
+    def sources_with_value(self, type_id, value_codes):
+        """
+        Concepts with a relationship of the given type whose value is one of value_codes.
+
+        Args:
+            type_id (int): typeId of the attribute
+            value_codes (np.ndarray): Sorted int64 SCTIDs (e.g. the descendants of a code)
+
+        Returns:
+            np.ndarray: Sorted int64 SCTIDs
+        """
+        start, end = self._range(type_id)
+        destinations = self.destinations[start:end]
+        # Relationships are sorted by destination, so the ones of each value are a contiguous range
+        starts = np.searchsorted(destinations, value_codes, side="left")
+        lengths = np.searchsorted(destinations, value_codes, side="right") - starts
+        positions = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(int(lengths.sum()))
+        return np.unique(self.sources[start:end][positions])
+
+    def attributes(self, codes):
+        """
+        Attribute relationships of the given codes.
+
+        Returns:
+            (np.ndarray, np.ndarray, np.ndarray): SCTIDs of the sources, typeIds and SCTIDs of the destinations
+        """
+        mask = isin_sorted(self.sources, np.unique(np.asarray(codes, dtype=np.int64)))
+        type_ids = np.repeat(self.types, np.diff(self.type_indptr))
+        return self.sources[mask], type_ids[mask], self.destinations[mask]
+
+
+def constrained_codes(codes, constraints, attribute_index, subsumption_index):
+    """
+    Keep the codes that satisfy every attribute constraint. Each constraint is answered by
+    intersecting the codes with the sources of the relationships whose value is in the precomputed
+    closure of the value codes.
+
+    Args:
+        codes (np.ndarray): Sorted int64 SCTIDs (e.g. the output of get_sucessors_from_list)
+        constraints (list): (typeId, value codes) pairs (see parse_attribute_constraint)
+        attribute_index (AttributeIndex): Attribute relationships
+        subsumption_index (SubsumptionIndex): Transitive closure of the hierarchy
+
+    Returns:
+        np.ndarray: Sorted int64 SCTIDs
+    """
+    codes = np.asarray(codes, dtype=np.int64)
+    for type_id, value_codes in constraints:
+        values = subsumption_index.descendants(value_codes)
+        codes = np.intersect1d(codes, attribute_index.sources_with_value(type_id, values), assume_unique=True)
+    return codes
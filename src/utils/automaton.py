@@ -0,0 +1,248 @@
+"""
+This module contains a precompiled dictionary of the gazetteer for downstream matching: a
+token-level Aho-Corasick automaton over the normalized terms (see utils.normalization), which
+maps each term to its (code, semantic_tag, mainterm, language) entries. It is built in bulk
+with NumPy (one pass per trie depth), saved as .npy arrays that can be memory-mapped, and scans
+a text in a single pass.
+
+    automaton = TermAutomaton.load("gazetteer_automaton")
+    automaton.find("Patient with acute myocardial infarction")
+"""
+import json, os, re
+from collections import namedtuple
+import numpy as np
+from utils.normalization import normalize_terms, normalize_text, check_steps
+
+AUTOMATON_VERSION = 1
+METADATA_FILE = "automaton.json"
+VOCABULARY_FILE = "vocabulary.txt"
+ARRAY_NAMES = ["keys", "targets", "fail", "out_link", "depth", "entry_indptr",
+               "entry_codes", "entry_tags", "entry_mainterm", "entry_languages"]
+# Tokens: runs of word characters, or any other non-space character
+TOKEN_PATTERN = r"\w+|[^\w\s]"
+TOKEN_REGEX = re.compile(TOKEN_PATTERN)
+
+Match = namedtuple("Match", ["start", "end", "code", "semantic_tag", "mainterm", "language"])
+
+
+# Normalization of the tokens when none is given
+DEFAULT_NORMALIZATION = ["casefold"]
+
+
+def _lookup(keys, targets, query):
+    """Targets of the transition keys (state * vocabulary_size + token), -1 for missing transitions."""
+    if len(keys) == 0:
+        return np.full(len(query), -1, dtype=np.int64)
+    positions = np.minimum(np.searchsorted(keys, query), len(keys) - 1)
+    return np.where(keys[positions] == query, targets[positions], -1)
+
+
+class TermAutomaton:
+    """
+    Token-level Aho-Corasick automaton. States are trie nodes numbered in breadth-first order
+    (0 is the root); transitions are stored as sorted int64 keys (state * vocabulary_size + token)
+    and the entries of each terminal state in CSR arrays.
+
+    Attributes:
+        vocabulary (dict): Normalized token -> token id
+        normalization (list): Normalization steps applied to the tokens of the terms and of the texts
+        semantic_tags, languages (list): Values of the entry_tags and entry_languages ids
+    """
+
+    def __init__(self, vocabulary, metadata, keys, targets, fail, out_link, depth, entry_indptr,
+                 entry_codes, entry_tags, entry_mainterm, entry_languages):
+        self.vocabulary = vocabulary
+        self.metadata = metadata
+        self.normalization = metadata["normalization"]
+        self.semantic_tags = metadata["semantic_tags"]
+        self.languages = metadata["languages"]
+        self.keys = keys
+        self.targets = targets
+        self.fail = fail
+        self.out_link = out_link
+        self.depth = depth
+        self.entry_indptr = entry_indptr
+        self.entry_codes = entry_codes
+        self.entry_tags = entry_tags
+        self.entry_mainterm = entry_mainterm
+        self.entry_languages = entry_languages
+
+    @classmethod
+    def from_gazetteer(cls, df, normalization=DEFAULT_NORMALIZATION):
+        """
+        Build the automaton from a gazetteer. Terms are split into tokens and each token is
+        normalized and stripped; tokens that become empty (e.g. punctuation with the "punctuation" step) are dropped.
+
+        Args:
+            df (pd.DataFrame): Gazetteer with the columns code, term, semantic_tag, mainterm and language
+            normalization (list, optional): Normalization steps (see utils.normalization)
+
+        Returns:
+            TermAutomaton
+        """
+        import pandas as pd  # Only needed to build the automaton
+        term_ids, terms = pd.factorize(df.term.astype(str))
+        tokens = pd.Series(terms).str.findall(TOKEN_PATTERN).explode()
+        tokens = normalize_terms(tokens.dropna(), check_steps(normalization))
+        # The "punctuation" step replaces a punctuation token with a space
+        tokens = tokens.str.strip()
+        tokens = tokens[tokens.str.len() > 0]
+        token_ids, vocabulary = pd.factorize(tokens)
+        token_ids = token_ids.astype(np.int64)
+        n_vocabulary = max(len(vocabulary), 1)
+        # Ragged array of the token ids of each term
+        lengths = np.bincount(tokens.index.values, minlength=len(terms))
+        offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+
+        # Trie, one depth at a time: the nodes of depth d + 1 are the distinct (node, token) pairs
+        node_of_term = np.zeros(len(terms), dtype=np.int64)
+        keys, targets, parents, labels, depths = [], [], [], [], [np.zeros(1, dtype=np.int32)]
+        n_nodes = 1
+        for d in range(int(lengths.max()) if len(lengths) else 0):
+            deeper = np.flatnonzero(lengths > d)
+            pair_keys = node_of_term[deeper] * n_vocabulary + token_ids[offsets[deeper] + d]
+            unique_keys, inverse = np.unique(pair_keys, return_inverse=True)
+            children = n_nodes + np.arange(len(unique_keys), dtype=np.int64)
+            node_of_term[deeper] = children[inverse.reshape(-1)]
+            keys.append(unique_keys)
+            targets.append(children)
+            parents.append(unique_keys // n_vocabulary)
+            labels.append(unique_keys % n_vocabulary)
+            depths.append(np.full(len(unique_keys), d + 1, dtype=np.int32))
+            n_nodes += len(unique_keys)
+        empty = np.empty(0, dtype=np.int64)
+        # Nodes are created in breadth-first order and parents grow with depth, so keys are sorted
+        levels = targets
+        keys = np.concatenate(keys) if keys else empty
+        targets = np.concatenate(targets) if targets else empty
+        depth = np.concatenate(depths)
+
+        # Failure links (longest proper suffix that is a node) and output links (nearest terminal
+        # node on the failure chain), depth by depth
+        is_terminal = np.zeros(n_nodes, dtype=bool)
+        is_terminal[node_of_term[lengths > 0]] = True
+        fail = np.zeros(n_nodes, dtype=np.int64)
+        out_link = np.full(n_nodes, -1, dtype=np.int64)
+        for level_children, level_parents, level_labels in zip(levels, parents, labels):
+            candidates = fail[level_parents]
+            candidates[level_parents == 0] = -1  # Nodes of depth 1 fail to the root
+            resolved = np.zeros(len(level_children), dtype=np.int64)
+            pending = np.flatnonzero(candidates >= 0)
+            while len(pending):
+                found = _lookup(keys, targets, candidates[pending] * n_vocabulary + level_labels[pending])
+                resolved[pending[found >= 0]] = found[found >= 0]
+                at_root = (found < 0) & (candidates[pending] == 0)
+                pending = pending[(found < 0) & ~at_root]
+                candidates[pending] = fail[candidates[pending]]
+            fail[level_children] = resolved
+            out_link[level_children] = np.where(is_terminal[resolved], resolved, out_link[resolved])
+
+        # Entries of the terminal nodes
+        has_tokens = lengths[term_ids] > 0
+        entry_nodes = node_of_term[term_ids[has_tokens]]
+        order = np.argsort(entry_nodes, kind="stable")
+        entry_indptr = np.zeros(n_nodes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(entry_nodes, minlength=n_nodes), out=entry_indptr[1:])
+        entries = df[has_tokens].iloc[order]
+        tag_ids, semantic_tags = pd.factorize(entries.semantic_tag.astype(str))
+        language_ids, languages = pd.factorize(entries.language.astype(str))
+        metadata = {"version": AUTOMATON_VERSION, "token_pattern": TOKEN_PATTERN, "normalization": list(normalization),
+                    "semantic_tags": list(semantic_tags), "languages": list(languages),
+                    "terms": int(is_terminal.sum()), "states": int(n_nodes)}
+        return cls({token: i for i, token in enumerate(vocabulary)}, metadata, keys, targets, fail, out_link,
+                   depth, entry_indptr, entries.code.values.astype(np.int64), tag_ids.astype(np.int16),
+                   entries.mainterm.values.astype(bool), language_ids.astype(np.int16))
+
+    def save(self, directory):
+        """Save the automaton as .npy arrays, the vocabulary and a metadata file inside a directory."""
+        os.makedirs(directory, exist_ok=True)
+        for name in ARRAY_NAMES:
+            np.save(os.path.join(directory, name + ".npy"), getattr(self, name))
+        tokens = sorted(self.vocabulary, key=self.vocabulary.get)
+        with open(os.path.join(directory, VOCABULARY_FILE), "w", encoding="utf-8") as f:
+            f.write("\n".join(tokens))
+        with open(os.path.join(directory, METADATA_FILE), "w", encoding="utf-8") as f:
+            json.dump(self.metadata, f, indent=1, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, directory, mmap_mode="r"):
+        """Load an automaton saved with TermAutomaton.save. By default the arrays are memory-mapped."""
+        with open(os.path.join(directory, METADATA_FILE), encoding="utf-8") as f:
+            metadata = json.load(f)
+        if metadata.get("version") != AUTOMATON_VERSION:
+            raise ValueError("Automaton {} was saved by another version of gaznomed".format(directory))
+        with open(os.path.join(directory, VOCABULARY_FILE), encoding="utf-8") as f:
+            content = f.read()
+        vocabulary = {token: i for i, token in enumerate(content.split("\n"))} if content else dict()
+        arrays = [np.load(os.path.join(directory, name + ".npy"), mmap_mode=mmap_mode) for name in ARRAY_NAMES]
+        return cls(vocabulary, metadata, *arrays)
+
+    def tokenize(self, text):
+        """
+        Tokens of a text with the normalization of the terms.
+
+        Returns:
+            list: (start, end, token id) of each token, token id -1 for the tokens that are not in any term
+        """
+        tokens = [(m.start(), m.end(), normalize_text(m.group(), self.normalization).strip()) for m in TOKEN_REGEX.finditer(text)]
+        return [(start, end, self.vocabulary.get(token, -1)) for start, end, token in tokens if token]
+
+    def _entries(self, node, start, end):
+        for i in range(int(self.entry_indptr[node]), int(self.entry_indptr[node + 1])):
+            yield Match(start, end, int(self.entry_codes[i]), self.semantic_tags[self.entry_tags[i]],
+                        bool(self.entry_mainterm[i]), self.languages[self.entry_languages[i]])
+
+    def iter_matches(self, text):
+        """
+        Scan a text once and yield every occurrence of a term (overlapping occurrences included).
+
+        Yields:
+            Match: start and end character offsets in the text and the entry of the term
+        """
+        tokens = self.tokenize(text)
+        n_vocabulary = max(len(self.vocabulary), 1)
+        keys, targets, fail = self.keys, self.targets, self.fail
+        n_keys = len(keys)
+        state = 0
+        for i, (_, end, token) in enumerate(tokens):
+            if token < 0:
+                state = 0
+                continue
+            while True:
+                key = state * n_vocabulary + token
+                position = int(np.searchsorted(keys, key)) if n_keys else 0
+                if position < n_keys and keys[position] == key:
+                    state = int(targets[position])
+                    break
+                if state == 0:
+                    break
+                state = int(fail[state])
+            node = state if self.entry_indptr[state + 1] > self.entry_indptr[state] else int(self.out_link[state])
+            while node > 0:
+                yield from self._entries(node, tokens[i - int(self.depth[node]) + 1][0], end)
+                node = int(self.out_link[node])
+
+    def find(self, text, longest=True):
+        """
+        Occurrences of the terms in a text.
+
+        Args:
+            text (str): Text to scan
+            longest (bool, optional): Only keep the leftmost longest non-overlapping occurrences
+                                      (all the entries of each kept span are returned).
+
+        Returns:
+            list: Match tuples sorted by position
+        """
+        matches = sorted(self.iter_matches(text), key=lambda m: (m.start, -m.end, m.code))
+        if not longest:
+            return matches
+        output, last_end, kept_span = [], -1, None
+        for match in matches:
+            if (match.start, match.end) == kept_span:
+                output.append(match)
+            elif match.start >= last_end:
+                output.append(match)
+                kept_span, last_end = (match.start, match.end), match.end
+        return output
+
@@ -0,0 +1,169 @@
+"""
+This module contains an on-disk cache of the parsed RF2 files. Each RF2 file gets its own
+cache entry, keyed by its path, size, modification time and content hash, where the parsed
+tables (pickled dataframes) and hierarchy arrays (.npy/.npz files) are stored. Repeated runs
+against the same release load those files instead of parsing the RF2 files again.
+"""
+import hashlib, json, os, pickle, shutil
+import pandas as pd
+
+# Increase it when the format of the cached objects changes
+CACHE_VERSION = 2
+FINGERPRINTS_FILE = "fingerprints.json"
+
+
+def content_hash(path, block_size=16 * 1024 * 1024):
+    """Return the blake2b hash of the content of a file."""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def file_fingerprint(cache_dir, path):
+    """
+    Return the fingerprint (path, size, mtime and content hash) of a file. Content hashes are
+    remembered in the cache directory, so a file is only hashed again if its path, size or
+    modification time change.
+
+    Args:
+        cache_dir (str): Cache directory. If it is None, the file is always hashed.
+        path (str): Path to the file
+
+    Returns:
+        dict: Fingerprint of the file
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    fingerprint = {"path": path, "size": stat.st_size, "mtime": stat.st_mtime_ns}
+    if cache_dir is None:
+        fingerprint["hash"] = content_hash(path)
+        return fingerprint
+    fingerprints_path = os.path.join(cache_dir, FINGERPRINTS_FILE)
+    fingerprints = dict()
+    if os.path.isfile(fingerprints_path):
+        with open(fingerprints_path) as f:
+            fingerprints = json.load(f)
+    known = fingerprints.get(path)
+    if known is not None and known["size"] == stat.st_size and known["mtime"] == stat.st_mtime_ns:
+        fingerprint["hash"] = known["hash"]
+        return fingerprint
+    print("Hashing {}".format(path))
+    fingerprint["hash"] = content_hash(path)
+    fingerprints[path] = fingerprint
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(fingerprints_path + ".tmp", "w") as f:
+        json.dump(fingerprints, f, indent=1)
+    os.replace(fingerprints_path + ".tmp", fingerprints_path)
+    return fingerprint
+
+
+def matches_fingerprint(fingerprint, path):
+    """
+    Check that a file has the content of a fingerprint (see file_fingerprint), wherever it is now.
+    The file is only hashed if its size matches and its modification time changed.
+
+    Args:
+        fingerprint (dict): Fingerprint of the file the object was derived from
+        path (str): Path to the file
+
+    Returns:
+        bool
+    """
+    stat = os.stat(path)
+    if stat.st_size != fingerprint["size"]:
+        return False
+    if stat.st_mtime_ns == fingerprint["mtime"]:
+        return True
+    return content_hash(path) == fingerprint["hash"]
+
+
+def cache_entry(cache_dir, rf2_path):
+    """
+    Return the cache directory of a RF2 file, creating it if needed.
+
+    Args:
+        cache_dir (str): Cache directory
+        rf2_path (str): Path to the RF2 file
+
+    Returns:
+        str: Path of the cache entry
+    """
+    fingerprint = file_fingerprint(cache_dir, rf2_path)
+    key = hashlib.blake2b(json.dumps([CACHE_VERSION, fingerprint], sort_keys=True).encode(), digest_size=16).hexdigest()
+    entry = os.path.join(cache_dir, "{}-{}".format(os.path.basename(rf2_path), key))
+    if not os.path.isdir(entry):
+        os.makedirs(entry)
+        with open(os.path.join(entry, "fingerprint.json"), "w") as f:
+            json.dump(fingerprint, f, indent=1)
+    return entry
+
+
+def save_pickle(obj, path):
+    with open(path, "wb") as f:
+        pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load_pickle(path):
+    with open(path, "rb") as f:
+        return pickle.load(f)
+
+
+def save_dataframe(df, path):
+    df.to_pickle(path)
+
+
+def load_or_build(cache_dir, rf2_path, name, build, save=save_pickle, load=load_pickle):
+    """
+    Load an object derived from a RF2 file from the cache, or build it and store it in the cache.
+
+    Args:
+        cache_dir (str): Cache directory. If it is None, the object is always built.
+        rf2_path (str): Path to the RF2 file the object is derived from
+        name (str): Name of the object inside the cache entry of the file
+        build (callable): Function without arguments that builds the object
+        save (callable, optional): Function (obj, path) that writes the object. Defaults to pickle.
+        load (callable, optional): Function (path) that reads the object. Defaults to pickle.
+
+    Returns:
+        The object
+    """
+    if cache_dir is None:
+        return build()
+    target = os.path.join(cache_entry(cache_dir, rf2_path), name)
+    if os.path.exists(target):
+        print("Loading {} from cache {}".format(name, target))
+        return load(target)
+    obj = build()
+    # Write to a temporary path first, so an interrupted run does not leave a corrupt entry
+    save(obj, target + ".tmp")
+    os.replace(target + ".tmp", target)
+    return obj
+
+
+def load_or_build_dataframe(cache_dir, rf2_path, name, build):
+    """load_or_build for pandas dataframes."""
+    return load_or_build(cache_dir, rf2_path, name, build, save=save_dataframe, load=pd.read_pickle)
+
+
+def clear_cache(cache_dir, rf2_path=None):
+    """
+    Remove cached objects.
+
+    Args:
+        cache_dir (str): Cache directory
+        rf2_path (str, optional): If given, only the entries of this RF2 file are removed.
+                                  Otherwise the whole cache is removed.
+    """
+    if not os.path.isdir(cache_dir):
+        return
+    if rf2_path is None:
+        shutil.rmtree(cache_dir)
+        print("Removed cache {}".format(cache_dir))
+        return
+    prefix = os.path.basename(rf2_path) + "-"
+    for name in os.listdir(cache_dir):
+        if name.startswith(prefix):
+            shutil.rmtree(os.path.join(cache_dir, name))
+            print("Removed cache entry {}".format(name))
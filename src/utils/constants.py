@@ -1,3 +1,5 @@
+import re
+
 SCT_TAGS_SPANISH = ["estructura corporal",
                     "célula",
                     "estructura celular",
@@ -203,4 +205,25 @@ ADDITIONAL_ES_SCT = ["concepto no activo",
                      "SNOMED RT+CTV3", # ROOT of snomed
                      "concepto especial", 
                      "metadato"
-                     ]
\ No newline at end of file
+                     ]
+
+# Description typeIds (SCTIDs are read as int64)
+FSN_TYPE_ID = 900000000000003001 # Fully specified name
+SYNONYM_TYPE_ID = 900000000000013009
+
+# Relationship typeIds
+IS_A_TYPE_ID = 116680003
+
+# Lookups of the valid semantic tags of each language (tag in the descriptions -> english tag)
+SEMANTIC_TAGS_ES2EN = {tag: SCT_TAG_ES2EN[tag] for tag in SCT_TAGS_SPANISH + ADDITIONAL_ES_SCT}
+SEMANTIC_TAGS_EN2EN = {tag: tag for tag in SCT_TAGS_ENGLISH + ADDITIONAL_EN_SCT}
+VALID_SEMANTIC_TAGS = frozenset(SEMANTIC_TAGS_ES2EN) | frozenset(SEMANTIC_TAGS_EN2EN)
+# Semantic tags of the output (categories of the semantic_tag column)
+OUTPUT_SEMANTIC_TAGS = sorted(set(SEMANTIC_TAGS_EN2EN.values()))
+# Semantic tag candidate: text between parenthesis at the end of a description
+SEMANTIC_TAG_REGEX = re.compile(r"\s*\(([^()]*)\)$")
+
+# Columns of the gazetteer
+GAZETTEER_COLUMNS = ["code","term","semantic_tag","mainterm","language"]
+# Output formats of the gazetteer (see utils.writer)
+OUTPUT_FORMATS = ["tsv", "tsv.gz", "parquet", "jsonl"]
@@ -0,0 +1,173 @@
+"""
+This module contains a compact representation of the Snomed-CT hierarchy. SCTIDs are mapped
+to dense int32 indices and the parents and children of each concept are stored as NumPy
+CSR (compressed sparse row) arrays, which is an order of magnitude lighter than a networkx
+graph keyed by strings.
+"""
+import os
+import numpy as np
+
+ARRAY_NAMES = ["codes", "children_indptr", "children_indices", "parents_indptr", "parents_indices"]
+
+
+def _csr_from_pairs(rows, cols, n):
+    """Build the (indptr, indices) arrays of a CSR adjacency from (row, col) index pairs."""
+    order = np.lexsort((cols, rows))
+    indices = cols[order].astype(np.int32)
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=n), out=indptr[1:])
+    return indptr, indices
+
+
+def _gather(indptr, indices, nodes):
+    """Return the concatenation of the adjacency lists of the given nodes."""
+    starts = indptr[nodes]
+    lengths = indptr[nodes + 1] - starts
+    total = int(lengths.sum())
+    if total == 0:
+        return np.empty(0, dtype=np.int32)
+    # Position of each gathered element inside the indices array
+    offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    return indices[offsets + np.arange(total)]
+
+
+class CSRGraph:
+    """
+    Snomed-CT hierarchy over dense integer indices.
+
+    Attributes:
+        codes (np.ndarray): Sorted int64 SCTIDs. The index of a code in this array is its dense index.
+        children_indptr, children_indices (np.ndarray): CSR adjacency from each concept to its children.
+        parents_indptr, parents_indices (np.ndarray): CSR adjacency from each concept to its parents.
+    """
+
+    def __init__(self, codes, children_indptr, children_indices, parents_indptr, parents_indices):
+        self.codes = codes
+        self.children_indptr = children_indptr
+        self.children_indices = children_indices
+        self.parents_indptr = parents_indptr
+        self.parents_indices = parents_indices
+
+    @classmethod
+    def from_edges(cls, sources, destinations, root_concept_code=138875005):
+        """
+        Build the graph from "is a" edges (source is a child of destination).
+
+        Args:
+            sources (array-like): SCTIDs of the children
+            destinations (array-like): SCTIDs of the parents
+            root_concept_code (int, optional): Snomed-CT root code, always included in the graph.
+        """
+        sources = np.asarray(sources, dtype=np.int64)
+        destinations = np.asarray(destinations, dtype=np.int64)
+        codes = np.unique(np.concatenate([sources, destinations, np.array([int(root_concept_code)], dtype=np.int64)]))
+        # Remove repeated edges (the same pair with different relationship ids)
+        pairs = np.unique(np.stack([np.searchsorted(codes, destinations), np.searchsorted(codes, sources)], axis=1), axis=0)
+        parent_idx, child_idx = pairs[:, 0], pairs[:, 1]
+        n = len(codes)
+        children_indptr, children_indices = _csr_from_pairs(parent_idx, child_idx, n)
+        parents_indptr, parents_indices = _csr_from_pairs(child_idx, parent_idx, n)
+        return cls(codes, children_indptr, children_indices, parents_indptr, parents_indices)
+
+    def save(self, directory):
+        """Save the arrays of the graph as .npy files inside a directory."""
+        os.makedirs(directory, exist_ok=True)
+        for name in ARRAY_NAMES:
+            np.save(os.path.join(directory, name + ".npy"), getattr(self, name))
+
+    @classmethod
+    def load(cls, directory, mmap_mode=None):
+        """Load a graph saved with CSRGraph.save. Use mmap_mode="r" to memory-map the arrays."""
+        return cls(*[np.load(os.path.join(directory, name + ".npy"), mmap_mode=mmap_mode) for name in ARRAY_NAMES])
+
+    def __len__(self):
+        return len(self.codes)
+
+    @property
+    def number_of_edges(self):
+        return len(self.children_indices)
+
+    def index_of(self, codes):
+        """
+        Map SCTIDs to dense indices.
+
+        Returns:
+            np.ndarray: int32 indices, -1 for the codes that are not in the graph.
+        """
+        codes = np.atleast_1d(np.asarray(codes, dtype=np.int64))
+        positions = np.minimum(np.searchsorted(self.codes, codes), len(self.codes) - 1)
+        return np.where(self.codes[positions] == codes, positions, -1).astype(np.int32)
+
+    def children(self, nodes):
+        """Dense indices of the children of the given dense indices."""
+        return _gather(self.children_indptr, self.children_indices, np.atleast_1d(nodes))
+
+    def parents(self, nodes):
+        """Dense indices of the parents of the given dense indices."""
+        return _gather(self.parents_indptr, self.parents_indices, np.atleast_1d(nodes))
+
+    def descendants_mask(self, nodes):
+        """
+        Breadth-first search over the children arrays starting from several nodes at once.
+
+        Args:
+            nodes (np.ndarray): Dense indices of the subtree roots
+
+        Returns:
+            np.ndarray: Boolean mask over the dense indices (roots included)
+        """
+        visited = np.zeros(len(self.codes), dtype=bool)
+        frontier = np.unique(np.asarray(nodes, dtype=np.int32))
+        visited[frontier] = True
+        while len(frontier):
+            frontier = np.unique(self.children(frontier))
+            frontier = frontier[~visited[frontier]]
+            visited[frontier] = True
+        return visited
+
+    def descendants(self, codes):
+        """
+        Return the SCTIDs of the subtrees of the given codes (including the codes themselves).
+        Codes that are not in the graph are ignored.
+        """
+        nodes = self.index_of(codes)
+        if (nodes < 0).any():
+            print("WARNING: codes {} are not in the hierarchy".format(
+                np.atleast_1d(np.asarray(codes, dtype=np.int64))[nodes < 0].tolist()))
+        return self.codes[self.descendants_mask(nodes[nodes >= 0])]
+
+    def subtree_pairs(self, codes):
+        """
+        Label the subtrees of several codes at once: a multi-source breadth-first search over
+        (concept, root) pairs. All the roots advance in the same vectorized step, so the
+        descendants they share are expanded together instead of in one traversal per root, and
+        each (concept, root) pair is visited once. Codes that are not in the graph are ignored.
+
+        Returns:
+            (np.ndarray, np.ndarray): int64 SCTIDs of the concepts of the subtrees (roots included) and of the
+                                      roots they descend from, one pair per concept and root, sorted by concept and root
+        """
+        roots = np.unique(np.asarray(codes, dtype=np.int64))
+        nodes = self.index_of(roots)
+        if (nodes < 0).any():
+            print("WARNING: codes {} are not in the hierarchy".format(roots[nodes < 0].tolist()))
+        roots, nodes = roots[nodes >= 0], nodes[nodes >= 0]
+        n_roots = max(len(roots), 1)
+        # Each pair is encoded as concept * n_roots + root position, so sorted keys are sorted pairs
+        frontier = nodes.astype(np.int64) * n_roots + np.arange(len(roots))
+        seen = np.sort(frontier)
+        while len(frontier):
+            concepts, positions = np.divmod(frontier, n_roots)
+            lengths = self.children_indptr[concepts + 1] - self.children_indptr[concepts]
+            keys = np.sort(_gather(self.children_indptr, self.children_indices, concepts).astype(np.int64) * n_roots
+                           + np.repeat(positions, lengths))
+            keys = keys[np.concatenate([[True], keys[1:] != keys[:-1]])] if len(keys) else keys
+            if len(seen):
+                found = seen[np.minimum(np.searchsorted(seen, keys), len(seen) - 1)] == keys
+                keys = keys[~found]
+            # Merge of two sorted runs (timsort is linear on them)
+            seen = np.sort(np.concatenate([seen, keys]), kind="stable")
+            frontier = keys
+        concepts, positions = np.divmod(seen, n_roots)
+        return self.codes[concepts], roots[positions]
+
@@ -2,51 +2,80 @@
 This module contains functions to load the Snomed-CT ontology as a multigraph, and recover
 subtrees of the graph given a code.
 """
-from tqdm import tqdm
-import networkx as nx
+import os
+import numpy as np
+from utils.tabular_read import get_active_edges
+from utils.csr_graph import CSRGraph
+from utils.subsumption import SubsumptionIndex
+from utils.cache import file_fingerprint, matches_fingerprint
 
 
-def load_ontology(file_name_rel, root_concept_code="138875005", relation_types = ["116680003"]):
+def ontology_from_edges(edges, root_concept_code=138875005):
+    """Function to build the netowrkx model from a table of active relationships.
+    Args:
+        edges (pd.DataFrame): Active relationships with the columns id, sourceId and destinationId
+                              (see utils.tabular_read.get_active_edges)
+        root_concept_code (int, optional): snomed code of the root of the ontology. Defaults to 138875005.
+    Returns:
+        Networkx DiGraph: SnomedCT model in a NetworkxDigraph format.
+    """
+    import networkx as nx
+    ontology = nx.MultiDiGraph()
+    ontology.add_node(int(root_concept_code))
+    ontology.add_edges_from(zip(edges.destinationId, edges.sourceId, edges.id))
+    return ontology
+
+
+def csr_from_edges(edges, root_concept_code=138875005):
+    """Function to build the compact CSR graph from a table of active relationships.
+    Args:
+        edges (pd.DataFrame): Active relationships with the columns sourceId and destinationId
+                              (see utils.tabular_read.get_active_edges)
+        root_concept_code (int, optional): snomed code of the root of the ontology. Defaults to 138875005.
+    Returns:
+        CSRGraph: SnomedCT hierarchy with dense integer indices.
+    """
+    return CSRGraph.from_edges(edges.sourceId.astype("int64").values, edges.destinationId.astype("int64").values,
+                               root_concept_code=root_concept_code)
+
+
+def load_ontology(file_name_rel, root_concept_code=138875005, relation_types = [116680003], use_snapshot=True):
     """Function to load SnomecCT relationships from RF2 format to netowrkx model.
     Args:
         file_name_rel (str): Path to the SnomedCT Relationship file in RF2 format
-        root_concept_code (str, optional): snomed code of the code from which you want to generate
+        root_concept_code (int, optional): snomed code of the code from which you want to generate
                                            the ontology file (For example if we want the branch
                                            "Pharmaceutical / biologic product" we would use the code
                                            "373873005", if we want the whole snomed ontology we would
-                                           use the code "138875005").Defaults to "138875005".
-        relation_types (str, optional): Type of relationship to consider when building the ontology.
-                                        Use string "116680003" if you only want to consider "Is a"
+                                           use the code "138875005").Defaults to 138875005.
+        relation_types (list or str, optional): Type of relationship to consider when building the ontology.
+                                        Use [116680003] if you only want to consider "Is a"
                                         relationships, use "all" if you want to consider all types
-                                        of relationships (including concept model attributes).Defaults to "116680003".
+                                        of relationships (including concept model attributes).Defaults to [116680003].
+        use_snapshot (bool, optional): Read the Snapshot file of the release if it is present.
     Returns:
         Networkx DiGraph: SnomedCT model in a NetworkxDigraph format.
     
     This code is based on the one written by @emreg00 (https://github.com/emreg00/toolbox/blob/master/parse_snomedct.py)
     """
-    ontology = nx.MultiDiGraph()
-    f = open(file_name_rel)
-    header = f.readline().strip("\n")
-    col_to_idx = dict((val.lower(), i) for i, val in enumerate(header.split("\t")))
-    ontology.add_node("138875005")
-    for line in f:
-        words = line.strip("\n").split("\t")
-        #if relation_types == "116680003": #"Is a" relationship code
-        if (words[col_to_idx["typeid"]] in relation_types) & (words[col_to_idx["active"]] == "0"):
-            source_id = words[col_to_idx["sourceid"]]
-            target_id = words[col_to_idx["destinationid"]]
-            try:
-                ontology.remove_edge(target_id, source_id,key=words[col_to_idx["id"]])
-            except:
-                print("Removing an already removed relation id {}".format(words[col_to_idx["id"]]))
-        elif (words[col_to_idx["typeid"]] in relation_types) & (words[col_to_idx["active"]] == "1"):
-            source_id = words[col_to_idx["sourceid"]]
-            target_id = words[col_to_idx["destinationid"]]
-            ontology.add_node(source_id)
-            ontology.add_edge(target_id, source_id,key=words[col_to_idx["id"]])
+    edges = get_active_edges(file_name_rel, relation_types=relation_types, use_snapshot=use_snapshot)
+    return ontology_from_edges(edges, root_concept_code=root_concept_code)
 
-    return ontology
 
+def load_ontology_csr(file_name_rel, root_concept_code=138875005, relation_types = [116680003], use_snapshot=True):
+    """Function to load SnomecCT relationships from RF2 format to a compact CSR graph. The latest
+    version of each relationship (newest effectiveTime) is used.
+    Args:
+        file_name_rel (str): Path to the SnomedCT Relationship file in RF2 format
+        root_concept_code (int, optional): snomed code of the root of the ontology. Defaults to 138875005.
+        relation_types (list, optional): Type of relationships to consider when building the ontology.
+                                         Defaults to [116680003] ("Is a" relationships).
+        use_snapshot (bool, optional): Read the Snapshot file of the release if it is present.
+    Returns:
+        CSRGraph: SnomedCT hierarchy with dense integer indices.
+    """
+    edges = get_active_edges(file_name_rel, relation_types=relation_types, use_snapshot=use_snapshot)
+    return csr_from_edges(edges, root_concept_code=root_concept_code)
 
 
 def subtree_sucessors_code_list(ontology, code):
@@ -56,10 +85,11 @@ def subtree_sucessors_code_list(ontology, code):
     
     Args:
     ontology ([networkx.MultiDigraph]): ontologías calculada
-    code ([str]): Código del que se quiere obtener la lista de códigos de su subarbol
+    code ([int]): Código del que se quiere obtener la lista de códigos de su subarbol
     
     Nota: También incluye el código de la entrada (code)
     """
+    import networkx as nx
     # Get sucesores
     resultado_dict = nx.dfs_successors(ontology, source=code)
     # Cogemos la lista de listas de conceptos 
@@ -67,26 +97,96 @@ def subtree_sucessors_code_list(ontology, code):
     lista_smallest_edges_flatten = [item for sublist in lista_smallest_edges for item in sublist]
     # Lista de hijos directos
     lista_nodes = list(resultado_dict.keys())
-    # Unimos todo
-    lista_end = lista_smallest_edges_flatten + lista_nodes
+    # Unimos todo. dfs_successors devuelve {} para un código sin hijos, así que se añade el propio código
+    lista_end = lista_smallest_edges_flatten + lista_nodes + [code]
     # Devolmenos una lista de elementos únicos
     return list(set(lista_end))
 
 
 def get_sucessors_from_list(g, list_codes):
-    """_summary_
+    """Get the codes of the subtrees of a list of codes (including the codes themselves).
 
     Args:
-        graph  ([networkx.MultiDigraph]): ontologías calculada
+        graph  ([networkx.MultiDigraph, CSRGraph or SubsumptionIndex]): ontologías calculada
         list_codes (list): List of the codes from which the user wishes to obtain their subtrees
 
     Returns:
-        list of codes
+        np.ndarray: Sorted int64 codes
     """
+    if isinstance(g, (CSRGraph, SubsumptionIndex)):
+        return g.descendants([int(code) for code in list_codes])
     lista_codigos_subtree = list()
-    list_codes = [str(code) for code in list_codes]
+    list_codes = [int(code) for code in list_codes]
     for subtree in list_codes:
-        lista_codigos_subtree.append(subtree_sucessors_code_list(g, subtree))
-    # Hacemos set y pasamos valores a int
-    lista_codigos_subtree_flatten = [int(i) for i in list(set([i for sublist in lista_codigos_subtree for i in sublist]))]
-    return lista_codigos_subtree_flatten
\ No newline at end of file
+        lista_codigos_subtree.extend(subtree_sucessors_code_list(g, subtree))
+    return np.unique(np.array(lista_codigos_subtree, dtype=np.int64))
+
+
+def get_subtree_roots(g, list_codes):
+    """Get the codes of the subtrees of a list of codes, labeled with the codes (roots) whose subtrees
+    contain them. With a CSRGraph all the subtrees are traversed in a single multi-source pass, and
+    with a SubsumptionIndex they are read from the closure (see subtree_pairs).
+
+    Args:
+        g ([networkx.MultiDigraph, CSRGraph or SubsumptionIndex]): Snomed-CT hierarchy
+        list_codes (list): Codes of the roots of the subtrees
+
+    Returns:
+        (np.ndarray, np.ndarray): int64 codes of the subtrees (roots included) and of their roots, one pair per
+                                  code and root, sorted by code and root
+    """
+    list_codes = sorted(set(int(code) for code in list_codes))
+    if isinstance(g, (CSRGraph, SubsumptionIndex)):
+        return g.subtree_pairs(list_codes)
+    subtrees = [np.unique(np.array(subtree_sucessors_code_list(g, root), dtype=np.int64)) for root in list_codes]
+    codes = np.concatenate(subtrees) if subtrees else np.empty(0, dtype=np.int64)
+    roots = np.repeat(np.array(list_codes, dtype=np.int64), [len(subtree) for subtree in subtrees])
+    order = np.lexsort((roots, codes))
+    return codes[order], roots[order]
+
+
+def load_subsumption_index(index_path, g=None, relation_paths=None, cache_dir=None):
+    """Load a subsumption index from disk, or compute it from a CSR graph and save it
+    if the file does not exist yet. The index only has to be computed once per release.
+
+    The fingerprints of the relation files are saved in the index (see utils.cache.file_fingerprint),
+    and an existing index that was built from other relation files is not used.
+
+    Args:
+        index_path (str): Path to the .npz file of the index
+        g (CSRGraph or callable, optional): Hierarchy used to compute the index if the file does not exist,
+                                            or function without arguments that builds it (only called if needed)
+        relation_paths (list, optional): Relation files of the release. If given, the index must have been built from them.
+        cache_dir (str, optional): Cache directory where the hashes of the relation files are remembered
+
+    Returns:
+        SubsumptionIndex
+    """
+    if os.path.isfile(index_path):
+        if relation_paths is not None:
+            sources = SubsumptionIndex.saved_sources(index_path)
+            if sources is None or len(sources) != len(relation_paths) or \
+                    not all(matches_fingerprint(source, path) for source, path in zip(sources, relation_paths)):
+                raise ValueError("Subsumption index {} was not built from the relation files {}. Remove it or give "
+                                 "another path to compute it again".format(index_path, ", ".join(relation_paths)))
+        return SubsumptionIndex.load(index_path)
+    if g is None:
+        raise FileNotFoundError("Subsumption index {} does not exist and no graph was given".format(index_path))
+    index = SubsumptionIndex.from_graph(g() if callable(g) else g)
+    sources = None if relation_paths is None else [file_fingerprint(cache_dir, path) for path in relation_paths]
+    index.save(index_path, sources)
+    return index
+
+
+def is_descendant_of(index, list_codes, ancestor_codes):
+    """Bulk "is a" test with a subsumption index.
+
+    Args:
+        index (SubsumptionIndex): Transitive closure of the hierarchy
+        list_codes (list): Codes to test
+        ancestor_codes (list or int): Ancestor to test for each code (or a single ancestor for all of them)
+
+    Returns:
+        np.ndarray: Boolean array, True when the code is the ancestor code or one of its descendants
+    """
+    return index.is_a([int(code) for code in list_codes], np.asarray(ancestor_codes, dtype=np.int64))
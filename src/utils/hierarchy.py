@@ -0,0 +1,151 @@
+"""
+This module contains hierarchy-aware columns of the gazetteer, computed in bulk for every
+concept of a CSRGraph in a single topological pass (one vectorized step per level):
+
+    depth       Length of the shortest "is a" path from the root (0 for the root, -1 for the
+                concepts that are not under the root)
+    top_level   Top-level concepts (children of the root) the concept descends from, separated by comma
+    parents     Direct parents of the concept, separated by comma
+
+It also contains the ancestor closure side table (one row per concept and ancestor), taken
+from a SubsumptionIndex, and the subtree_root column (the roots of a batch subtree query each
+concept descends from, separated by comma).
+"""
+import numpy as np
+import pandas as pd
+
+HIERARCHY_COLUMNS = ["depth", "top_level", "parents"]
+SUBTREE_ROOT_COLUMN = "subtree_root"
+# Separator of the codes of the top_level and parents columns
+CODE_SEPARATOR = ","
+
+
+def _join_codes(rows, codes, n):
+    """For each row in range(n), the codes of that row joined by CODE_SEPARATOR ("" if it has none). rows must be sorted."""
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=n), out=indptr[1:])
+    codes = codes.astype(str).tolist()
+    return np.array([CODE_SEPARATOR.join(codes[start:end]) for start, end in zip(indptr[:-1].tolist(), indptr[1:].tolist())],
+                    dtype=object)
+
+
+def _lookup(table_codes, codes):
+    """Positions of codes in the sorted table_codes, and whether each code is there."""
+    if len(table_codes) == 0:
+        return np.zeros(len(codes), dtype=np.int64), np.zeros(len(codes), dtype=bool)
+    positions = np.minimum(np.searchsorted(table_codes, codes), len(table_codes) - 1)
+    return positions, table_codes[positions] == codes
+
+
+def hierarchy_table(graph, root_concept_code=138875005):
+    """
+    Compute the hierarchy columns of every concept of the graph. Concepts are processed level
+    by level in topological order (a concept is processed once all its parents are), so the depth
+    and the top-level branches of a level are reduced from the ones of their parents at once.
+
+    Args:
+        graph (CSRGraph): Snomed-CT hierarchy
+        root_concept_code (int, optional): Snomed-CT root code. Defaults to 138875005.
+
+    Returns:
+        pd.DataFrame: Dataframe with the columns code (int64, sorted), depth (int32), top_level and parents
+    """
+    n = len(graph)
+    root = int(graph.index_of(root_concept_code)[0])
+    top_level = np.sort(graph.children(root)) if root >= 0 else np.empty(0, dtype=np.int32)
+    depth = np.full(n, -1, dtype=np.int32)
+    # branches[i, j]: concept i descends from the top-level concept top_level[j]
+    branches = np.zeros((n, len(top_level)), dtype=bool)
+    if root >= 0:
+        depth[root] = 0
+        branches[top_level, np.arange(len(top_level))] = True
+    unreachable = np.iinfo(np.int32).max
+    pending_parents = np.diff(graph.parents_indptr)
+    level = np.flatnonzero(pending_parents == 0).astype(np.int32)
+    processed = 0
+    while len(level):
+        parents_len = graph.parents_indptr[level + 1] - graph.parents_indptr[level]
+        with_parents = level[parents_len > 0]
+        if len(with_parents):
+            parents = graph.parents(with_parents)
+            starts = np.concatenate([[0], np.cumsum(parents_len[parents_len > 0])[:-1]])
+            parent_depth = np.where(depth[parents] >= 0, depth[parents], unreachable)
+            shortest = np.minimum.reduceat(parent_depth, starts)
+            depth[with_parents] = np.where(shortest < unreachable, shortest + 1, -1)
+            if len(top_level):
+                branches[with_parents] |= np.logical_or.reduceat(branches[parents], starts, axis=0)
+        processed += len(level)
+        # Next level: children whose parents have all been processed
+        children = graph.children(level)
+        np.subtract.at(pending_parents, children, 1)
+        level = np.unique(children[pending_parents[children] == 0]).astype(np.int32)
+    if processed < n:
+        raise ValueError("The hierarchy contains cycles")
+    branch_rows, branch_cols = np.nonzero(branches)
+    parent_rows = np.repeat(np.arange(n), np.diff(graph.parents_indptr))
+    return pd.DataFrame({"code": graph.codes, "depth": depth,
+                         "top_level": _join_codes(branch_rows, graph.codes[top_level][branch_cols], n),
+                         "parents": _join_codes(parent_rows, graph.codes[graph.parents_indices], n)})
+
+
+def add_hierarchy_columns(df, table):
+    """
+    Add the hierarchy columns to a table with a code column.
+
+    Args:
+        df (pd.DataFrame): Table with an int64 code column (e.g. a gazetteer)
+        table (pd.DataFrame): Output of hierarchy_table
+
+    Returns:
+        pd.DataFrame: df with the columns depth, top_level and parents (-1 and "" for unknown codes)
+    """
+    positions, known = _lookup(table.code.values, df.code.values)
+    return df.assign(depth=np.where(known, table.depth.values[positions], -1).astype(np.int32),
+                     top_level=np.where(known, table.top_level.values[positions], ""),
+                     parents=np.where(known, table.parents.values[positions], ""))
+
+
+def ancestor_table(index, codes):
+    """
+    Ancestor closure side table of the given codes.
+
+    Args:
+        index (SubsumptionIndex): Transitive closure of the hierarchy
+        codes (array-like): SCTIDs (e.g. the codes of a gazetteer)
+
+    Returns:
+        pd.DataFrame: One row per code and proper ancestor, with the int64 columns code and ancestor
+    """
+    codes, ancestors = index.ancestor_pairs(np.unique(np.asarray(codes, dtype=np.int64)))
+    return pd.DataFrame({"code": codes, "ancestor": ancestors})
+
+
+def subtree_root_table(codes, roots):
+    """
+    Subtree roots of each code of a batch subtree query.
+
+    Args:
+        codes, roots (np.ndarray): (code, root) pairs sorted by code (see utils.graph_read.get_subtree_roots)
+
+    Returns:
+        pd.DataFrame: Dataframe with the columns code (int64, sorted) and subtree_root (roots separated by comma)
+    """
+    unique_codes = np.unique(codes)
+    return pd.DataFrame({"code": unique_codes,
+                         SUBTREE_ROOT_COLUMN: _join_codes(np.searchsorted(unique_codes, codes), roots, len(unique_codes))})
+
+
+def add_subtree_root_column(df, table):
+    """
+    Add the subtree_root column to a table with a code column.
+
+    Args:
+        df (pd.DataFrame): Table with an int64 code column (e.g. a gazetteer)
+        table (pd.DataFrame): Output of subtree_root_table
+
+    Returns:
+        pd.DataFrame: df with the subtree_root column ("" for the codes that are not in any subtree)
+    """
+    positions, known = _lookup(table.code.values, df.code.values)
+    return df.assign(**{SUBTREE_ROOT_COLUMN: np.where(known, table[SUBTREE_ROOT_COLUMN].values[positions], "")})
+
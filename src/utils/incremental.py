@@ -0,0 +1,153 @@
+"""
+This module contains functions to update a gazetteer between Snomed-CT releases. The state of
+a run (the cached description and relationship tables it was built from) is saved next to its
+output; a later run compares the new release with that state and only re-derives the concepts
+whose descriptions, active status or position in the hierarchy changed.
+"""
+import json, os
+import numpy as np
+import pandas as pd
+from utils.csr_graph import CSRGraph
+from utils.cache import CACHE_VERSION
+from utils.tabular_read import isin_sorted, active_terms, active_edges, latest_versions_of_files
+from utils.writer import read_gazetteer_file
+from utils.constants import GAZETTEER_COLUMNS
+
+STATE_SUFFIX = ".state.json"
+CHANGES_SUFFIX = ".changes.tsv"
+
+
+def save_run_state(out_path, state):
+    """Save the state of a run (dictionary of paths and options) next to its output."""
+    with open(out_path + STATE_SUFFIX, "w") as f:
+        json.dump(dict(state, cache_version=CACHE_VERSION), f, indent=1)
+
+
+def load_run_state(out_path):
+    """
+    Load the state saved by a previous run.
+
+    Args:
+        out_path (str): Output path of the previous run
+
+    Returns:
+        dict: State of the run
+    """
+    state_path = out_path + STATE_SUFFIX
+    if not os.path.isfile(state_path):
+        raise FileNotFoundError("There is no state for {}. The previous run must be done with --cache_dir".format(out_path))
+    with open(state_path) as f:
+        state = json.load(f)
+    if state.get("cache_version") != CACHE_VERSION:
+        raise ValueError("The state of {} was saved by another version of gaznomed. Build it again with --cache_dir".format(out_path))
+    languages = [f["language"] for f in state["concept_files"]]
+    tables = [f.get("descriptions" if languages.count(f["language"]) == 1 else "description_versions")
+              for f in state["concept_files"]]
+    tables += [f.get("isa_edges" if len(state["relation_files"]) == 1 else "relationships") for f in state["relation_files"]]
+    for path in tables:
+        if path is None:
+            raise ValueError("The state of {} was saved by another version of gaznomed. Build it again with --cache_dir".format(out_path))
+        if not os.path.isfile(path):
+            raise FileNotFoundError("Cached table {} of the previous run does not exist".format(path))
+    return state
+
+
+def previous_descriptions(concept_files):
+    """
+    Active descriptions of each language of a previous run, combined as terminology.load_language_descriptions does.
+
+    Args:
+        concept_files (list): Concept files of the state of the run (see load_run_state)
+
+    Returns:
+        dict: language -> active descriptions
+    """
+    groups = dict()
+    for concept_file in concept_files:
+        groups.setdefault(concept_file["language"], []).append(concept_file)
+    return {language: pd.read_pickle(files[0]["descriptions"]) if len(files) == 1 else
+            active_terms(latest_versions_of_files([pd.read_pickle(f["description_versions"]) for f in files]))
+            for language, files in groups.items()}
+
+
+def previous_isa_edges(relation_files):
+    """Active "is a" edges of a previous run, combined as terminology.load_isa_edges does."""
+    if len(relation_files) == 1:
+        return pd.read_pickle(relation_files[0]["isa_edges"])
+    return active_edges(latest_versions_of_files([pd.read_pickle(f["relationships"]) for f in relation_files]))
+
+
+def read_gazetteer(paths, output_format="tsv"):
+    """Read the (one or several) files of a gazetteer."""
+    return pd.concat([read_gazetteer_file(path, output_format) for path in paths], ignore_index=True)[GAZETTEER_COLUMNS]
+
+
+def _changed_rows(previous, current, columns):
+    """Rows of previous and current (restricted to columns) that are not present in both tables."""
+    merged = previous[columns].drop_duplicates().merge(current[columns].drop_duplicates(), how="outer", indicator=True)
+    return merged[merged["_merge"] != "both"]
+
+
+def changed_description_concepts(previous_descriptions, descriptions):
+    """
+    Concepts with added, removed or modified active descriptions between two releases.
+
+    Args:
+        previous_descriptions, descriptions (pd.DataFrame): Outputs of active_terms_from_conceptRF2_file
+
+    Returns:
+        set: conceptIds (int)
+    """
+    changed = _changed_rows(previous_descriptions, descriptions, ["conceptId","languageCode","typeId","term"])
+    return set(changed.conceptId)
+
+
+def changed_hierarchy_concepts(previous_edges, edges, with_descendants):
+    """
+    Concepts whose active status or position in the hierarchy changed between two releases.
+
+    Args:
+        previous_edges, edges (pd.DataFrame): Active "is a" edges (see get_active_edges)
+        with_descendants (bool): Also return the descendants (in both releases) of the concepts whose
+                                 parents changed, because their subtree membership may change.
+
+    Returns:
+        set: conceptIds (int)
+    """
+    previous_codes = set(previous_edges.sourceId) | set(previous_edges.destinationId)
+    codes = set(edges.sourceId) | set(edges.destinationId)
+    affected = previous_codes ^ codes
+    sources = set(_changed_rows(previous_edges, edges, ["sourceId","destinationId"]).sourceId)
+    affected |= sources
+    if with_descendants and len(sources):
+        sources = np.array(sorted(sources), dtype=np.int64)
+        for table in (previous_edges, edges):
+            graph = CSRGraph.from_edges(table.sourceId.values, table.destinationId.values)
+            nodes = graph.index_of(sources)
+            affected |= set(graph.codes[graph.descendants_mask(nodes[nodes >= 0])].tolist())
+    return affected
+
+
+def apply_changes(previous_gazetteer, affected_codes, recomputed):
+    """
+    Replace the rows of the affected concepts of a gazetteer with their recomputed rows.
+
+    Args:
+        previous_gazetteer (pd.DataFrame): Gazetteer of the previous release
+        affected_codes (set or np.ndarray): Codes (int) whose rows were recomputed
+        recomputed (pd.DataFrame): New rows of the affected codes
+
+    Returns:
+        (pd.DataFrame, pd.DataFrame): Updated gazetteer and change report (rows with a "change"
+                                      column that is "added" or "removed")
+    """
+    affected_codes = np.unique(np.fromiter(affected_codes, dtype=np.int64, count=len(affected_codes)))
+    is_affected = isin_sorted(previous_gazetteer.code.values, affected_codes)
+    previous_rows = previous_gazetteer[is_affected]
+    recomputed = recomputed[GAZETTEER_COLUMNS]
+    updated = pd.concat([previous_gazetteer[~is_affected], recomputed], ignore_index=True)
+    changes = previous_rows.merge(recomputed, how="outer", indicator=True)
+    changes = changes[changes["_merge"] != "both"].copy()
+    changes["change"] = changes["_merge"].map({"left_only": "removed", "right_only": "added"}).astype(object)
+    changes = changes.drop(columns="_merge").sort_values(by=["code","change"]).reset_index(drop=True)
+    return updated, changes
@@ -0,0 +1,192 @@
+"""
+This module contains the per-stage instrumentation of the pipeline. Stages are marked in the code with
+
+    with stage("subtrees") as record:
+        codes = get_sucessors_from_list(g, roots)
+        record["rows"] = len(codes)
+
+While a MetricsRecorder is active (see MetricsRecorder.activate), each stage records its wall time,
+CPU time, RSS before and after it, peak RSS and row count. Stages that run several times (e.g. the
+writing of each chunk) are added up, and the time of a stage includes the stages nested in it.
+Optionally, each stage is profiled with cProfile (one .prof file per stage) and the peak of its
+Python allocations is traced with tracemalloc (slower). When no recorder is active, stage() only
+yields an empty record, so library code is instrumented without cost.
+
+The peak RSS of a stage is exact on Linux, where the peak of the process is reset when the stage
+starts. On other platforms it is the peak of the process up to the end of the stage.
+"""
+import json, os, sys, time, tracemalloc
+from contextlib import contextmanager
+
+# Recorder of the running process (None when the metrics are disabled)
+_active_recorder = None
+
+
+def _proc_status_mb(field):
+    """Memory field of /proc/self/status in MB (Linux only)."""
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1]) / 2 ** 10
+    raise ValueError(field)
+
+
+def peak_rss_mb():
+    """Peak resident set size of the process in MB."""
+    try:
+        return _proc_status_mb("VmHWM")
+    except (OSError, ValueError):
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in bytes on macOS and in KB on Linux
+        return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
+
+
+def rss_mb():
+    """Current resident set size of the process in MB (the peak if it is not available)."""
+    try:
+        return _proc_status_mb("VmRSS")
+    except (OSError, ValueError):
+        return peak_rss_mb()
+
+
+def reset_peak_rss():
+    """Reset the peak RSS of the process to its current RSS (Linux only, elsewhere the peak is kept)."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+class MetricsRecorder:
+    """
+    Metrics of the stages of a run.
+
+    Attributes:
+        stages (dict): Stage name -> metrics, in the order the stages were first run
+        profile_dir (str): Directory where the cProfile stats of each stage are saved, or None
+        trace_memory (bool): Trace the Python allocations of each stage with tracemalloc
+        wall_seconds, peak_rss_mb (float): Wall time and peak RSS of the whole run (set when it ends)
+    """
+
+    def __init__(self, profile_dir=None, trace_memory=False):
+        self.stages = dict()
+        self.profile_dir = profile_dir
+        self.trace_memory = trace_memory
+        self.wall_seconds = None
+        self.peak_rss_mb = None
+        self._profiles = dict()
+        self._open = []
+
+    @contextmanager
+    def activate(self):
+        """Record the stages run inside the block."""
+        global _active_recorder
+        previous, _active_recorder = _active_recorder, self
+        if self.profile_dir is not None:
+            os.makedirs(self.profile_dir, exist_ok=True)
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.wall_seconds = time.perf_counter() - start
+            self.peak_rss_mb = peak_rss_mb()
+            if self.trace_memory:
+                tracemalloc.stop()
+            _active_recorder = previous
+
+    def _peaks(self):
+        """Peak RSS and peak traced memory (MB) since the last reset."""
+        return peak_rss_mb(), tracemalloc.get_traced_memory()[1] / 2 ** 20 if self.trace_memory else 0.0
+
+    def _enter(self, name):
+        if self._open:
+            # The peaks are reset for the new stage: the ones of the open stage up to now are kept in its frame
+            parent = self._open[-1]
+            parent["peaks"] = tuple(map(max, parent["peaks"], self._peaks()))
+        frame = {"name": name, "peaks": (0.0, 0.0), "profile": None}
+        reset_peak_rss()
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+        # cProfile does not support nested profilers: nested stages are profiled by the outermost one
+        if self.profile_dir is not None and not self._open:
+            import cProfile
+            frame["profile"] = self._profiles.setdefault(name, cProfile.Profile())
+        self._open.append(frame)
+        frame["rss_before_mb"] = rss_mb()
+        frame["cpu"] = time.process_time()
+        frame["start"] = time.perf_counter()
+        if frame["profile"] is not None:
+            frame["profile"].enable()
+        return frame
+
+    def _exit(self, frame, record):
+        if frame["profile"] is not None:
+            frame["profile"].disable()
+        wall = time.perf_counter() - frame["start"]
+        cpu = time.process_time() - frame["cpu"]
+        self._open.pop()
+        peak, traced_peak = map(max, frame["peaks"], self._peaks())
+        if self._open:
+            # The peaks of the stage are also peaks of the stage it is nested in
+            parent = self._open[-1]
+            parent["peaks"] = tuple(map(max, parent["peaks"], (peak, traced_peak)))
+        metrics = self.stages.setdefault(frame["name"], {"calls": 0, "wall_seconds": 0.0, "cpu_seconds": 0.0,
+                                                         "rss_before_mb": frame["rss_before_mb"], "peak_rss_mb": 0.0})
+        metrics["calls"] += 1
+        metrics["wall_seconds"] += wall
+        metrics["cpu_seconds"] += cpu
+        metrics["rss_after_mb"] = rss_mb()
+        metrics["peak_rss_mb"] = max(metrics["peak_rss_mb"], peak)
+        if self.trace_memory:
+            metrics["traced_peak_mb"] = max(metrics.get("traced_peak_mb", 0.0), traced_peak)
+        if self._open:
+            metrics["parent"] = self._open[-1]["name"]
+        for key, value in record.items():
+            # Counts (rows, codes...) of a stage that runs several times are added up
+            metrics[key] = metrics[key] + value if key in metrics and isinstance(value, (int, float)) else value
+        if frame["profile"] is not None:
+            metrics["profile"] = os.path.join(self.profile_dir, "{}.prof".format(frame["name"]))
+            frame["profile"].dump_stats(metrics["profile"])
+
+    def to_dict(self):
+        return {"wall_seconds": self.wall_seconds, "peak_rss_mb": self.peak_rss_mb,
+                "stages": [dict(name=name, **metrics) for name, metrics in self.stages.items()]}
+
+    def save(self, path, **extra):
+        """Save the metrics as JSON, with extra top-level fields (e.g. the command line)."""
+        with open(path, "w") as f:
+            json.dump(dict(extra, **self.to_dict()), f, indent=1)
+
+    def summary(self):
+        """Table of the stages, one line per stage."""
+        lines = ["{:<28} {:>6} {:>10} {:>10} {:>12} {:>11}".format("stage", "calls", "wall (s)", "cpu (s)",
+                                                                  "peak RSS MB", "rows")]
+        for name, metrics in self.stages.items():
+            lines.append("{:<28} {:>6} {:>10.3f} {:>10.3f} {:>12.1f} {:>11}".format(
+                ("  " if "parent" in metrics else "") + name, metrics["calls"], metrics["wall_seconds"],
+                metrics["cpu_seconds"], metrics["peak_rss_mb"], metrics.get("rows", "")))
+        return "\n".join(lines)
+
+
+@contextmanager
+def stage(name):
+    """
+    Mark a stage of the pipeline. The yielded dict takes extra metrics of the stage (e.g. "rows").
+
+    Args:
+        name (str): Name of the stage. Stages with the same name are added up.
+    """
+    record = dict()
+    recorder = _active_recorder
+    if recorder is None:
+        yield record
+        return
+    frame = recorder._enter(name)
+    try:
+        yield record
+    finally:
+        recorder._exit(frame, record)
@@ -0,0 +1,73 @@
+"""
+This module contains the term normalization pipeline. A normalization is a chain of steps,
+applied in order:
+
+    casefold     Case folding ("Heart" -> "heart")
+    accents      Accent folding, unidecode style ("infección" -> "infeccion")
+    punctuation  Punctuation replaced with spaces ("T-cell" -> "T cell")
+    whitespace   Runs of whitespace squashed into a single space, and stripped
+
+Tables are normalized with vectorized string operations over their distinct terms, and single
+strings (for example the tokens of a text, see utils.automaton) with the same steps.
+"""
+import re, unicodedata
+
+NORMALIZATION_STEPS = ["casefold", "accents", "punctuation", "whitespace"]
+# Combining diacritical marks left by the NFKD decomposition
+COMBINING_MARKS = "[\u0300-\u036f\u1ab0-\u1aff\u1dc0-\u1dff\u20d0-\u20ff\ufe20-\ufe2f]"
+# Letters that the NFKD decomposition does not split into a base letter and a mark
+LETTER_FOLDING = str.maketrans({"æ": "ae", "Æ": "AE", "œ": "oe", "Œ": "OE", "ø": "o", "Ø": "O", "ß": "ss",
+                                "đ": "d", "Đ": "D", "ł": "l", "Ł": "L", "ı": "i"})
+PUNCTUATION = r"[^\w\s]"
+WHITESPACE = r"\s+"
+COMBINING_MARKS_REGEX = re.compile(COMBINING_MARKS)
+PUNCTUATION_REGEX = re.compile(PUNCTUATION)
+WHITESPACE_REGEX = re.compile(WHITESPACE)
+
+# Each step as (vectorized version over a pd.Series of strings, version over a single string)
+STEPS = {
+    "casefold": (lambda terms: terms.str.casefold(),
+                 lambda term: term.casefold()),
+    "accents": (lambda terms: terms.str.normalize("NFKD").str.replace(COMBINING_MARKS, "", regex=True).str.translate(LETTER_FOLDING),
+                lambda term: COMBINING_MARKS_REGEX.sub("", unicodedata.normalize("NFKD", term)).translate(LETTER_FOLDING)),
+    "punctuation": (lambda terms: terms.str.replace(PUNCTUATION, " ", regex=True),
+                    lambda term: PUNCTUATION_REGEX.sub(" ", term)),
+    "whitespace": (lambda terms: terms.str.replace(WHITESPACE, " ", regex=True).str.strip(),
+                   lambda term: WHITESPACE_REGEX.sub(" ", term).strip()),
+}
+
+
+def check_steps(steps):
+    """Raise a ValueError if a step of the chain is not one of NORMALIZATION_STEPS."""
+    unknown = [step for step in steps if step not in STEPS]
+    if unknown:
+        raise ValueError("Unknown normalization steps {}. Valid steps are {}".format(
+            ", ".join(unknown), ", ".join(NORMALIZATION_STEPS)))
+    return list(steps)
+
+
+def normalize_terms(terms, steps=NORMALIZATION_STEPS):
+    """
+    Normalize a column of terms. Each distinct term is normalized only once.
+
+    Args:
+        terms (pd.Series): Terms
+        steps (list, optional): Chain of normalization steps (see NORMALIZATION_STEPS)
+
+    Returns:
+        pd.Series: Normalized terms, with the index of terms
+    """
+    steps = check_steps(steps)
+    import pandas as pd
+    term_ids, distinct_terms = pd.factorize(terms)
+    normalized = pd.Series(distinct_terms, dtype=object)
+    for step in steps:
+        normalized = STEPS[step][0](normalized)
+    return pd.Series(normalized.values[term_ids], index=terms.index, dtype=object)
+
+
+def normalize_text(text, steps=NORMALIZATION_STEPS):
+    """Normalize a single string with the same chain of steps as normalize_terms."""
+    for step in steps:
+        text = STEPS[step][1](text)
+    return text
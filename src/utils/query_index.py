@@ -0,0 +1,166 @@
+"""
+This module contains a persisted query index of a release. It answers semantic tag and subtree
+queries, and writes their rows, using only the standard library and NumPy (no pandas or networkx),
+so short-lived processes such as CLI queries or workers start in a fraction of a second.
+
+The index is a directory of .npy arrays, memory-mapped when it is loaded, and a JSON file:
+
+    meta.json           Format version, semantic tags and languages (the arrays store their positions)
+    codes.npy           int64 code of each row (one row per code, language, term and semantic tag), sorted
+    tag_ids.npy         int16 semantic tag of each row
+    language_ids.npy    int8 language of each row
+    mainterm.npy        bool mainterm flag of each row
+    term_offsets.npy    int64, the term of row i is terms[term_offsets[i]:term_offsets[i + 1]] (in characters)
+    terms.npy           uint8 UTF-8 text of all the terms
+    subsumption_*.npy   Arrays of the SubsumptionIndex of the hierarchy
+"""
+import csv, json, os
+import numpy as np
+from utils.subsumption import SubsumptionIndex
+from utils.constants import GAZETTEER_COLUMNS
+
+QUERY_INDEX_VERSION = 1
+ARRAY_NAMES = ["codes", "tag_ids", "language_ids", "mainterm", "term_offsets", "terms"]
+SUBSUMPTION_ARRAY_NAMES = ["codes", "ancestors_indptr", "ancestors_indices", "descendants_indptr", "descendants_indices"]
+QUERY_FORMATS = ["tsv", "jsonl"]
+
+
+class QueryIndex:
+    """
+    Concept rows and hierarchy of a release, in NumPy arrays.
+
+    Attributes:
+        codes, tag_ids, language_ids, mainterm, term_offsets, terms (np.ndarray): Rows (see the module docstring)
+        semantic_tags (list): Semantic tag of each tag id
+        languages (list): Language of each language id
+        index (SubsumptionIndex): Transitive closure of the hierarchy
+    """
+
+    def __init__(self, codes, tag_ids, language_ids, mainterm, term_offsets, terms, semantic_tags, languages, index):
+        self.codes = codes
+        self.tag_ids = tag_ids
+        self.language_ids = language_ids
+        self.mainterm = mainterm
+        self.term_offsets = term_offsets
+        self.terms = terms
+        self.semantic_tags = semantic_tags
+        self.languages = languages
+        self.index = index
+        self._text = None
+
+    @classmethod
+    def from_concepts(cls, concepts, index):
+        """
+        Build the index from a concept table. Duplicated rows (same code, language, term and semantic tag) are dropped.
+
+        Args:
+            concepts (pd.DataFrame): Active concepts (output of utils.tabular_read.prepare_concept_df)
+            index (SubsumptionIndex): Transitive closure of the hierarchy
+
+        Returns:
+            QueryIndex
+        """
+        concepts = concepts.sort_values(by="code", kind="stable").drop_duplicates(subset=["code","language","term","semantic_tag"])
+        semantic_tags, tag_ids = np.unique(concepts.semantic_tag.astype(str).values, return_inverse=True)
+        languages, language_ids = np.unique(concepts.language.astype(str).values, return_inverse=True)
+        terms = concepts.term.tolist()
+        term_offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        np.cumsum([len(term) for term in terms], out=term_offsets[1:])
+        text = np.frombuffer("".join(terms).encode("utf-8"), dtype=np.uint8)
+        return cls(concepts.code.values.astype(np.int64), tag_ids.astype(np.int16), language_ids.astype(np.int8),
+                   concepts.mainterm.values.astype(bool), term_offsets, text, semantic_tags.tolist(), languages.tolist(), index)
+
+    def save(self, directory):
+        """Save the index as .npy files and a meta.json file inside a directory."""
+        os.makedirs(directory, exist_ok=True)
+        for name in ARRAY_NAMES:
+            np.save(os.path.join(directory, name + ".npy"), getattr(self, name))
+        for name in SUBSUMPTION_ARRAY_NAMES:
+            np.save(os.path.join(directory, "subsumption_{}.npy".format(name)), getattr(self.index, name))
+        with open(os.path.join(directory, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump({"version": QUERY_INDEX_VERSION, "semantic_tags": self.semantic_tags, "languages": self.languages},
+                      f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, directory, mmap_mode="r"):
+        """Load an index saved with QueryIndex.save. By default the arrays are memory-mapped."""
+        with open(os.path.join(directory, "meta.json"), encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("version") != QUERY_INDEX_VERSION:
+            raise ValueError("The query index {} was saved by another version. Build it again".format(directory))
+        arrays = [np.load(os.path.join(directory, name + ".npy"), mmap_mode=mmap_mode) for name in ARRAY_NAMES]
+        index = SubsumptionIndex(*[np.load(os.path.join(directory, "subsumption_{}.npy".format(name)), mmap_mode=mmap_mode)
+                                   for name in SUBSUMPTION_ARRAY_NAMES])
+        return cls(*arrays, meta["semantic_tags"], meta["languages"], index)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def rows_of_codes(self, codes):
+        """Sorted positions of the rows of the given codes."""
+        codes = np.unique(np.asarray(codes, dtype=np.int64))
+        starts = np.searchsorted(self.codes, codes, side="left")
+        lengths = np.searchsorted(self.codes, codes, side="right") - starts
+        return np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(int(lengths.sum()))
+
+    def rows_of_semantic_tags(self, tags):
+        """Sorted positions of the rows of the given semantic tags."""
+        tags = set(tags)
+        tag_ids = [position for position, tag in enumerate(self.semantic_tags) if tag in tags]
+        return np.flatnonzero(np.isin(self.tag_ids, tag_ids))
+
+    def subtree(self, codes):
+        """Codes of the subtrees of the given codes (codes included)."""
+        return self.index.descendants([int(code) for code in np.atleast_1d(codes)])
+
+    def rows(self, semantic_tags="all", subtrees=None):
+        """
+        Rows of the concepts of the given semantic tags plus the concepts of the subtrees of the given
+        codes, as the CLI selects them (see terminology.Terminology.gazetteer).
+
+        Args:
+            semantic_tags (list or str, optional): Semantic tags, "all" for all of them, None (or ["None"]) for none.
+            subtrees (list, optional): Codes from which the subtrees are selected.
+
+        Returns:
+            np.ndarray: Sorted positions of the rows
+        """
+        if semantic_tags == "all" or semantic_tags == ["all"]:
+            return np.arange(len(self.codes))
+        rows = np.empty(0, dtype=np.int64)
+        if semantic_tags is not None and semantic_tags != ["None"]:
+            rows = self.rows_of_semantic_tags([semantic_tags] if isinstance(semantic_tags, str) else semantic_tags)
+        if subtrees is not None:
+            rows = np.union1d(rows, self.rows_of_codes(self.subtree(subtrees)))
+        return rows
+
+    def records(self, rows):
+        """Yield the given rows as (code, term, semantic_tag, mainterm, language) tuples."""
+        if self._text is None:
+            # The text of all the terms is decoded once, and the terms are sliced from it
+            self._text = bytes(self.terms).decode("utf-8")
+        rows = np.asarray(rows, dtype=np.int64)
+        starts, ends = self.term_offsets[rows].tolist(), self.term_offsets[rows + 1].tolist()
+        for code, start, end, tag_id, mainterm, language_id in zip(self.codes[rows].tolist(), starts, ends,
+                                                                   self.tag_ids[rows].tolist(), self.mainterm[rows].tolist(),
+                                                                   self.language_ids[rows].tolist()):
+            yield code, self._text[start:end], self.semantic_tags[tag_id], mainterm, self.languages[language_id]
+
+    def write(self, rows, file, output_format="tsv"):
+        """
+        Write the given rows to an open text file, as TSV (with header) or JSON lines. The mainterm flag is written as 0/1.
+
+        Returns:
+            int: Number of written rows
+        """
+        if output_format not in QUERY_FORMATS:
+            raise ValueError("Unknown query output format {}. It must be one of {}".format(output_format, ", ".join(QUERY_FORMATS)))
+        records = ((code, term, semantic_tag, int(mainterm), language)
+                   for code, term, semantic_tag, mainterm, language in self.records(rows))
+        if output_format == "tsv":
+            writer = csv.writer(file, delimiter="\t", lineterminator="\n")
+            writer.writerow(GAZETTEER_COLUMNS)
+            writer.writerows(records)
+        else:
+            file.writelines(json.dumps(dict(zip(GAZETTEER_COLUMNS, record)), ensure_ascii=False) + "\n" for record in records)
+        return len(rows)
@@ -0,0 +1,195 @@
+"""
+This module contains functions to read Snomed-CT RF2 release files and to resolve,
+for each component, the version that is in force in the release (the row with the
+newest effectiveTime), independently of the order of the rows in the file.
+"""
+import csv, io, os
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+from utils.rf2_mmap import load_latest_components_mmap, empty_components, NUMERIC_COLUMNS
+
+# Number of rows read from the RF2 files on each chunk
+CHUNK_ROWS = 1000000
+# Approximate size of the byte ranges parsed by each worker task in parallel mode
+CHUNK_BYTES = 64 * 1024 * 1024
+
+DESCRIPTION_COLUMNS = ["id", "effectiveTime", "active", "moduleId", "conceptId", "languageCode",
+                       "typeId", "term", "caseSignificanceId"]
+RELATIONSHIP_COLUMNS = ["id", "effectiveTime", "active", "moduleId", "sourceId", "destinationId",
+                        "relationshipGroup", "typeId", "characteristicTypeId", "modifierId"]
+
+
+def find_snapshot_file(rf2_path):
+    """
+    Given the path of a Full RF2 file, return the path of the equivalent Snapshot file of the
+    same release if it is present (SnomedCT archives keep them in the relative path
+    "/Snapshot/Terminology/"). Snapshot files only contain the latest version of each component,
+    so they are much smaller than Full files and give the same result once resolved.
+
+    Args:
+        rf2_path (str): Path to a Full (or Snapshot) RF2 file
+
+    Returns:
+        str: Path of the Snapshot file, or rf2_path if there is no Snapshot file available.
+    """
+    directory, file_name = os.path.split(rf2_path)
+    if "_Full" not in file_name:
+        return rf2_path
+    snapshot_name = file_name.replace("_Full", "_Snapshot", 1)
+    candidates = [os.path.join(directory, snapshot_name)]
+    # Full/Terminology/<file> -> Snapshot/Terminology/<file>
+    terminology_dir, terminology_name = os.path.split(directory)
+    release_dir, full_name = os.path.split(terminology_dir)
+    if full_name == "Full":
+        candidates.append(os.path.join(release_dir, "Snapshot", terminology_name, snapshot_name))
+    for candidate in candidates:
+        if os.path.isfile(candidate):
+            return candidate
+    return rf2_path
+
+
+def rf2_dtypes(usecols):
+    """Types of the columns of a RF2 file: SCTIDs, dates and flags are int64, the other columns are strings."""
+    return {name: "int64" if name in NUMERIC_COLUMNS else str for name in usecols}
+
+
+def read_rf2_chunks(rf2_path, usecols, chunksize=CHUNK_ROWS):
+    """
+    Read a RF2 file in chunks of rows. Numeric columns are parsed as int64 (see rf2_dtypes).
+
+    Args:
+        rf2_path (str): Path to the RF2 file
+        usecols (list): Columns of the file to be loaded
+        chunksize (int, optional): Number of rows of each chunk
+
+    Returns:
+        Iterator of pd.DataFrame
+    """
+    return pd.read_csv(rf2_path, sep="\t", usecols=usecols, dtype=rf2_dtypes(usecols), quoting=csv.QUOTE_NONE,
+                       na_filter=False, encoding="utf-8", chunksize=chunksize)
+
+
+def resolve_latest_versions(df, key="id"):
+    """
+    Keep, for each value of key, the row with the newest effectiveTime. Ties are solved
+    in favour of the last row of the file. effectiveTime values have the YYYYMMDD format,
+    so they can be compared as integers.
+
+    Args:
+        df (pd.DataFrame): RF2 rows, with at least the columns key and effectiveTime
+        key (str, optional): Column that identifies the component. Defaults to "id".
+
+    Returns:
+        pd.DataFrame: One row per component
+    """
+    return df.sort_values(by="effectiveTime", kind="stable").drop_duplicates(subset=key, keep="last")
+
+
+def chunk_offsets(rf2_path, n_chunks):
+    """
+    Split a RF2 file (without its header) into byte ranges that start and end at line boundaries.
+
+    Args:
+        rf2_path (str): Path to the RF2 file
+        n_chunks (int): Number of byte ranges
+
+    Returns:
+        list: (start, end) byte offsets
+    """
+    size = os.path.getsize(rf2_path)
+    with open(rf2_path, "rb") as f:
+        f.readline()  # Header
+        offsets = [f.tell()]
+        for i in range(1, n_chunks):
+            target = offsets[0] + (size - offsets[0]) * i // n_chunks
+            if target <= offsets[-1]:
+                continue
+            f.seek(target - 1)
+            f.readline()  # Move to the beginning of the next line
+            if f.tell() >= size:
+                break
+            if f.tell() > offsets[-1]:
+                offsets.append(f.tell())
+    offsets.append(size)
+    return [(offsets[i], offsets[i + 1]) for i in range(len(offsets) - 1) if offsets[i + 1] > offsets[i]]
+
+
+def read_rf2_header(rf2_path):
+    """Return the column names of a RF2 file."""
+    with open(rf2_path, "r", encoding="utf-8") as f:
+        return f.readline().rstrip("\r\n").split("\t")
+
+
+def _parse_byte_range(task):
+    """Worker task: parse a range of lines of a RF2 file and resolve the latest versions inside it."""
+    rf2_path, start, end, names, usecols = task
+    with open(rf2_path, "rb") as f:
+        f.seek(start)
+        data = f.read(end - start)
+    chunk = pd.read_csv(io.BytesIO(data), sep="\t", header=None, names=names, usecols=usecols, dtype=rf2_dtypes(usecols),
+                        quoting=csv.QUOTE_NONE, na_filter=False, encoding="utf-8")
+    return resolve_latest_versions(chunk)
+
+
+def load_latest_components_parallel(rf2_path, usecols, workers, chunk_bytes=CHUNK_BYTES):
+    """
+    Parallel version of load_latest_components. The file is split at line boundaries and each
+    range is parsed and resolved in a process pool. The partial results are merged in file order
+    and resolved again, so the output is the same as the one of the serial reader.
+
+    Args:
+        rf2_path (str): Path to the RF2 file
+        usecols (list): Columns of the file to be loaded. It must include "id" and "effectiveTime"
+        workers (int): Number of processes
+        chunk_bytes (int, optional): Approximate size of each byte range
+
+    Returns:
+        pd.DataFrame: Latest version of each component (active and inactive ones)
+    """
+    names = read_rf2_header(rf2_path)
+    n_chunks = max(workers, os.path.getsize(rf2_path) // chunk_bytes + 1)
+    tasks = [(rf2_path, start, end, names, usecols) for start, end in chunk_offsets(rf2_path, n_chunks)]
+    if len(tasks) == 0:
+        return empty_components(usecols)
+    from tqdm import tqdm
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        parts = list(tqdm(pool.map(_parse_byte_range, tasks), total=len(tasks), unit=" chunks"))
+    return resolve_latest_versions(pd.concat(parts, ignore_index=True)).reset_index(drop=True)
+
+
+def load_latest_components(rf2_path, usecols, use_snapshot=True, chunksize=CHUNK_ROWS, workers=1, reader="mmap"):
+    """
+    Load a RF2 file resolving the latest version of each component. The file is read in chunks
+    and resolved after each one, so memory depends on the number of components and not on the
+    number of historical rows.
+
+    Args:
+        rf2_path (str): Path to the RF2 file
+        usecols (list): Columns of the file to be loaded. It must include "id" and "effectiveTime"
+        use_snapshot (bool, optional): Read the Snapshot file of the same release if it is present.
+        chunksize (int, optional): Number of rows of each chunk
+        workers (int, optional): Number of processes. If it is greater than 1, the file is parsed in parallel.
+        reader (str, optional): "mmap" (memory-mapped reader, see utils.rf2_mmap) or "pandas" (chunked
+                                pandas reader). Only used when workers is 1.
+
+    Returns:
+        pd.DataFrame: Latest version of each component (active and inactive ones)
+    """
+    if use_snapshot:
+        snapshot_path = find_snapshot_file(rf2_path)
+        if snapshot_path != rf2_path:
+            print("Reading Snapshot file {}".format(snapshot_path))
+        rf2_path = snapshot_path
+    if workers > 1:
+        return load_latest_components_parallel(rf2_path, usecols, workers)
+    if reader == "mmap":
+        return load_latest_components_mmap(rf2_path, usecols)
+    from tqdm import tqdm
+    components = None
+    for chunk in tqdm(read_rf2_chunks(rf2_path, usecols, chunksize), unit=" chunks"):
+        if components is not None:
+            chunk = pd.concat([components, chunk], ignore_index=True)
+        components = resolve_latest_versions(chunk)
+    if components is None:
+        return empty_components(usecols)
+    return components.reset_index(drop=True)
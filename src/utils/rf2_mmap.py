@@ -0,0 +1,170 @@
+"""
+This module contains a memory-mapped reader of RF2 files. Instead of building a Python string
+per line and a list of strings per split, the file is scanned as a NumPy byte array: the
+positions of tabs and newlines give the byte bounds of every field, numeric columns are parsed
+with vectorized operations into int64 arrays and text columns are only decoded for the rows that
+survive the latest-version resolution. Columns that are not requested (moduleId,
+caseSignificanceId, ...) are never decoded.
+"""
+import mmap
+import numpy as np
+import pandas as pd
+
+# Approximate size of the windows of the file scanned at once
+WINDOW_BYTES = 64 * 1024 * 1024
+# Columns that only contain digits
+NUMERIC_COLUMNS = frozenset(["id", "effectiveTime", "active", "moduleId", "conceptId", "typeId",
+                             "caseSignificanceId", "sourceId", "destinationId", "relationshipGroup",
+                             "characteristicTypeId", "modifierId", "refsetId", "referencedComponentId"])
+TAB, NEWLINE, CARRIAGE_RETURN = 9, 10, 13
+
+
+def empty_components(usecols):
+    """Table without rows with the columns (and types) of load_latest_components_mmap."""
+    return pd.DataFrame({name: pd.Series(dtype="int64" if name in NUMERIC_COLUMNS else object) for name in usecols})
+
+
+def parse_digits(buf, starts, ends):
+    """
+    Parse the unsigned integers written in buf[starts[i]:ends[i]] with vectorized operations.
+
+    Args:
+        buf (np.ndarray): uint8 array with the content of the file
+        starts, ends (np.ndarray): Byte bounds of the fields
+
+    Returns:
+        np.ndarray: int64 values
+
+    Raises:
+        ValueError: If a field is empty or has a byte that is not a digit
+    """
+    lengths = ends - starts
+    values = np.zeros(len(starts), dtype=np.int64)
+    if len(starts) == 0:
+        return values
+    invalid = lengths == 0
+    for position in range(int(lengths.max())):
+        has_digit = position < lengths
+        digits = buf[np.where(has_digit, starts + position, 0)].astype(np.int64) - 48
+        invalid |= has_digit & ((digits < 0) | (digits > 9))
+        values = np.where(has_digit, values * 10 + digits, values)
+    if invalid.any():
+        first = np.flatnonzero(invalid)[0]
+        raise ValueError("Malformed RF2 file: {!r} is not a number".format(
+            buf[starts[first]:ends[first]].tobytes().decode("utf-8", errors="replace")))
+    return values
+
+
+def _scan_window(buf, start, end, n_columns):
+    """
+    Return the byte bounds of the fields of the lines in buf[start:end], which must start at the
+    beginning of a line and end after a newline (or at the end of the file). Empty lines are
+    skipped, as pandas does.
+
+    Returns:
+        (np.ndarray, np.ndarray): field starts and field ends, arrays of shape (lines, n_columns)
+    """
+    window = buf[start:end]
+    newlines = np.flatnonzero(window == NEWLINE) + start
+    if len(newlines) == 0 or newlines[-1] != end - 1:
+        newlines = np.append(newlines, end)  # Last line without newline
+    tabs = np.flatnonzero(window == TAB) + start
+    line_starts = np.concatenate([[start], newlines[:-1] + 1])
+    line_ends = newlines.copy()
+    # Remove the carriage return of CRLF line endings
+    has_cr = line_ends > line_starts
+    has_cr[has_cr] = buf[line_ends[has_cr] - 1] == CARRIAGE_RETURN
+    line_ends[has_cr] -= 1
+    not_empty = line_ends > line_starts
+    tabs_per_line = np.diff(np.searchsorted(tabs, np.concatenate([[start], newlines])))
+    if (tabs_per_line[not_empty] != n_columns - 1).any():
+        raise ValueError("Malformed RF2 file: every line must have {} columns".format(n_columns))
+    tabs = tabs.reshape(-1, n_columns - 1)
+    line_starts, line_ends = line_starts[not_empty], line_ends[not_empty]
+    field_starts = np.column_stack([line_starts, tabs + 1])
+    field_ends = np.column_stack([tabs, line_ends])
+    return field_starts, field_ends
+
+
+def _decode(buf_bytes, starts, ends):
+    """Decode the utf-8 text fields buf_bytes[starts[i]:ends[i]]."""
+    return [buf_bytes[s:e].decode("utf-8") for s, e in zip(starts.tolist(), ends.tolist())]
+
+
+def load_latest_components_mmap(rf2_path, usecols, window_bytes=WINDOW_BYTES):
+    """
+    Memory-mapped version of utils.rf2.load_latest_components. The file is scanned in windows;
+    after each window only the latest version (newest effectiveTime, ties solved in favour of the
+    last row of the file) of each component id is kept, as integer ids plus the byte bounds of the
+    requested text columns.
+
+    Args:
+        rf2_path (str): Path to the RF2 file
+        usecols (list): Columns of the file to be loaded. It must include "id" and "effectiveTime"
+        window_bytes (int, optional): Approximate size of each window
+
+    Returns:
+        pd.DataFrame: Latest version of each component (active and inactive ones), with the same
+                      values (int64 numeric columns) and row order as load_latest_components.
+    """
+    with open(rf2_path, "rb") as f:
+        header = f.readline().rstrip(b"\r\n").decode("utf-8").split("\t")
+        data_start = f.tell()
+        size = f.seek(0, 2)
+        if size <= data_start:
+            return empty_components(usecols)
+        error = None
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            buf = np.frombuffer(mm, dtype=np.uint8)
+            try:
+                columns = {name: header.index(name) for name in usecols}
+                numeric = [name for name in usecols if name in NUMERIC_COLUMNS]
+                text = [name for name in usecols if name not in NUMERIC_COLUMNS]
+                state = None
+                rows_read = 0
+                start = data_start
+                while start < size:
+                    end = min(start + window_bytes, size)
+                    if end < size:
+                        # Extend the window to the end of the line
+                        end = mm.find(b"\n", end - 1)
+                        end = size if end == -1 else end + 1
+                    field_starts, field_ends = _scan_window(buf, start, end, len(header))
+                    if len(field_starts) == 0:
+                        # Only empty lines in the window
+                        start = end
+                        continue
+                    window = {"row": np.arange(rows_read, rows_read + len(field_starts), dtype=np.int64)}
+                    rows_read += len(field_starts)
+                    for name in numeric:
+                        window[name] = parse_digits(buf, field_starts[:, columns[name]], field_ends[:, columns[name]])
+                    for name in text:
+                        window[name + "_start"] = field_starts[:, columns[name]]
+                        window[name + "_end"] = field_ends[:, columns[name]]
+                    if state is not None:
+                        window = {key: np.concatenate([state[key], window[key]]) for key in window}
+                    # Latest version of each id: sort by id, effectiveTime and row and take the last one
+                    order = np.lexsort((window["row"], window["effectiveTime"], window["id"]))
+                    sorted_ids = window["id"][order]
+                    last = order[np.append(sorted_ids[1:] != sorted_ids[:-1], True)]
+                    state = {key: values[last] for key, values in window.items()}
+                    start = end
+                if state is None:
+                    return empty_components(usecols)
+                # Same row order as the pandas reader: by effectiveTime, ties in file order
+                order = np.lexsort((state["row"], state["effectiveTime"]))
+                output = dict()
+                # Columns in file order, as pandas does with usecols
+                usecols = [name for name in header if name in columns]
+                for name in usecols:
+                    if name in numeric:
+                        output[name] = state[name][order]
+                    else:
+                        output[name] = _decode(mm, state[name + "_start"][order], state[name + "_end"][order])
+                return pd.DataFrame(output, columns=usecols)
+            except ValueError as parse_error:
+                # The traceback keeps views of the map alive, so the error is raised once it is closed
+                error = str(parse_error)
+            finally:
+                del buf
+        raise ValueError("{} ({})".format(error, rf2_path))
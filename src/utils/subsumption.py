@@ -0,0 +1,207 @@
+"""
+This module contains a precomputed transitive closure of the Snomed-CT hierarchy. The
+ancestors of each concept are stored as sorted CSR arrays over the dense indices of a
+CSRGraph, so descendant sets and "is a" tests are answered with array lookups and binary
+searches, without traversing the graph again. The index can be saved to disk once per release.
+"""
+import json
+import numpy as np
+
+
+def _segments(values, starts, lengths):
+    """Return the concatenation of values[starts[i]:starts[i] + lengths[i]] for every i."""
+    total = int(lengths.sum())
+    offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    return values[offsets + np.arange(total)]
+
+
+def _csr_from_sorted_pairs(rows, cols, n):
+    """Build CSR arrays from (row, col) pairs that are already sorted by row."""
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=n), out=indptr[1:])
+    return indptr, cols.astype(np.int32)
+
+
+class SubsumptionIndex:
+    """
+    Transitive closure of the Snomed-CT hierarchy.
+
+    Attributes:
+        codes (np.ndarray): Sorted int64 SCTIDs (same dense indices as the CSRGraph it was built from)
+        ancestors_indptr, ancestors_indices (np.ndarray): Sorted proper ancestors of each concept
+        descendants_indptr, descendants_indices (np.ndarray): Sorted proper descendants of each concept
+    """
+
+    def __init__(self, codes, ancestors_indptr, ancestors_indices, descendants_indptr, descendants_indices):
+        self.codes = codes
+        self.ancestors_indptr = ancestors_indptr
+        self.ancestors_indices = ancestors_indices
+        self.descendants_indptr = descendants_indptr
+        self.descendants_indices = descendants_indices
+        self._pair_keys = None
+
+    @classmethod
+    def from_graph(cls, graph):
+        """
+        Compute the closure of a CSRGraph. Concepts are processed level by level in topological
+        order; the ancestors of the concepts of a level are the union of their parents and the
+        ancestors of those parents, computed with vectorized operations for the whole level.
+
+        Args:
+            graph (CSRGraph): Snomed-CT hierarchy
+
+        Returns:
+            SubsumptionIndex
+        """
+        n = len(graph)
+        pending_parents = np.diff(graph.parents_indptr)
+        # Ancestors of each processed concept: buffer[anc_start[i]:anc_start[i] + anc_len[i]]
+        anc_start = np.zeros(n, dtype=np.int64)
+        anc_len = np.zeros(n, dtype=np.int64)
+        buffer_len = 0
+        buffer = np.empty(0, dtype=np.int32)
+        level = np.flatnonzero(pending_parents == 0).astype(np.int32)
+        processed = 0
+        while len(level):
+            parents_len = graph.parents_indptr[level + 1] - graph.parents_indptr[level]
+            parents = graph.parents(level)
+            pair_nodes = np.repeat(level, parents_len)
+            inherited_len = anc_len[parents]
+            inherited = _segments(buffer, anc_start[parents], inherited_len)
+            rows = np.concatenate([pair_nodes, np.repeat(pair_nodes, inherited_len)]).astype(np.int64)
+            keys = np.unique(rows * n + np.concatenate([parents, inherited]))
+            cols = (keys % n).astype(np.int32)
+            # keys are sorted by concept, so the segments follow the sorted order of the level
+            sorted_level = np.sort(level)
+            counts = np.bincount(keys // n, minlength=n)[sorted_level]
+            anc_start[sorted_level] = buffer_len + np.cumsum(counts) - counts
+            anc_len[sorted_level] = counts
+            buffer_len += len(cols)
+            buffer = np.concatenate([buffer, cols])
+            processed += len(level)
+            # Next level: children whose parents have all been processed
+            children = graph.children(level)
+            np.subtract.at(pending_parents, children, 1)
+            level = np.unique(children[pending_parents[children] == 0]).astype(np.int32)
+        if processed < n:
+            raise ValueError("The hierarchy contains cycles")
+        rows = np.repeat(np.arange(n, dtype=np.int32), anc_len)
+        cols = _segments(buffer, anc_start, anc_len)
+        ancestors_indptr, ancestors_indices = _csr_from_sorted_pairs(rows, cols, n)
+        order = np.lexsort((rows, cols))
+        descendants_indptr, descendants_indices = _csr_from_sorted_pairs(cols[order], rows[order], n)
+        return cls(graph.codes, ancestors_indptr, ancestors_indices, descendants_indptr, descendants_indices)
+
+    def save(self, path, sources=None):
+        """
+        Save the index to a .npz file.
+
+        Args:
+            path (str): Path to the .npz file
+            sources (list, optional): Fingerprints of the files the index was built from (see
+                                      utils.cache.file_fingerprint), stored as JSON next to the arrays
+        """
+        extra = dict() if sources is None else {"sources": np.array(json.dumps(sources))}
+        with open(path, "wb") as f:
+            np.savez(f, codes=self.codes, ancestors_indptr=self.ancestors_indptr,
+                     ancestors_indices=self.ancestors_indices, descendants_indptr=self.descendants_indptr,
+                     descendants_indices=self.descendants_indices, **extra)
+
+    @staticmethod
+    def saved_sources(path):
+        """Fingerprints of the files a saved index was built from, or None if they were not saved."""
+        with np.load(path) as data:
+            return json.loads(str(data["sources"])) if "sources" in data.files else None
+
+    @classmethod
+    def load(cls, path):
+        """Load an index saved with SubsumptionIndex.save."""
+        with np.load(path) as data:
+            return cls(data["codes"], data["ancestors_indptr"], data["ancestors_indices"],
+                       data["descendants_indptr"], data["descendants_indices"])
+
+    def __len__(self):
+        return len(self.codes)
+
+    def index_of(self, codes):
+        """Map SCTIDs to dense indices (-1 for the codes that are not in the index)."""
+        codes = np.atleast_1d(np.asarray(codes, dtype=np.int64))
+        positions = np.minimum(np.searchsorted(self.codes, codes), len(self.codes) - 1)
+        return np.where(self.codes[positions] == codes, positions, -1).astype(np.int32)
+
+    def descendants_mask(self, nodes):
+        """Boolean mask over the dense indices with the given nodes and all their descendants."""
+        nodes = np.asarray(nodes, dtype=np.int64)
+        mask = np.zeros(len(self.codes), dtype=bool)
+        mask[nodes] = True
+        starts = self.descendants_indptr[nodes]
+        mask[_segments(self.descendants_indices, starts, self.descendants_indptr[nodes + 1] - starts)] = True
+        return mask
+
+    def descendants(self, codes):
+        """SCTIDs of the subtrees of the given codes (codes included). Unknown codes are ignored."""
+        nodes = self.index_of(codes)
+        return self.codes[self.descendants_mask(nodes[nodes >= 0])]
+
+    def ancestors(self, codes):
+        """SCTIDs of all the ancestors of the given codes (codes not included)."""
+        nodes = self.index_of(codes)
+        nodes = nodes[nodes >= 0].astype(np.int64)
+        starts = self.ancestors_indptr[nodes]
+        ancestors = _segments(self.ancestors_indices, starts, self.ancestors_indptr[nodes + 1] - starts)
+        return self.codes[np.unique(ancestors)]
+
+    def ancestor_pairs(self, codes):
+        """
+        (code, ancestor) pairs of the closure of the given codes. Unknown codes are ignored.
+
+        Returns:
+            (np.ndarray, np.ndarray): SCTIDs of the codes (repeated once per ancestor) and of their proper ancestors
+        """
+        nodes = self.index_of(codes)
+        nodes = nodes[nodes >= 0].astype(np.int64)
+        starts = self.ancestors_indptr[nodes]
+        lengths = self.ancestors_indptr[nodes + 1] - starts
+        return self.codes[np.repeat(nodes, lengths)], self.codes[_segments(self.ancestors_indices, starts, lengths)]
+
+    def subtree_pairs(self, codes):
+        """
+        (concept, root) pairs of the subtrees of the given codes, read from the descendants of each
+        root without traversing the graph. Unknown codes are ignored.
+
+        Returns:
+            (np.ndarray, np.ndarray): int64 SCTIDs of the concepts of the subtrees (roots included) and of the
+                                      roots they descend from, one pair per concept and root, sorted by concept and root
+        """
+        roots = np.unique(np.asarray(codes, dtype=np.int64))
+        nodes = self.index_of(roots)
+        roots, nodes = roots[nodes >= 0], nodes[nodes >= 0].astype(np.int64)
+        starts = self.descendants_indptr[nodes]
+        lengths = self.descendants_indptr[nodes + 1] - starts
+        concepts = np.concatenate([nodes, _segments(self.descendants_indices, starts, lengths)])
+        positions = np.concatenate([np.arange(len(roots)), np.repeat(np.arange(len(roots)), lengths)])
+        order = np.lexsort((positions, concepts))
+        return self.codes[concepts[order]], roots[positions[order]]
+
+    def is_a(self, codes, ancestor_codes):
+        """
+        Pairwise subsumption test: codes[i] is ancestor_codes[i] or one of its descendants.
+        Each test is a binary search over the sorted (concept, ancestor) pairs of the closure.
+
+        Args:
+            codes (array-like): SCTIDs
+            ancestor_codes (array-like): SCTIDs (a single code is broadcast to all the codes)
+
+        Returns:
+            np.ndarray: Boolean array
+        """
+        n = len(self.codes)
+        if self._pair_keys is None:
+            rows = np.repeat(np.arange(n, dtype=np.int64), np.diff(self.ancestors_indptr))
+            self._pair_keys = rows * n + self.ancestors_indices
+        nodes, ancestors = np.broadcast_arrays(self.index_of(codes), self.index_of(ancestor_codes))
+        known = (nodes >= 0) & (ancestors >= 0)
+        keys = nodes.astype(np.int64) * n + ancestors
+        positions = np.minimum(np.searchsorted(self._pair_keys, keys), max(len(self._pair_keys) - 1, 0))
+        found = (self._pair_keys[positions] == keys) if len(self._pair_keys) else np.zeros(len(keys), dtype=bool)
+        return known & (found | (nodes == ancestors))
@@ -1,67 +1,92 @@
-from tqdm import tqdm
-import sys, os, re
 import pandas as pd
 import numpy as np
-import operator
 
-general_path = os.getcwd().split("gaznomed")[0]+"gaznomed/"
-sys.path.append(general_path+'src')
-from utils.constants import SCT_TAGS_SPANISH, SCT_TAGS_ENGLISH, SCT_TAG_ES2EN, ADDITIONAL_EN_SCT, ADDITIONAL_ES_SCT
+from utils.constants import SEMANTIC_TAGS_ES2EN, SEMANTIC_TAGS_EN2EN, VALID_SEMANTIC_TAGS, SEMANTIC_TAG_REGEX, \
+    OUTPUT_SEMANTIC_TAGS, FSN_TYPE_ID, SYNONYM_TYPE_ID, IS_A_TYPE_ID
+from utils.rf2 import load_latest_components, resolve_latest_versions
 
+# Type of the semantic_tag column: the same categories for every language and release
+SEMANTIC_TAG_DTYPE = pd.CategoricalDtype(OUTPUT_SEMANTIC_TAGS)
 
-def active_terms_from_conceptRF2_file(concept_path):
+
+def active_terms_from_conceptRF2_file(concept_path, use_snapshot=True, workers=1, reader="mmap"):
     """
     Function to load a dataframe of concepts from the concept RF2 file. 
     This function only loads active terms present in that file
     This file can be both in english and spanish.
+
+    The latest version of each description id is the one with the newest effectiveTime, so
+    the result does not depend on the order of the rows in the file. Only the latest FSN of
+    each concept keeps the FSN typeId; older FSNs are demoted to synonyms.
     Args:
         concept_path (str): Path to the snomed-ct concept rf2 file
+        use_snapshot (bool, optional): Read the Snapshot file of the release if it is present.
+        workers (int, optional): Number of processes used to parse the file.
+        reader (str, optional): RF2 reader used when workers is 1, "mmap" or "pandas".
+
+    Returns:
+        pd.DataFrame: Dataframe with 6 columns: effectiveTime, active, conceptId (int64), languageCode
+                      (categorical), typeId (categorical), term
+    """
+    return active_terms(latest_descriptions(concept_path, use_snapshot=use_snapshot, workers=workers, reader=reader))
+
+
+def latest_descriptions(concept_path, use_snapshot=True, workers=1, reader="mmap"):
+    """
+    Latest version of every description (active and inactive ones) of a concept RF2 file. The
+    versions of several files are combined with latest_versions_of_files.
 
     Returns:
-        pd.DataFrame: Dataframe with 6 columns: effectiveTime, active, conceptId, languageCode, typeId, term
-    """
-    file = open(concept_path, 'r')
-    lines = file.readlines()
-    concept_dicts = dict()
-    for index in tqdm(range(0, len(lines))):
-        if index == 0:
-            continue
-        else:  
-            elementos = lines[index].split("\t")
-            # si el código está dentro del diccionario, añadimos.
-            if elementos[4] in concept_dicts.keys():
-                # Si typeId es main term (900000000000003001) añadimos la entrada, pero quitamos ese mainterm al resto de elementos de la lista. 
-                if elementos[6] == "900000000000003001":
-                    # Buscamos que elemento de la lista tiene en el campo main term 
-                    lista_tuplas = concept_dicts[elementos[4]]
-
-                    # Actualizamos ese elemento
-                    nueva_lista_tuplas = []
-                    for tupla in lista_tuplas:
-                        # Si el elemento guardado anteriormente tiene es FSN (ese codigo)
-                        if tupla[4] == "900000000000003001":
-                            # Lo guardo con el codigo sinonimo
-                            nueva_tupla = (tupla[0], tupla[1], tupla[2], tupla[3], "900000000000013009", tupla[5])
-                        else:
-                            # Si no lo dejo igual
-                            nueva_tupla = tupla
-                        # La añado
-                        nueva_lista_tuplas.append(nueva_tupla)
-                    # Añado a la lista el nuevo elemento
-                    nueva_lista_tuplas_end = nueva_lista_tuplas+[(elementos[1],elementos[2],elementos[4],elementos[5],elementos[6],elementos[7])]
-                    # Guardamos en el diccionario
-                    concept_dicts[elementos[4]] = nueva_lista_tuplas_end# .append((elementos[1],elementos[2],elementos[4],elementos[5],elementos[6],elementos[7]))
-                # Si no exoste se guarda dentro de la lista
-                else: 
-                    concept_dicts[elementos[4]].append((elementos[1],elementos[2],elementos[4],elementos[5],elementos[6],elementos[7]))
-            else: # Si el código no está dentro.
-                # Se añade los datos de interés 
-                concept_dicts[elementos[4]] = [(elementos[1],elementos[2],elementos[4],elementos[5],elementos[6],elementos[7])] 
-    # Convertimos el diccionario en una lista de tuplas
-    lista_tuplas = [(v[0],v[1],v[2],v[3],v[4],v[5]) for k in concept_dicts.keys() for v in concept_dicts[k]]
-    # Creamos el dataframe a partir de la lista de tuplas
-    df = pd.DataFrame(lista_tuplas, columns=["effectiveTime","active","conceptId","languageCode","typeId","term"])
-    return df
+        pd.DataFrame: Dataframe with the columns id, effectiveTime, active, conceptId, languageCode, typeId and term
+    """
+    return load_latest_components(concept_path, ["id","effectiveTime","active","conceptId","languageCode","typeId","term"],
+                                  use_snapshot=use_snapshot, workers=workers, reader=reader)
+
+
+def active_terms(df):
+    """
+    Active descriptions of a table of latest versions (see latest_descriptions). Only the latest
+    FSN of each concept keeps the FSN typeId; older FSNs are demoted to synonyms.
+    """
+    df = df[df.active == 1].copy()
+    # Resolve the latest FSN of each concept
+    fsn = df[df.typeId == FSN_TYPE_ID].sort_values(by="effectiveTime", kind="stable")
+    old_fsn = fsn.index[fsn.duplicated(subset="conceptId", keep="last")]
+    df.loc[old_fsn, "typeId"] = SYNONYM_TYPE_ID
+    df = df.astype({"languageCode": "category", "typeId": "category"})
+    return df[["effectiveTime","active","conceptId","languageCode","typeId","term"]].reset_index(drop=True)
+
+
+def latest_versions_of_files(tables):
+    """
+    Latest version of each component across several RF2 files of the same kind, e.g. an edition
+    and its extensions. A component inactivated in an extension is inactive even if it is still
+    active in the edition file. Ties are solved in favour of the later file, so the edition
+    is given first.
+
+    Args:
+        tables (list): Latest versions of each file (outputs of latest_descriptions or latest_relationships)
+
+    Returns:
+        pd.DataFrame: One row per component id
+    """
+    if len(tables) == 1:
+        return tables[0]
+    return resolve_latest_versions(pd.concat(tables, ignore_index=True)).reset_index(drop=True)
+
+
+def semantic_tag_lookup(language):
+    """ Return the dictionary that maps the valid semantic tags written in a language to their
+    english version (the semantic tags of the output are always in english).
+
+    Args:
+        language ([str]): Language of Snomed-CT mentions
+    """
+    if "es" in language: #Spanish snomed-ct
+        return SEMANTIC_TAGS_ES2EN
+    elif "en" in language:
+        return SEMANTIC_TAGS_EN2EN
+    return dict()
 
 
 def get_snomed_semantic_class(sct_mention, language):
@@ -75,77 +100,66 @@ def get_snomed_semantic_class(sct_mention, language):
     Returns:
       output (str): Semantic class string
     """
-    # If there is semantic class, the last element of the string will be a close bracket (")")
-    if sct_mention[-1] ==")": #There are semantic class
-        try:
-            # Take the string between parenthesis.
-            candidate_sem_tag = re.sub("[()]", "", re.findall('\(.*?\)',sct_mention)[-1])
-            # Depending on language, take a different list of valid semantic_tags
-            if "es" in language: #Spanish snomed-ct
-                # If candidate_sem_Tag is in the list of valid semantic tags, take always de english verison.
-                if candidate_sem_tag in SCT_TAGS_SPANISH+ADDITIONAL_ES_SCT:
-                            output = SCT_TAG_ES2EN[candidate_sem_tag] # Take always english version
-                else:
-                    output = None
-            elif "en" in language:
-                # If candidate_sem_Tag is in the list of valid semantic tags, take always de english verison.
-                if candidate_sem_tag in SCT_TAGS_ENGLISH+ADDITIONAL_EN_SCT:
-                            output = candidate_sem_tag 
-                else:
-                    output = None
-        except:
-            output = None
-    else:
-        output = None
-    return output
+    # If there is semantic class, the mention will end with a string between parenthesis.
+    candidate = SEMANTIC_TAG_REGEX.search(sct_mention)
+    if candidate is None:
+        return None
+    # If candidate_sem_Tag is in the list of valid semantic tags, take always de english verison.
+    return semantic_tag_lookup(language).get(candidate.group(1))
 
 
 def snomed_remove_semantictag(sct_mention):
-    """ Function to extract the semantic class of a mention. The semantic class is the text
+    """ Function to remove the semantic class of a mention. The semantic class is the text
     contained between brackects at the end of a string
 
     Args:
         sct_mention ([str]): Snomed-CT mention
-        language ([str]): Language of Snomed-CT mention
         
     Returns:
       output (str): 
     """
-    # If there is semantic class, the last element of the string will be a close bracket (")")
-    if sct_mention[-1] ==")": #There are semantic class
-        try:
-            # Take the mention and remove the last paranthesis information (that yusually is the semantic tag)
-            candidate_sem_tag = re.findall('\(.*?\)',sct_mention)[-1]
-            valid_sct_sem_tags = SCT_TAGS_SPANISH+ADDITIONAL_ES_SCT+SCT_TAGS_ENGLISH+ADDITIONAL_EN_SCT
-            # If candidate semantic tags is in the valid list of semantic tags, remove it. 
-            # We remove the parenthesis to search in the list
-            if re.sub("[()]", "", candidate_sem_tag) in valid_sct_sem_tags:
-                output = sct_mention.replace(candidate_sem_tag,"").strip()
-            else:
-                output = sct_mention
-        except:
-            output = sct_mention
-    else:
-        output = sct_mention
-    
-    return output
+    candidate = SEMANTIC_TAG_REGEX.search(sct_mention)
+    # If candidate semantic tags is in the valid list of semantic tags, remove it. 
+    if candidate is not None and candidate.group(1) in VALID_SEMANTIC_TAGS:
+        return sct_mention[:candidate.start()].strip()
+    return sct_mention
+
+
+def split_semantic_tags(terms, language):
+    """ Vectorized version of get_snomed_semantic_class and snomed_remove_semantictag. The
+    candidate semantic tag of each term is extracted only once.
+
+    Args:
+        terms (pd.Series): Snomed-CT mentions
+        language ([str]): Language of Snomed-CT mentions
+
+    Returns:
+        (pd.Series, pd.Series): Semantic class of each mention (categorical, missing if it has no valid
+                                semantic class) and mentions without their semantic class
+    """
+    candidates = terms.str.extract(SEMANTIC_TAG_REGEX, expand=False)
+    semantic_tags = candidates.map(semantic_tag_lookup(language)).astype(SEMANTIC_TAG_DTYPE)
+    # Remove the semantic tags that are valid in any language
+    has_tag = candidates.isin(VALID_SEMANTIC_TAGS)
+    mentions = terms.copy()
+    mentions[has_tag] = terms[has_tag].str.replace(SEMANTIC_TAG_REGEX, "", regex=True).str.strip()
+    return semantic_tags, mentions
 
 
 def prepare_concept_df(df, language):
     """
     This functions transform concept dataframe to a more readable format.
     It extract semantic classes from concepto descriptors, remove duplicates, etc
+    The output has int64 codes, categorical language and semantic_tag columns and a boolean mainterm column.
     """
-    # Extract semantic tags from descriptors
-    df["semantic_tag"] = df.term.apply(lambda x: get_snomed_semantic_class(x,language))
+    # Extract semantic tags from descriptors and remove them from texts
+    df["semantic_tag"], df["mention"] = split_semantic_tags(df.term, language)
     # Identify which terms are fully specified names
-    df["mainterm"] = df.typeId.apply(lambda x: 1 if x=="900000000000003001" else 0)
-    # Remove semantic tags from texts
-    df["mention"] = df.term.apply(lambda x: snomed_remove_semantictag(x))
+    df["mainterm"] = (df.typeId == FSN_TYPE_ID).values
     # Ordenamos por conceptId, este paso no es necesario al 100%
     df = df.sort_values(by=["conceptId","mainterm"], ascending=False).reset_index(drop=True)
     # Genero diccionario con los valores únicos de codigos y sus semantic_tag:
-    mapping_dict = dict(df[df.typeId=="900000000000003001"].loc[df['semantic_tag'].notnull(), ['conceptId', 'semantic_tag']].values)
+    mapping_dict = dict(df[df.typeId==FSN_TYPE_ID].loc[df['semantic_tag'].notnull(), ['conceptId', 'semantic_tag']].values)
     # mapeo los valores nones de semantic_tag con los valores del diccionario
     df['semantic_tag2'] = df['semantic_tag'].fillna(df['conceptId'].map(mapping_dict))
     # Only select columns we are interested in
@@ -153,78 +167,124 @@ def prepare_concept_df(df, language):
     # Remove last None values (that are obsolete terms)
     sct_df = sct_df[sct_df.semantic_tag2.notnull()].sort_values(by=["mention","mainterm"], ascending=False).reset_index(drop=True)
     # Create a new dict of code:semantic_tag of the mainterms to ensure we have the same semantic_tag for each code.
-    dict_sem_tags = dict(zip(sct_df.loc[sct_df['mainterm'] == 1].conceptId, sct_df.loc[sct_df['mainterm'] == 1].semantic_tag2))
-    sct_df['semantic_tag2'] = sct_df['conceptId'].map(dict_sem_tags)
+    dict_sem_tags = dict(zip(sct_df.loc[sct_df['mainterm']].conceptId, sct_df.loc[sct_df['mainterm']].semantic_tag2))
+    sct_df['semantic_tag2'] = sct_df['conceptId'].map(dict_sem_tags).astype(SEMANTIC_TAG_DTYPE)
     # Remove duplicates
     sct_df = sct_df.drop_duplicates(subset=["mention","conceptId","semantic_tag2","mainterm"]).reset_index(drop=True)
     # Prepare output
     sct_df.columns = ["code","language","term","semantic_tag","mainterm"]
-    sct_df["code"] = sct_df.code.astype(int)
     return sct_df
 
 
-def get_active_relations(path_relations_file):
-    """
-    Leemos el archivo de relaciones de  snomed línea por línea, borrando aquellas relaciones
-    no activas. Posteriormente eliminamos del diccionario resultante las claves (sct codes)
-    que hay que borrar por pertenecer a conceptos inactivos. Por último, iteramos para conseguir
-    la forma final del diccionario  "CODIGO" --> "Lista de codigos padre".
-    """
-    file = open(path_relations_file, 'r')
-    lines = file.readlines()
-    rels_dict = dict()
-    # First round to get the active relationship
-    for index in tqdm(range(0, len(lines))):
-        if index == 0:
-            continue
-        else:  
-            elementos = lines[index].split("\t")
-            # Si la relación es de tipo is-a procesamos
-            if (elementos[7] == "116680003"):
-                if elementos[4] in rels_dict.keys():
-                # Si la relación ya ha sido guardada previa,emente, pero había sido inactivada, cambiamos estado  
-                    if elementos[2] =="1":
-                        rels_dict[elementos[4]].append((elementos[5],"1"))
-                    else:
-                        try:
-                        # Si el valor active pasa a 0, borramos el elemento que tenia ese valor
-                            rels_dict[elementos[4]].remove((elementos[5],"1"))
-                        except:
-                            print("WARNING: Trying to remove key {} from dict. The element was removed before".format(elementos[4]))
-                else:
-                    if elementos[2] =="1":
-                        rels_dict[elementos[4]] = [(elementos[5],"1")] 
-                    else: # No guardamos cosas inactivas.
-                        continue
-
-    print("Se han obtenido {} relaciones del archivo".format(len(rels_dict)))
-
-    rels_dict_final = {k: list(map(operator.itemgetter(0), v)) for k, v in rels_dict.items()}
+def concat_concept_dfs(dfs):
+    """
+    Concatenate concept tables (outputs of prepare_concept_df), keeping the language column
+    categorical (pd.concat turns categoricals with different categories into strings).
+    """
+    dfs = list(dfs)
+    languages = pd.CategoricalDtype(sorted(set().union(*(df.language.cat.categories for df in dfs))))
+    return pd.concat([df.astype({"language": languages}) for df in dfs], ignore_index=True)
+
+
+def get_active_edges(path_relations_file, relation_types=[IS_A_TYPE_ID], use_snapshot=True, workers=1, reader="mmap"):
+    """
+    Single ingestion stage of the relationship file. The latest version (newest effectiveTime)
+    of each relationship is resolved and only the active relationships of the given types are
+    kept. Both the active code filter and the hierarchy builders consume this table.
+
+    Args:
+        path_relations_file (str): Path to the snomed-ct relationship rf2 file
+        relation_types (list or str, optional): typeIds of the relationships to keep, or "all".
+                                                Defaults to [116680003] ("Is a" relationships).
+        use_snapshot (bool, optional): Read the Snapshot file of the release if it is present.
+        workers (int, optional): Number of processes used to parse the file.
+        reader (str, optional): RF2 reader used when workers is 1, "mmap" or "pandas".
+
+    Returns:
+        pd.DataFrame: Dataframe with 4 int64 columns: id, sourceId, destinationId, typeId
+    """
+    rels = latest_relationships(path_relations_file, use_snapshot=use_snapshot, workers=workers, reader=reader)
+    return active_edges(rels, relation_types)
+
+
+def latest_relationships(path_relations_file, use_snapshot=True, workers=1, reader="mmap"):
+    """
+    Latest version of every relationship (active and inactive ones, of every type) of a relationship
+    RF2 file. The versions of several files are combined with latest_versions_of_files.
+
+    Returns:
+        pd.DataFrame: Dataframe with the int64 columns id, effectiveTime, active, sourceId, destinationId and typeId
+    """
+    return load_latest_components(path_relations_file, ["id","effectiveTime","active","sourceId","destinationId","typeId"],
+                                  use_snapshot=use_snapshot, workers=workers, reader=reader)
+
+
+def active_edges(rels, relation_types=[IS_A_TYPE_ID]):
+    """Active relationships of the given typeIds (or "all") of a table of latest versions (see latest_relationships)."""
+    rels = rels[rels.active == 1]
+    if relation_types != "all":
+        rels = rels[rels.typeId.isin([int(relation_type) for relation_type in relation_types])]
+    return rels[["id","sourceId","destinationId","typeId"]].reset_index(drop=True)
+
+
+def relations_dict_from_edges(edges):
+    """
+    Transform a table of active "is a" edges into the dictionary "CODIGO" --> "Lista de codigos padre".
+    """
+    return {k: list(v) for k, v in edges.groupby("sourceId", sort=False).destinationId}
+
+
+def get_active_relations(path_relations_file, use_snapshot=True):
+    """
+    Leemos el archivo de relaciones de snomed resolviendo la última versión (effectiveTime más
+    reciente) de cada relación, y nos quedamos con las relaciones "is-a" activas. El resultado
+    no depende del orden de las filas del archivo. Por último, agrupamos para conseguir la forma
+    final del diccionario "CODIGO" --> "Lista de codigos padre".
+    """
+    rels_dict_final = relations_dict_from_edges(get_active_edges(path_relations_file, use_snapshot=use_snapshot))
+
+    print("Se han obtenido {} relaciones del archivo".format(len(rels_dict_final)))
     
     return rels_dict_final
 
 
-from itertools import chain 
 def list_of_active_codes_from_relations(active_rels):
     """
     Given a dictionary representing each snomed-ct code and the codes to which they are attached,
      this function extracts the list of active codes, which are those with a related concept.
 
     Args:
-        active_rels (dict): Dictionary of relations between snomed-ct codes
+        active_rels (dict or pd.DataFrame): Dictionary of relations between snomed-ct codes, or
+                                            table of active edges (see get_active_edges)
+
+    Returns:
+        np.ndarray: Sorted int64 array of the active codes in snomed-ct (see isin_sorted)
+    """
+    if isinstance(active_rels, pd.DataFrame):
+        return np.unique(np.concatenate([active_rels.sourceId.values, active_rels.destinationId.values]).astype(np.int64))
+    sources = [code for code, parents in active_rels.items() if len(parents) >= 1]
+    destinations = [parent for code in sources for parent in active_rels[code]]
+    return np.unique(np.array(sources + destinations, dtype=np.int64))
+
+
+def isin_sorted(values, sorted_codes):
+    """
+    Vectorized membership test of codes in a sorted int64 array (binary search), used to filter
+    the concept table with a single boolean mask.
+
+    Args:
+        values (array-like): int64 codes to test
+        sorted_codes (np.ndarray): Sorted int64 codes (e.g. the output of list_of_active_codes_from_relations)
 
     Returns:
-        list: List of active codes in snomed-ct
-    """
-    output_list = list()
-    for i in active_rels:
-        if len(active_rels[i])>=1:
-            codigos = active_rels[i]+[i]
-            output_list.append(codigos)
-    output_list_final = chain.from_iterable(output_list)
-    codigos_active_out = list(np.unique(list(output_list_final)))
-    codigos_active_out = [ int(value) for value in codigos_active_out] 
-    return codigos_active_out
+        np.ndarray: Boolean mask, True for the values that are in sorted_codes
+    """
+    values = np.asarray(values, dtype=np.int64)
+    if len(sorted_codes) == 0:
+        return np.zeros(len(values), dtype=bool)
+    positions = np.minimum(np.searchsorted(sorted_codes, values), len(sorted_codes) - 1)
+    return sorted_codes[positions] == values
+
 
 def filter_concepts_by_semantic_tag(dataframe_sct, tags):
     """
@@ -0,0 +1,186 @@
+"""
+This module contains the output stage of the gazetteer. Rows are written in chunks as they are
+selected, instead of concatenating the selections into a single table first, and duplicated rows
+(same code, language, term and semantic tag) are dropped with a hash set of the rows already
+written. Parquet output requires pyarrow, which is an optional dependency.
+"""
+import gzip, os
+import pandas as pd
+from utils.tabular_read import SEMANTIC_TAG_DTYPE
+from utils.constants import OUTPUT_FORMATS, GAZETTEER_COLUMNS
+from utils.metrics import stage
+
+DEDUP_COLUMNS = ["code","language","term","semantic_tag"]
+# Number of rows written at once
+CHUNK_ROWS = 100000
+
+
+def to_output_types(df):
+    """Types of the written columns: the boolean mainterm flag is written as 0/1."""
+    if "mainterm" in df.columns and df.mainterm.dtype == bool:
+        return df.astype({"mainterm": "int64"})
+    return df
+
+
+def output_path_with_suffix(out_path, suffix, output_format="tsv"):
+    """Output path with a suffix added before the extension (the extension of the format, e.g. ".tsv.gz", if it has it)."""
+    extension = "." + output_format
+    if not out_path.endswith(extension):
+        out_name, extension = os.path.splitext(out_path)
+    else:
+        out_name = out_path[:-len(extension)]
+    return "{}{}{}".format(out_name, suffix, extension)
+
+
+def output_path_of_language(out_path, language, output_format="tsv"):
+    """Output path of the gazetteer of one language: the language code is added before the extension."""
+    return output_path_with_suffix(out_path, "_" + language, output_format)
+
+
+class GazetteerWriter:
+    """
+    Chunked writer of a gazetteer file. Rows whose (code, language, term, semantic_tag) were already
+    written are skipped, so the selections can be written one after the other. Other tables (e.g.
+    side tables without duplicates) can be written with their own columns and dedup_columns=None.
+
+        with GazetteerWriter("gazetteer.parquet", "parquet") as writer:
+            writer.write(semantic_tag_rows)
+            writer.write(subtree_rows)
+    """
+
+    def __init__(self, path, output_format="tsv", columns=GAZETTEER_COLUMNS, chunk_rows=CHUNK_ROWS,
+                 dedup_columns=DEDUP_COLUMNS):
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError("Unknown output format {}. It must be one of {}".format(output_format, ", ".join(OUTPUT_FORMATS)))
+        self.path = path
+        self.output_format = output_format
+        self.columns = columns
+        self.chunk_rows = chunk_rows
+        self.dedup_columns = dedup_columns
+        self.rows = 0
+        self._seen = set()
+        self._closed = False
+        self._file = None
+        self._parquet_writer = None
+        if output_format == "parquet":
+            try:
+                import pyarrow, pyarrow.parquet
+            except ImportError:
+                raise ImportError("Parquet output requires pyarrow: pip install pyarrow")
+            self._pyarrow = pyarrow
+        elif output_format == "tsv.gz":
+            self._file = gzip.open(path, "wt", encoding="utf-8", newline="")
+        else:
+            self._file = open(path, "w", encoding="utf-8", newline="")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _new_rows(self, df):
+        """Rows of df that were not written yet (the first occurrence of each row is kept)."""
+        if self.dedup_columns is None:
+            return df
+        df = df.drop_duplicates(subset=self.dedup_columns)
+        keys = zip(*(df[column].tolist() for column in self.dedup_columns))
+        is_new = [key not in self._seen and not self._seen.add(key) for key in keys]
+        return df[is_new]
+
+    def _write_chunk(self, chunk):
+        if self.output_format == "parquet":
+            table = self._pyarrow.Table.from_pandas(chunk, preserve_index=False)
+            if self._parquet_writer is None:
+                self._parquet_writer = self._pyarrow.parquet.ParquetWriter(self.path, table.schema)
+            self._parquet_writer.write_table(table.cast(self._parquet_writer.schema))
+        elif self.output_format == "jsonl":
+            self._file.write(chunk.to_json(orient="records", lines=True, force_ascii=False).rstrip("\n") + "\n")
+        else:
+            chunk.to_csv(self._file, sep="\t", index=False, header=self.rows == 0)
+
+    def write(self, df):
+        """Write the rows of df (a table with the gazetteer columns) that were not written yet."""
+        for start in range(0, len(df), self.chunk_rows):
+            chunk = to_output_types(self._new_rows(df.iloc[start:start + self.chunk_rows])[self.columns])
+            if len(chunk):
+                self._write_chunk(chunk)
+                self.rows += len(chunk)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        # Empty gazetteers still get the header (or the schema)
+        if self.rows == 0 and self.output_format != "jsonl":
+            self._write_chunk(pd.DataFrame(columns=self.columns))
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+            self._parquet_writer = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def write_gazetteer(parts, out_path, output_format="tsv", split_languages=False, columns=GAZETTEER_COLUMNS):
+    """
+    Write the selections of a gazetteer, one after the other, dropping the duplicated rows.
+
+    Args:
+        parts (iterable): Tables with the gazetteer columns
+        out_path (str): Output path
+        output_format (str, optional): One of OUTPUT_FORMATS
+        split_languages (bool, optional): Write one file per language (see output_path_of_language)
+        columns (list, optional): Columns written (the gazetteer columns and, e.g., the hierarchy columns)
+
+    Returns:
+        list: Paths of the written files
+    """
+    writers = dict()
+    try:
+        for part in parts:
+            with stage("write") as record:
+                if not split_languages:
+                    if None not in writers:
+                        writers[None] = GazetteerWriter(out_path, output_format, columns)
+                    written = writers[None].rows
+                    writers[None].write(part)
+                    record["rows"] = writers[None].rows - written
+                    continue
+                written = sum(writer.rows for writer in writers.values())
+                for language, language_df in part.groupby("language", sort=True):
+                    if language not in writers:
+                        writers[language] = GazetteerWriter(output_path_of_language(out_path, language, output_format),
+                                                            output_format, columns)
+                    writers[language].write(language_df)
+                record["rows"] = sum(writer.rows for writer in writers.values()) - written
+        if not split_languages and None not in writers:
+            writers[None] = GazetteerWriter(out_path, output_format, columns)
+    finally:
+        for writer in writers.values():
+            writer.close()
+    return [writers[key].path for key in sorted(writers, key=lambda key: "" if key is None else key)]
+
+
+def read_gazetteer_file(path, output_format="tsv"):
+    """Read a gazetteer written by GazetteerWriter, with the column types of the concept table (see
+    utils.tabular_read.prepare_concept_df)."""
+    if output_format == "parquet":
+        df = pd.read_parquet(path)
+    elif output_format == "jsonl":
+        df = pd.read_json(path, lines=True, dtype={"term": str, "semantic_tag": str, "language": str})
+    else:
+        df = pd.read_csv(path, sep="\t", dtype=str, na_filter=False, encoding="utf-8",
+                         compression="gzip" if output_format == "tsv.gz" else None)
+    if len(df) == 0:
+        df = pd.DataFrame(columns=GAZETTEER_COLUMNS)
+    df = df.astype({"code": "int64", "mainterm": "int64", "term": str, "semantic_tag": SEMANTIC_TAG_DTYPE,
+                    "language": "category"})
+    return df.astype({"mainterm": bool})[GAZETTEER_COLUMNS]
+
+
+def write_table(df, out_path, output_format="tsv"):
+    """Write a side table of the gazetteer (e.g. the ancestor closure) in one of OUTPUT_FORMATS, keeping all its rows."""
+    with GazetteerWriter(out_path, output_format, list(df.columns), dedup_columns=None) as writer:
+        writer.write(df)
+    return out_path
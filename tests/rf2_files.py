@@ -0,0 +1,55 @@
+"""Helpers to write small RF2 files and hierarchies in the tests."""
+import random
+
+ROOT = 138875005
+MODULE = "900000000000207008"
+IS_A, STATED, MODIFIER = "116680003", "900000000000011006", "900000000000451002"
+
+
+def write_rf2(path, header, rows, newline="\n", blank_lines=()):
+    """Write a RF2 file, with empty lines after the given row positions and a trailing empty line."""
+    lines = ["\t".join(header)]
+    for position, row in enumerate(rows):
+        lines.append("\t".join(row))
+        if position in blank_lines:
+            lines.append("")
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        f.write(newline.join(lines) + newline + newline)
+    return str(path)
+
+
+def random_hierarchy(n_concepts=300, seed=0):
+    """
+    Random "is a" hierarchy under the root: each concept has 1 to 3 parents among the previous ones.
+
+    Returns:
+        (list, list): SCTIDs of the children and of the parents of each edge
+    """
+    rng = random.Random(seed)
+    codes = [ROOT] + [1000 + 7 * i for i in range(1, n_concepts)]
+    sources, destinations = [], []
+    for position in range(1, n_concepts):
+        for parent in set(rng.choice(codes[:position]) for _ in range(rng.randint(1, 3))):
+            sources.append(codes[position])
+            destinations.append(parent)
+    return sources, destinations
+
+
+def relationship_rows(sources, destinations, effective_time="20230131", active="1"):
+    """RF2 relationship rows (see utils.rf2.RELATIONSHIP_COLUMNS) of "is a" edges."""
+    return [[str(5000000 + i), effective_time, active, MODULE, str(source), str(destination), "0", IS_A, STATED, MODIFIER]
+            for i, (source, destination) in enumerate(zip(sources, destinations))]
+
+
+def brute_descendants(sources, destinations, code):
+    """Codes of the subtree of a code (code included), by a depth-first traversal of the edges."""
+    children = dict()
+    for source, destination in zip(sources, destinations):
+        children.setdefault(destination, []).append(source)
+    found, pending = {code}, [code]
+    while pending:
+        for child in children.get(pending.pop(), []):
+            if child not in found:
+                found.add(child)
+                pending.append(child)
+    return found
@@ -0,0 +1,42 @@
+"""
+The term automaton must find the terms of the gazetteer in a text: every occurrence (overlapping ones
+included) or only the leftmost longest ones, also when the text is written with another punctuation
+or case than the term.
+"""
+import os, sys
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from utils.automaton import TermAutomaton
+from utils.constants import GAZETTEER_COLUMNS
+
+GAZETTEER = pd.DataFrame([
+    (22298006, "Myocardial infarction", "disorder", True, "en"),
+    (57054005, "Acute myocardial infarction", "disorder", True, "en"),
+    (55641003, "Infarction", "morphologic abnormality", True, "en"),
+    (118613001, "T-cell lymphoma", "disorder", True, "en"),
+], columns=GAZETTEER_COLUMNS)
+
+
+def spans(matches):
+    return [(match.start, match.end, match.code) for match in matches]
+
+
+def test_overlapping_matches(tmp_path):
+    text = "Acute myocardial infarction."
+    automaton = TermAutomaton.from_gazetteer(GAZETTEER)
+    assert spans(automaton.find(text, longest=False)) == [(0, 27, 57054005), (6, 27, 22298006), (17, 27, 55641003)]
+    assert spans(automaton.find(text)) == [(0, 27, 57054005)]
+    # Same matches with the memory-mapped arrays
+    automaton.save(str(tmp_path / "automaton"))
+    assert spans(TermAutomaton.load(str(tmp_path / "automaton")).find(text, longest=False)) == \
+        spans(automaton.find(text, longest=False))
+
+
+def test_normalized_match():
+    automaton = TermAutomaton.from_gazetteer(GAZETTEER, ["casefold", "punctuation"])
+    assert " " not in automaton.vocabulary
+    for text in ["Known T cell lymphoma", "Known t-cell LYMPHOMA", "Known T - cell lymphoma"]:
+        assert spans(automaton.find(text)) == [(6, len(text), 118613001)], text
+    # Without the punctuation step the hyphen is a token of the term
+    assert TermAutomaton.from_gazetteer(GAZETTEER).find("Known T cell lymphoma") == []
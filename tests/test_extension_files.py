@@ -0,0 +1,50 @@
+"""
+The concept and relation files of an edition and its extensions are combined: the latest version of
+each component is resolved across all the files, and the semantic tag of a synonym comes from the
+FSN of its concept in any file of the same language.
+"""
+import os, sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from utils.rf2 import DESCRIPTION_COLUMNS, RELATIONSHIP_COLUMNS
+from terminology import load_all_concepts, load_isa_edges
+from rf2_files import write_rf2, MODULE, IS_A, STATED, MODIFIER
+
+CORE = "900000000000448009"
+FSN, SYNONYM = "900000000000003001", "900000000000013009"
+
+
+def description(id, effective_time, active, concept, type_id, term):
+    return [id, effective_time, active, MODULE, concept, "en", type_id, term, CORE]
+
+
+def relationship(id, effective_time, active, source, destination):
+    return [id, effective_time, active, MODULE, source, destination, "0", IS_A, STATED, MODIFIER]
+
+
+def test_synonyms_of_an_extension_take_the_semantic_tag_of_the_edition(tmp_path):
+    edition = write_rf2(tmp_path / "edition.txt", DESCRIPTION_COLUMNS, [
+        description("1011", "20220731", "1", "22298006", FSN, "Myocardial infarction (disorder)"),
+        description("1021", "20220731", "1", "22298006", SYNONYM, "Heart attack"),
+    ])
+    extension = write_rf2(tmp_path / "extension.txt", DESCRIPTION_COLUMNS, [
+        description("2011", "20230131", "1", "22298006", SYNONYM, "Cardiac infarction"),
+        # Inactivation of a description of the edition
+        description("1021", "20230131", "0", "22298006", SYNONYM, "Heart attack"),
+    ])
+    concepts = load_all_concepts([edition, extension], ["en", "en"])
+    assert sorted(concepts.term) == ["Cardiac infarction", "Myocardial infarction"]
+    assert set(concepts.semantic_tag) == {"disorder"}
+
+
+def test_relationships_inactivated_in_an_extension_are_not_active(tmp_path):
+    edition = write_rf2(tmp_path / "edition.txt", RELATIONSHIP_COLUMNS, [
+        relationship("1001", "20220731", "1", "22298006", "138875005"),
+        relationship("1002", "20220731", "1", "404684003", "138875005"),
+    ])
+    extension = write_rf2(tmp_path / "extension.txt", RELATIONSHIP_COLUMNS, [
+        relationship("1001", "20230131", "0", "22298006", "138875005"),
+        relationship("2001", "20230131", "1", "22298006", "404684003"),
+    ])
+    edges = load_isa_edges([edition, extension])
+    assert sorted(zip(edges.sourceId, edges.destinationId)) == [(22298006, 404684003), (404684003, 138875005)]
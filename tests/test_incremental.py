@@ -0,0 +1,81 @@
+"""
+A gazetteer updated from the previous release (--update_from) must have the same rows as the gazetteer
+built again from the new release (the recomputed concepts are written after the others), and an update
+with a different selection than the previous run is refused.
+"""
+import os, sys
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from utils.rf2 import DESCRIPTION_COLUMNS, RELATIONSHIP_COLUMNS
+from gaznomed import main
+from rf2_files import write_rf2, random_hierarchy, relationship_rows, MODULE, IS_A, STATED, MODIFIER
+
+CORE = "900000000000448009"
+FSN, SYNONYM = "900000000000003001", "900000000000013009"
+TAGS = ["disorder", "finding", "procedure"]
+SOURCES, DESTINATIONS = random_hierarchy(60, seed=1)
+CODES = sorted(set(SOURCES))
+SUBTREE = 1021
+NEW_CONCEPT = 99999
+
+
+def descriptions(code, effective_time, active="1", term=None):
+    term = term or "Concept {}".format(code)
+    return [[str(code * 10 + 1), effective_time, active, MODULE, str(code), "en", FSN,
+             "{} ({})".format(term, TAGS[code % 3]), CORE],
+            [str(code * 10 + 2), effective_time, active, MODULE, str(code), "en", SYNONYM, term, CORE]]
+
+
+def write_release(directory, next_release):
+    """Release N, or N+1: a renamed concept, an inactivated concept, a new concept and a moved concept"""
+    os.makedirs(directory)
+    concepts = [row for code in CODES for row in descriptions(code, "20230131")]
+    relationships = relationship_rows(SOURCES, DESTINATIONS)
+    if next_release:
+        concepts += descriptions(CODES[10], "20230731", term="Renamed concept")
+        concepts += descriptions(CODES[23], "20230731", active="0")
+        concepts += descriptions(NEW_CONCEPT, "20230731")
+        moved = [row for row in relationships if row[4] == str(CODES[30])]
+        relationships += [row[:1] + ["20230731", "0"] + row[3:] for row in moved]
+        relationships += [["6000001", "20230731", "1", MODULE, str(NEW_CONCEPT), str(SUBTREE), "0", IS_A, STATED, MODIFIER],
+                          ["6000002", "20230731", "1", MODULE, str(CODES[30]), str(SUBTREE), "0", IS_A, STATED, MODIFIER]]
+    return (write_rf2(os.path.join(directory, "sct2_Description.txt"), DESCRIPTION_COLUMNS, concepts),
+            write_rf2(os.path.join(directory, "sct2_Relationship.txt"), RELATIONSHIP_COLUMNS, relationships))
+
+
+def run(release, out, cache_dir, semantic_tags="disorder", extra=()):
+    concept_path, relation_path = release
+    main(["-c", concept_path, "-r", relation_path, "-l", "en", "-s", semantic_tags, "-t", str(SUBTREE),
+          "--cache_dir", cache_dir, "--no_snapshot", "-o", out] + list(extra))
+    with open(out, encoding="utf-8") as f:
+        return sorted(f.read().splitlines())
+
+
+@pytest.fixture
+def releases(tmp_path):
+    return write_release(str(tmp_path / "N"), False), write_release(str(tmp_path / "N1"), True)
+
+
+def test_update_equals_a_full_build_of_the_new_release(tmp_path, releases):
+    old_release, new_release = releases
+    old = run(old_release, str(tmp_path / "old.tsv"), str(tmp_path / "cache"))
+    updated = run(new_release, str(tmp_path / "updated.tsv"), str(tmp_path / "cache"),
+                  extra=["--update_from", str(tmp_path / "old.tsv")])
+    rebuilt = run(new_release, str(tmp_path / "rebuilt.tsv"), str(tmp_path / "rebuilt_cache"))
+    assert updated == rebuilt
+    assert updated != old
+    assert "Concept {}".format(CODES[23]) in [row.split("\t")[1] for row in old]
+    terms = [row.split("\t")[1] for row in updated]
+    assert "Renamed concept" in terms and "Concept {}".format(NEW_CONCEPT) in terms
+    assert "Concept {}".format(CODES[23]) not in terms
+    assert os.path.exists(str(tmp_path / "updated.tsv.changes.tsv"))
+
+
+def test_update_with_another_selection_is_refused(tmp_path, releases):
+    old_release, new_release = releases
+    run(old_release, str(tmp_path / "old.tsv"), str(tmp_path / "cache"))
+    with pytest.raises(SystemExit):
+        run(new_release, str(tmp_path / "updated.tsv"), str(tmp_path / "cache"), semantic_tags="finding",
+            extra=["--update_from", str(tmp_path / "old.tsv")])
+    assert not os.path.exists(str(tmp_path / "updated.tsv"))
@@ -0,0 +1,79 @@
+"""
+The RF2 readers (chunked pandas, parallel and memory-mapped) must resolve the same latest version of
+each component. Each test writes a small RF2 file and compares the outputs of the three readers.
+"""
+import os, sys
+import pandas as pd
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from utils.rf2 import load_latest_components, load_latest_components_parallel, DESCRIPTION_COLUMNS, RELATIONSHIP_COLUMNS
+from utils.rf2_mmap import load_latest_components_mmap
+from rf2_files import write_rf2
+
+DESCRIPTION_USECOLS = ["id","effectiveTime","active","conceptId","languageCode","typeId","term"]
+RELATIONSHIP_USECOLS = ["id","effectiveTime","active","sourceId","destinationId","typeId"]
+
+# Component 101 has three versions, out of file order; the latest one (20230131) is inactive
+DESCRIPTIONS = [
+    ["101", "20220731", "1", "900000000000207008", "10", "en", "900000000000003001", "Heart (body structure)", "900000000000448009"],
+    ["102", "20220731", "1", "900000000000207008", "10", "en", "900000000000013009", "Heart", "900000000000448009"],
+    ["101", "20230131", "0", "900000000000207008", "10", "en", "900000000000003001", "Heart (body structure)", "900000000000448009"],
+    ["103", "20220731", "1", "900000000000207008", "11", "en", "900000000000013009", "Cœur – ñandú", "900000000000448009"],
+    ["101", "20020131", "1", "900000000000207008", "10", "en", "900000000000003001", "Old heart", "900000000000448009"],
+    ["102", "20220731", "1", "900000000000207008", "10", "en", "900000000000013009", "Heart, tie", "900000000000448009"],
+]
+RELATIONSHIPS = [
+    ["201", "20220731", "1", "900000000000207008", "10", "138875005", "0", "116680003", "900000000000011006", "900000000000451002"],
+    ["202", "20220731", "1", "900000000000207008", "11", "10", "0", "116680003", "900000000000011006", "900000000000451002"],
+    ["201", "20230131", "0", "900000000000207008", "10", "138875005", "0", "116680003", "900000000000011006", "900000000000451002"],
+    ["203", "20230131", "1", "900000000000207008", "10", "138875005", "0", "116680003", "900000000000011006", "900000000000451002"],
+]
+CASES = {"descriptions": (DESCRIPTION_COLUMNS, DESCRIPTIONS, DESCRIPTION_USECOLS),
+         "relationships": (RELATIONSHIP_COLUMNS, RELATIONSHIPS, RELATIONSHIP_USECOLS)}
+
+
+def read_with_every_reader(path, usecols):
+    return {"pandas": load_latest_components(path, usecols, use_snapshot=False, chunksize=2, reader="pandas"),
+            # Windows of a few bytes end in the middle of a line, so they are extended to the end of the line
+            "mmap": load_latest_components_mmap(path, usecols, window_bytes=7),
+            "parallel": load_latest_components_parallel(path, usecols, workers=2, chunk_bytes=100)}
+
+
+@pytest.mark.parametrize("newline", ["\n", "\r\n"])
+@pytest.mark.parametrize("case", sorted(CASES))
+def test_readers_resolve_the_same_latest_versions(tmp_path, case, newline):
+    header, rows, usecols = CASES[case]
+    path = write_rf2(tmp_path / "sct2_{}.txt".format(case), header, rows, newline, blank_lines=[1])
+    outputs = read_with_every_reader(path, usecols)
+    expected = outputs["pandas"]
+    assert sorted(expected.id) == sorted(set(int(row[0]) for row in rows))
+    latest = expected.set_index("id")
+    assert latest.loc[101 if case == "descriptions" else 201, "effectiveTime"] == 20230131
+    assert latest.loc[101 if case == "descriptions" else 201, "active"] == 0
+    for reader in ["mmap", "parallel"]:
+        pd.testing.assert_frame_equal(outputs[reader].reset_index(drop=True), expected.reset_index(drop=True))
+
+
+@pytest.mark.parametrize("newline", ["\n", "\r\n"])
+def test_files_with_only_empty_lines_have_no_components(tmp_path, newline):
+    path = write_rf2(tmp_path / "sct2_Description.txt", DESCRIPTION_COLUMNS, [], newline)
+    for reader, output in read_with_every_reader(path, DESCRIPTION_USECOLS).items():
+        assert list(output.columns) == DESCRIPTION_USECOLS, reader
+        assert len(output) == 0, reader
+
+
+def test_ties_are_solved_in_favour_of_the_last_row(tmp_path):
+    path = write_rf2(tmp_path / "sct2_Description.txt", DESCRIPTION_COLUMNS, DESCRIPTIONS)
+    for reader, output in read_with_every_reader(path, DESCRIPTION_USECOLS).items():
+        assert output.set_index("id").loc[102, "term"] == "Heart, tie", reader
+        assert output.set_index("id").loc[103, "term"] == "Cœur – ñandú", reader
+
+
+def test_non_numeric_ids_are_rejected(tmp_path):
+    rows = DESCRIPTIONS + [["10x4", "20220731", "1", "900000000000207008", "10", "en", "900000000000013009", "Bad", "900000000000448009"]]
+    path = write_rf2(tmp_path / "sct2_Description.txt", DESCRIPTION_COLUMNS, rows)
+    with pytest.raises(ValueError):
+        load_latest_components(path, DESCRIPTION_USECOLS, use_snapshot=False, reader="pandas")
+    with pytest.raises(ValueError, match="10x4"):
+        load_latest_components_mmap(path, DESCRIPTION_USECOLS)
@@ -0,0 +1,81 @@
+"""
+The gazetteer server answers the queries of a client on localhost: rows as TSV or JSON, 400 for a
+bad parameter, 404 for an unknown endpoint and 500 (not 404) for an error inside a query.
+"""
+import asyncio, json, os, sys
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from utils.rf2 import DESCRIPTION_COLUMNS, RELATIONSHIP_COLUMNS
+from terminology import Terminology
+from server import GazetteerServer
+from rf2_files import write_rf2, relationship_rows, MODULE, ROOT
+
+CORE = "900000000000448009"
+FSN, SYNONYM = "900000000000003001", "900000000000013009"
+CONCEPTS = {404684003: "Clinical finding (finding)", 64572001: "Disease (disorder)", 22298006: "Myocardial infarction (disorder)",
+            123037004: "Body structure (body structure)"}
+EDGES = [(404684003, ROOT), (64572001, 404684003), (22298006, 64572001), (123037004, ROOT)]
+
+
+@pytest.fixture(scope="module")
+def terminology(tmp_path_factory):
+    directory = tmp_path_factory.mktemp("release")
+    rows = [[str(code * 10 + 1), "20230131", "1", MODULE, str(code), "en", FSN, term, CORE] for code, term in CONCEPTS.items()]
+    rows += [[str(code * 10 + 2), "20230131", "1", MODULE, str(code), "en", SYNONYM, term.rsplit(" (", 1)[0], CORE]
+             for code, term in CONCEPTS.items()]
+    concept_path = write_rf2(directory / "sct2_Description.txt", DESCRIPTION_COLUMNS, rows)
+    relation_path = write_rf2(directory / "sct2_Relationship.txt", RELATIONSHIP_COLUMNS,
+                              relationship_rows(*zip(*EDGES)))
+    return Terminology.load([concept_path], ["en"], [relation_path], use_snapshot=False)
+
+
+async def get(port, target):
+    """Status and de-chunked body of a GET request"""
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write("GET {} HTTP/1.1\r\nHost: localhost\r\n\r\n".format(target).encode("latin-1"))
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    head, chunks = response.split(b"\r\n\r\n", 1)
+    body = b""
+    while True:
+        size, chunks = chunks.split(b"\r\n", 1)
+        if int(size, 16) == 0:
+            break
+        body, chunks = body + chunks[:int(size, 16)], chunks[int(size, 16) + 2:]
+    return int(head.split(b" ")[1]), body.decode("utf-8")
+
+
+def query(terminology, *targets):
+    """Start a server on a free port, send the requests and close it"""
+    async def run():
+        server = GazetteerServer(terminology, port=0)
+        await server.start()
+        try:
+            return [await get(server.port, target) for target in targets]
+        finally:
+            await server.close()
+    return asyncio.run(run())
+
+
+def test_rows_are_served_as_tsv_and_json(terminology):
+    (status, tsv), (json_status, body) = query(terminology, "/semantic_tag?tags=disorder", "/subtree?codes=64572001&format=json")
+    assert status == 200 and json_status == 200
+    lines = tsv.splitlines()
+    assert lines[0] == "code\tterm\tsemantic_tag\tmainterm\tlanguage"
+    assert sorted(set(line.split("\t")[1] for line in lines[1:])) == ["Disease", "Myocardial infarction"]
+    assert sorted(set(row["code"] for row in json.loads(body))) == [22298006, 64572001]
+
+
+def test_errors(terminology, monkeypatch):
+    (health, body), (unknown, _), (bad, _) = query(terminology, "/health", "/unknown", "/code?codes=abc")
+    assert health == 200 and json.loads(body) == {"status": "ok", "concepts": len(terminology.concepts)}
+    assert unknown == 404
+    assert bad == 400
+
+    def broken():
+        return {}["missing"]
+    monkeypatch.setattr(terminology, "semantic_tags", broken)
+    [(status, body)] = query(terminology, "/semantic_tags")
+    assert status == 500 and "missing" in body
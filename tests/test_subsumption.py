@@ -0,0 +1,90 @@
+"""
+The subsumption index must give the same descendants, ancestors and "is a" answers as a traversal of
+the graph, also after a save/load round trip, and a saved index is only used with its relation files.
+The subtrees of several roots (CSR graph and subsumption index) are compared with a traversal too.
+"""
+import os, sys
+import numpy as np
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from utils.csr_graph import CSRGraph
+from utils.subsumption import SubsumptionIndex
+from utils.graph_read import load_subsumption_index
+from utils.rf2 import RELATIONSHIP_COLUMNS
+from rf2_files import write_rf2, random_hierarchy, relationship_rows, brute_descendants, ROOT
+
+SOURCES, DESTINATIONS = random_hierarchy()
+CODES = sorted(set(SOURCES) | set(DESTINATIONS))
+SUBTREES = {code: brute_descendants(SOURCES, DESTINATIONS, code) for code in CODES}
+
+
+@pytest.fixture(scope="module")
+def graph():
+    return CSRGraph.from_edges(SOURCES, DESTINATIONS)
+
+
+@pytest.fixture(scope="module")
+def index(graph):
+    return SubsumptionIndex.from_graph(graph)
+
+
+def test_descendants_and_ancestors_match_a_traversal(index):
+    for code in CODES:
+        assert index.descendants([code]).tolist() == sorted(SUBTREES[code])
+        ancestors = sorted(other for other in CODES if other != code and code in SUBTREES[other])
+        assert index.ancestors([code]).tolist() == ancestors
+    assert index.descendants([ROOT]).tolist() == CODES
+    assert index.descendants(CODES[5:8]).tolist() == sorted(set().union(*(SUBTREES[code] for code in CODES[5:8])))
+    # Unknown codes are ignored
+    assert index.descendants([999]).tolist() == []
+
+
+def test_is_a_matches_a_traversal(index):
+    codes = np.repeat(CODES, len(CODES))
+    ancestors = np.tile(CODES, len(CODES))
+    expected = [code in SUBTREES[ancestor] for code, ancestor in zip(codes, ancestors)]
+    assert index.is_a(codes, ancestors).tolist() == expected
+    assert index.is_a([CODES[10], 999], ROOT).tolist() == [True, False]
+
+
+def test_save_and_load(index, tmp_path):
+    path = str(tmp_path / "index.npz")
+    index.save(path)
+    loaded = SubsumptionIndex.load(path)
+    for name in ["codes", "ancestors_indptr", "ancestors_indices", "descendants_indptr", "descendants_indices"]:
+        assert np.array_equal(getattr(loaded, name), getattr(index, name))
+    assert SubsumptionIndex.saved_sources(path) is None
+
+
+def test_saved_index_is_only_used_with_its_relation_files(tmp_path):
+    release = write_rf2(tmp_path / "relationships.txt", RELATIONSHIP_COLUMNS, relationship_rows(SOURCES, DESTINATIONS))
+    other_release = write_rf2(tmp_path / "other_relationships.txt", RELATIONSHIP_COLUMNS,
+                              relationship_rows(SOURCES[1:], DESTINATIONS[1:]))
+    path = str(tmp_path / "index.npz")
+    graph = CSRGraph.from_edges(SOURCES, DESTINATIONS)
+    built = load_subsumption_index(path, graph, [release])
+    assert [source["size"] for source in SubsumptionIndex.saved_sources(path)] == [os.path.getsize(release)]
+    loaded = load_subsumption_index(path, relation_paths=[release])
+    assert np.array_equal(loaded.descendants_indices, built.descendants_indices)
+    with pytest.raises(ValueError):
+        load_subsumption_index(path, graph, [other_release])
+    # An index saved without the fingerprints of its relation files is not trusted either
+    SubsumptionIndex.from_graph(graph).save(path)
+    with pytest.raises(ValueError):
+        load_subsumption_index(path, relation_paths=[release])
+
+
+def test_subtree_pairs_match_a_traversal(graph, index):
+    leaves = [code for code in CODES if SUBTREES[code] == {code}]
+    nested = [code for code in CODES if code != ROOT and len(SUBTREES[code]) > 2][:2]
+    # Overlapping roots (a root inside the subtree of another one, and the root of the hierarchy), a leaf,
+    # a repeated root and a code that is not in the hierarchy
+    inner = sorted(SUBTREES[nested[0]] - {nested[0]})[0]
+    cases = [[ROOT, nested[0]], nested + [inner, leaves[0]], [leaves[0]], [nested[1], nested[1], 999], []]
+    for roots in cases:
+        expected = sorted((code, root) for root in set(roots) if root in SUBTREES for code in SUBTREES[root])
+        for structure in [graph, index]:
+            codes, subtree_roots = structure.subtree_pairs(roots)
+            assert codes.dtype == subtree_roots.dtype == np.int64
+            assert list(zip(codes.tolist(), subtree_roots.tolist())) == expected, (type(structure).__name__, roots)
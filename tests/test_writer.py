@@ -0,0 +1,57 @@
+"""
+A gazetteer written by GazetteerWriter in chunks must be read back by read_gazetteer_file with the
+same rows (each duplicated row written once, also when its copies are in different chunks) and types.
+"""
+import os, sys
+import pandas as pd
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from utils.writer import GazetteerWriter, read_gazetteer_file
+from utils.tabular_read import SEMANTIC_TAG_DTYPE
+from utils.constants import GAZETTEER_COLUMNS
+
+ROWS = [
+    (22298006, "Myocardial infarction", "disorder", True, "en"),
+    (22298006, "Heart attack", "disorder", False, "en"),
+    (80891009, "Cœur – \"structure\"", "body structure", False, "es"),
+    # Copy of the first row, in the second chunk
+    (22298006, "Myocardial infarction", "disorder", True, "en"),
+    (1234, "NA", "finding", False, "en"),
+    (1234, "0012", "finding", False, "en"),
+]
+
+
+def gazetteer(rows):
+    df = pd.DataFrame(rows, columns=GAZETTEER_COLUMNS)
+    return df.astype({"semantic_tag": SEMANTIC_TAG_DTYPE, "language": "category"})
+
+
+def has_pyarrow():
+    try:
+        import pyarrow
+    except ImportError:
+        return False
+    return True
+
+
+OUTPUT_FORMATS = ["tsv", "tsv.gz", "jsonl",
+                  pytest.param("parquet", marks=pytest.mark.skipif(not has_pyarrow(), reason="Parquet output requires pyarrow"))]
+
+
+@pytest.mark.parametrize("output_format", OUTPUT_FORMATS)
+def test_round_trip(tmp_path, output_format):
+    path = str(tmp_path / "gazetteer.{}".format(output_format))
+    with GazetteerWriter(path, output_format, chunk_rows=3) as writer:
+        writer.write(gazetteer(ROWS))
+    assert writer.rows == len(ROWS) - 1
+    expected = gazetteer(ROWS[:3] + ROWS[4:])
+    pd.testing.assert_frame_equal(read_gazetteer_file(path, output_format), expected)
+
+
+@pytest.mark.parametrize("output_format", OUTPUT_FORMATS)
+def test_empty_gazetteer(tmp_path, output_format):
+    path = str(tmp_path / "gazetteer.{}".format(output_format))
+    GazetteerWriter(path, output_format).close()
+    df = read_gazetteer_file(path, output_format)
+    assert list(df.columns) == GAZETTEER_COLUMNS and len(df) == 0